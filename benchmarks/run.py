@@ -0,0 +1,266 @@
+"""
+Benchmarks for maildown's render and send hot paths. Run with `python -m benchmarks`, optionally writing the results
+to JSON with `--output` and comparing against an earlier run with `--compare`
+"""
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+Case = Tuple[str, Callable[[], object], int]
+
+BENCHMARKS: List[Callable[[], Iterator[Case]]] = []
+
+PARAGRAPH = (
+    "Maildown makes it **easy** to send `markdown` emails. It supports [links](https://example.com), *emphasis* and "
+    "lists:\n\n- one\n- two\n- three\n\n"
+)
+CODE_BLOCK = "```python\ndef greet(name):\n    return f'Hello {name}'\n\nfor i in range(10):\n    greet(i)\n```\n\n"
+
+
+def benchmark(function: Callable[[], Iterator[Case]]) -> Callable[[], Iterator[Case]]:
+    BENCHMARKS.append(function)
+    return function
+
+
+def document(paragraphs: int = 10, code_blocks: int = 0) -> str:
+    return "# Newsletter {{ name }}\n\n" + PARAGRAPH * paragraphs + CODE_BLOCK * code_blocks
+
+
+def theme(copies: int = 1) -> str:
+    """
+    Writes a theme made of `copies` copies of the default stylesheet, with distinct selectors, to a temporary file
+    """
+    from maildown import renderer
+
+    with open(renderer.DEFAULT_THEME) as f:
+        css = f.read()
+    path = os.path.join(tempfile.mkdtemp(), f"theme-{copies}.css")
+    with open(path, "w") as f:
+        f.write(css)
+        for i in range(1, copies):
+            f.write(css.replace("{", f", .copy-{i} {{"))
+    return path
+
+
+def clear_caches() -> None:
+    from maildown import inliner, renderer, templates
+
+    renderer._compile.cache_clear()
+    renderer.render_markdown.cache_clear()
+    renderer.clear_highlight_cache()
+    templates.clear_caches()
+    inliner.compile_stylesheet.cache_clear()
+
+
+@benchmark
+def generate_content() -> Iterator[Case]:
+    from maildown import renderer
+
+    context = dict(name="Chris")
+
+    def cold(content: str, theme_path: Optional[str] = None) -> Callable[[], object]:
+        def run():
+            clear_caches()
+            return renderer.generate_content(content, theme=theme_path, context=context)
+
+        return run
+
+    for paragraphs in (10, 100, 1000):
+        yield f"generate_content.cold.paragraphs={paragraphs}", cold(document(paragraphs)), 1
+    for code_blocks in (10, 50):
+        yield f"generate_content.cold.code_blocks={code_blocks}", cold(document(10, code_blocks)), 1
+    for copies in (10, 50):
+        yield f"generate_content.cold.theme_copies={copies}", cold(document(100), theme(copies)), 1
+
+    content = document(100, 10)
+    renderer.generate_content(content)
+    yield "generate_content.warm.paragraphs=100", lambda: renderer.generate_content(content, context=context), 1
+
+
+@benchmark
+def block_code() -> Iterator[Case]:
+    from maildown import renderer
+
+    for lines in (10, 100):
+        code = "\n".join(f"value_{i} = compute({i}, 'text')  # comment" for i in range(lines))
+
+        def cold(code=code):
+            renderer.clear_highlight_cache()
+            return renderer.HighlightRenderer.block_code(code, "python")
+
+        yield f"block_code.cold.lines={lines}", cold, 1
+
+        def warm(code=code):
+            return renderer.HighlightRenderer.block_code(code, "python")
+
+        yield f"block_code.warm.lines={lines}", warm, 1
+
+
+@benchmark
+def premailer_transform() -> Iterator[Case]:
+    import jinja2
+    import mistune
+    import premailer
+    from maildown import inliner, renderer
+
+    with open(renderer.TEMPLATE) as f:
+        template = jinja2.Template(f.read())
+    body = mistune.Markdown(renderer=renderer.HighlightRenderer())(document(100, 10))
+
+    for copies in (1, 10):
+        with open(theme(copies)) as f:
+            html = template.render(content=body, stylesheet=f.read())
+        yield f"premailer.transform.theme_copies={copies}", lambda html=html: premailer.transform(html), 1
+        yield f"inliner.transform.theme_copies={copies}", lambda html=html: inliner.transform(html), 1
+
+
+@benchmark
+def config_lookup() -> Iterator[Case]:
+    from maildown import utilities
+    from maildown.backends import AwsBackend
+
+    config = AwsBackend().config
+
+    def lookups():
+        for _ in range(1000):
+            config["access_key"]
+
+    yield "config.lookup", lookups, 1000
+    yield "config.get_config", utilities.get_config, 1
+
+
+@benchmark
+def send() -> Iterator[Case]:
+    from maildown.backends import AwsBackend
+    from benchmarks.stub import StubSes
+
+    content = document(10)
+    recipients = [dict(email=f"{i}@example.com", name=str(i)) for i in range(200)]
+    with StubSes() as ses:
+        backend = AwsBackend(endpoint_url=ses.url)
+        backend.send("me@example.com", "Benchmark", ["you@example.com"], content=content)
+
+        yield "send.send", lambda: backend.send("me@example.com", "Benchmark", ["you@example.com"], content=content), 1
+        for workers in (1, 10):
+            yield f"send.send_many.workers={workers}", lambda workers=workers: backend.send_many(
+                "me@example.com", "Benchmark", recipients, content=content, workers=workers
+            ), len(recipients)
+
+
+def measure(function: Callable[[], object], ops: int, repeat: int, min_time: float) -> Dict[str, float]:
+    """
+    Times `function` at least `repeat` times, and for at least `min_time` seconds in total
+    """
+    function()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeat or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    return dict(
+        runs=len(timings),
+        ops=ops,
+        min=min(timings),
+        median=median,
+        mean=statistics.mean(timings),
+        stdev=statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        ops_per_second=ops / median if median else 0.0,
+    )
+
+
+@contextlib.contextmanager
+def isolated_home() -> Iterator[str]:
+    """
+    Points HOME at a temporary directory holding a config with dummy credentials
+    """
+    from maildown import utilities
+
+    original = os.environ.get("HOME")
+    with tempfile.TemporaryDirectory() as home:
+        os.environ["HOME"] = home
+        utilities.clear_config_cache()
+        utilities.write_config(aws=dict(access_key="benchmark", secret_key="benchmark"))
+        try:
+            yield home
+        finally:
+            if original is None:
+                del os.environ["HOME"]
+            else:
+                os.environ["HOME"] = original
+            utilities.clear_config_cache()
+
+
+def metadata() -> Dict[str, str]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return dict(
+        commit=commit,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    )
+
+
+def run(pattern: str = "", repeat: int = 5, min_time: float = 0.5, out=None) -> Dict[str, Dict[str, float]]:
+    """
+    Runs every benchmark case whose name contains `pattern`, and returns the results keyed by case name
+    """
+    out = out or sys.stdout
+    results = {}
+    with isolated_home():
+        for function in BENCHMARKS:
+            for name, case, ops in function():
+                if pattern not in name:
+                    continue
+                results[name] = measure(case, ops, repeat, min_time)
+                median, ops_per_second = results[name]["median"], results[name]["ops_per_second"]
+                out.write(f"{name:<50} {median * 1000:>10.3f} ms {ops_per_second:>12.1f}/s\n")
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], previous: Dict[str, Dict[str, float]], out=None) -> None:
+    """
+    Writes the change in median time of each case against an earlier run
+    """
+    out = out or sys.stdout
+    for name, result in results.items():
+        if name in previous:
+            change = result["median"] / previous[name]["median"] - 1
+            out.write(f"{name:<50} {change:>+8.1%}\n")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument("-k", "--filter", default="", help="Only run cases whose name contains this")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("-c", "--compare", help="Compare against the results in this JSON file")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="The minimum number of timed runs per case")
+    parser.add_argument("--min-time", type=float, default=0.5, help="The minimum total seconds per case")
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.repeat, args.min_time)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(metadata=metadata(), results=results), f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+        sys.stdout.write(f"\nChange in median time against {args.compare}:\n")
+        compare(results, previous)
@@ -0,0 +1,63 @@
+import socketserver
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+SEND_EMAIL_RESPONSE = """<SendEmailResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <SendEmailResult><MessageId>{message_id}</MessageId></SendEmailResult>
+  <ResponseMetadata><RequestId>request</RequestId></ResponseMetadata>
+</SendEmailResponse>"""
+
+SEND_QUOTA_RESPONSE = """<GetSendQuotaResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <GetSendQuotaResult><Max24HourSend>-1</Max24HourSend><MaxSendRate>100000</MaxSendRate>
+  <SentLast24Hours>0</SentLast24Hours></GetSendQuotaResult>
+  <ResponseMetadata><RequestId>request</RequestId></ResponseMetadata>
+</GetSendQuotaResponse>"""
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        params = dict(urllib.parse.parse_qsl(body))
+        if params.get("Action") == "GetSendQuota":
+            response = SEND_QUOTA_RESPONSE
+        else:
+            response = SEND_EMAIL_RESPONSE.format(message_id=self.server.count)
+        self.server.count += 1
+
+        encoded = response.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubSes(object):
+    """
+    A local HTTP server which answers SES `SendEmail` and `GetSendQuota` requests, so sends can be measured without
+    touching Amazon. Use as a context manager; `url` is the endpoint to point a backend at
+    """
+
+    def __enter__(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.count = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,5 +1,4 @@
-from maildown.application import application
-
-
 def run():
+    from maildown.application import application
+
     application.run()
@@ -6,3 +6,10 @@ application = Application()
 application.add(commands.InitCommand())
 application.add(commands.VerifyCommand())
 application.add(commands.SendCommand())
+application.add(commands.ResumeCommand())
+application.add(commands.RenderCommand())
+application.add(commands.CompileCommand())
+application.add(commands.ServeCommand())
+application.add(commands.PreviewCommand())
+application.add(commands.SuppressCommand())
+application.add(commands.ReportCommand())
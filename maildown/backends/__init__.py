@@ -1 +1,49 @@
-from maildown.backends.aws import AwsBackend  # noqa: F401
+"""
+The email backends. Names are imported from their submodules the first time they are used, so that importing one
+backend, e.g. `maildown.backends.smtp`, doesn't also import boto3 for the SES backends
+"""
+from typing import Any
+import importlib
+import sys
+import types
+
+_exports = {
+    "AwsBackend": "aws",
+    "BulkSendError": "aws",
+    "AdaptiveRateLimiter": "ratelimit",
+    "QuotaExceeded": "ratelimit",
+    "TokenBucket": "ratelimit",
+    "AsyncBaseBackend": "aio",
+    "AsyncAwsBackend": "aio",
+    "ConnectionPool": "smtp",
+    "SmtpBackend": "smtp",
+    "IdentityCache": "identities",
+    "Suppressed": "base",
+    "Shard": "sharded",
+    "ShardedAwsBackend": "sharded",
+    "DryRunBackend": "dryrun",
+}
+
+__all__ = list(_exports)
+
+
+class _LazyModule(types.ModuleType):
+    # Module level __getattr__ only exists from Python 3.7, so the package's class is swapped for this one instead
+
+    def __getattr__(self, name: str) -> Any:
+        if name in _exports:
+            value = getattr(importlib.import_module(f"{__name__}.{_exports[name]}"), name)
+            setattr(self, name, value)
+            return value
+        try:
+            return importlib.import_module(f"{__name__}.{name}")
+        except ImportError as e:
+            if e.name != f"{__name__}.{name}":
+                raise
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_exports))
+
+
+sys.modules[__name__].__class__ = _LazyModule
@@ -0,0 +1,255 @@
+from typing import Optional, Any, AsyncIterator, Iterable, List
+import asyncio
+import time
+from botocore.exceptions import ClientError
+from maildown import instrumentation
+from maildown.backends.base import BaseBackend, SendResult
+from maildown.backends.aws import AwsBackend, DEFAULT_SEND_RATE, email_request, is_throttle
+from maildown.backends.ratelimit import AdaptiveRateLimiter
+
+
+DEFAULT_CONCURRENCY = 100
+
+
+class AsyncBaseBackend(BaseBackend):
+    """
+    The asyncio version of `BaseBackend`. Sending is done with coroutines, so that a single thread can keep many
+    requests in flight at once
+    """
+
+    async def send_message(  # type: ignore
+        self, to: list, sender: str, html: str, content: str, subject: str
+    ) -> Any:
+        raise NotImplementedError()
+
+    async def close(self) -> None:
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def send(  # type: ignore
+        self,
+        sender: str,
+        subject: str,
+        to: list,
+        content: Optional[str] = None,
+        file_path: Optional[str] = None,
+        context: Optional[dict] = None,
+        theme=None,
+    ) -> Any:
+        from maildown import templates
+
+        if file_path:
+            content = templates.read_file(file_path)
+
+        if not content:
+            raise AttributeError(
+                "You must provide either the content or filepath attribute"
+            )
+
+        suppressions = self.suppressions
+        if suppressions is not None:
+            to = [email for email in to if email not in suppressions]
+            if not to:
+                return None
+
+        html = templates.compile_content(content, theme=theme).render(context)
+        with instrumentation.span("send.message", backend=self.name):
+            return await self.send_message(to, sender, html, content, subject)
+
+    async def send_many(  # type: ignore
+        self,
+        sender: str,
+        subject: str,
+        recipients: Iterable[dict],
+        content: Optional[str] = None,
+        file_path: Optional[str] = None,
+        context: Optional[dict] = None,
+        theme=None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ) -> List[SendResult]:
+        """
+        The asyncio version of `BaseBackend.send_many`. At most `concurrency` messages are sent at once
+        """
+        return [
+            result
+            async for result in self.iter_send_many(
+                sender,
+                subject,
+                recipients,
+                content=content,
+                file_path=file_path,
+                context=context,
+                theme=theme,
+                concurrency=concurrency,
+            )
+        ]
+
+    async def iter_send_many(  # type: ignore
+        self,
+        sender: str,
+        subject: str,
+        recipients: Iterable[dict],
+        content: Optional[str] = None,
+        file_path: Optional[str] = None,
+        context: Optional[dict] = None,
+        theme=None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ) -> AsyncIterator[SendResult]:
+        """
+        The asyncio version of `BaseBackend.iter_send_many`. Sends are limited to `concurrency` at once by a semaphore,
+        and recipients are only read as fast as they are sent, so memory use stays flat
+        """
+        from maildown import templates
+
+        if file_path:
+            content = templates.read_file(file_path)
+
+        if not content:
+            raise AttributeError(
+                "You must provide either the content or filepath attribute"
+            )
+
+        compiled = templates.compile_content(content, theme=theme)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send_one(recipient: dict) -> SendResult:
+            email = recipient["email"]
+            start = None
+            async with semaphore:
+                try:
+                    html = compiled.render(dict(context or {}, **recipient))
+                    start = time.perf_counter()
+                    with instrumentation.span("send.message", backend=self.name):
+                        response = await self.send_message([email], sender, html, str(content), subject)
+                    return SendResult(email, response, latency=time.perf_counter() - start)
+                except Exception as e:
+                    return SendResult(email, error=e, latency=time.perf_counter() - start if start else None)
+
+        pending: set = set()
+        skipped: List[SendResult] = []
+        try:
+            for recipient in self.filter_suppressed(recipients, skipped.append):
+                for result in skipped:
+                    yield result
+                skipped.clear()
+                if len(pending) >= concurrency * 2:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.ensure_future(send_one(recipient)))
+
+            for result in skipped:
+                yield result
+            for task in asyncio.as_completed(pending):
+                yield await task
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class AsyncAwsBackend(AsyncBaseBackend):
+    """
+    Sends through SES with an aiobotocore client. Credentials, client settings and the rate limiter are taken from an
+    `AwsBackend`, built with the given keyword arguments. Requires the `aiobotocore` package
+    (`pip install maildown[async]`)
+    """
+
+    name = "aws"
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.backend = AwsBackend(**kwargs)
+        self._client = None
+        self._client_context = None
+        self._client_lock: Optional[asyncio.Lock] = None
+
+    def login(self, *args, **kwargs):
+        return self.backend.login(*args, **kwargs)
+
+    def verify_address(self, email: str) -> bool:
+        return self.backend.verify_address(email)
+
+    async def get_client(self):
+        """
+        Returns the aiobotocore SES client, which is created the first time it is needed and kept until `close`
+        """
+        if self._client_lock is None:
+            self._client_lock = asyncio.Lock()
+        async with self._client_lock:
+            if self._client is None:
+                try:
+                    from aiobotocore.session import get_session
+                except ImportError:
+                    raise ImportError(
+                        "The async backend requires aiobotocore. Install it with `pip install maildown[async]`"
+                    )
+
+                self._client_context = get_session().create_client(
+                    "ses", **self.backend.client_kwargs()
+                )
+                self._client = await self._client_context.__aenter__()  # type: ignore
+        return self._client
+
+    async def close(self) -> None:
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client = self._client_context = None
+
+    async def get_rate_limiter(self) -> Optional[AdaptiveRateLimiter]:
+        """
+        The asyncio version of `AwsBackend.rate_limiter`. The account's quota is read with the aiobotocore client, so
+        the event loop isn't blocked, and the limiter is shared with the `AwsBackend`
+        """
+        backend = self.backend
+        if backend.rate_limit is None:
+            backend.rate_limit = backend.config.get("rate_limit", True)  # type: ignore
+        if not backend.rate_limit:
+            return None
+
+        if backend._rate_limiter is None:
+            client = await self.get_client()
+            try:
+                quota = await client.get_send_quota()
+            except ClientError:
+                quota = dict(MaxSendRate=DEFAULT_SEND_RATE)
+            if backend._rate_limiter is None:
+                backend._rate_limiter = AdaptiveRateLimiter.from_quota(quota)
+        return backend._rate_limiter
+
+    async def call(self, operation: str, messages: int = 1, **kwargs):
+        """
+        The asyncio version of `AwsBackend.call`
+        """
+        limiter = await self.get_rate_limiter()
+        client = await self.get_client()
+        region = client.meta.region_name
+        attempt = 0
+        while True:
+            if limiter:
+                with instrumentation.span("aws.wait", region=region):
+                    await limiter.acquire_async(messages)
+            try:
+                with instrumentation.span(f"aws.{operation}", region=region):
+                    response = await getattr(client, operation)(**kwargs)
+            except ClientError as e:
+                if not is_throttle(e) or not limiter or attempt >= self.backend.throttle_retries:
+                    raise
+                instrumentation.event("aws.throttle", region=region)
+                await limiter.throttled_async(attempt, messages)
+                attempt += 1
+            else:
+                if limiter:
+                    limiter.succeeded()
+                return response
+
+    async def send_message(  # type: ignore
+        self, to: list, sender: str, html: str, content: str, subject: str
+    ):
+        return await self.call("send_email", **email_request(to, sender, html, content, subject))
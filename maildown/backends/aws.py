@@ -1,14 +1,122 @@
-from typing import Optional
+from typing import Optional, Dict, Any, Iterable, Iterator, List, Set
 import os
+import json
+import hashlib
+import threading
+import time
 import configparser
-from maildown.backends.base import BaseBackend
+from maildown import instrumentation, recipients as recipients_module
+from maildown.backends.base import BaseBackend, SendResult, DEFAULT_WORKERS
+from maildown.backends.identities import IdentityCache, IDENTITY_TTL
+from maildown.backends.ratelimit import AdaptiveRateLimiter, QuotaExceeded
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 
+DEFAULT_SEND_RATE = 1.0
+MAX_THROTTLE_RETRIES = 5
+BULK_CHUNK_SIZE = 50
+MAX_BULK_RETRIES = 3
+IDENTITY_PAGE_SIZE = 1000
+VERIFICATION_BATCH_SIZE = 100
+RETRYABLE_BULK_STATUSES = ("TransientFailure", "Failed", "AccountThrottled")
+
+
+class BulkSendError(Exception):
+    """
+    Raised for (and returned with) a destination which failed in a `SendBulkTemplatedEmail` call
+    """
+
+    def __init__(self, status: dict):
+        self.status = status
+        super().__init__(f'{status.get("Status")}: {status.get("Error", "")}'.rstrip(": "))
+
+
+def is_throttle(error: ClientError) -> bool:
+    """
+    Returns True if an SES error is a rate throttle, which can be retried. Throttling because the daily quota has
+    been used up can't be retried, so raises `QuotaExceeded` instead
+    """
+    details = error.response.get("Error", {})
+    if details.get("Code") != "Throttling":
+        return False
+    if "daily" in str(details.get("Message", "")).lower():
+        raise QuotaExceeded(details.get("Message")) from error
+    return True
+
+
+def email_request(to: list, sender: str, html: str, content: str, subject: str) -> dict:
+    """
+    Returns the arguments for an SES `SendEmail` call
+    """
+    return dict(
+        Source=sender,
+        Destination=dict(ToAddresses=to),
+        Message=dict(
+            Body=dict(
+                Html=dict(Charset="utf-8", Data=html),
+                Text=dict(Charset="utf-8", Data=content),
+            ),
+            Subject=dict(Charset="utf-8", Data=subject),
+        ),
+    )
+
+
 class AwsBackend(BaseBackend):
     name = "aws"
 
+    def __init__(
+        self,
+        max_pool_connections: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        retry_mode: Optional[str] = None,
+        share_client: Optional[bool] = None,
+        rate_limit: Optional[bool] = None,
+        endpoint_url: Optional[str] = None,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        region: Optional[str] = None,
+        throttle_retries: Optional[int] = None,
+    ):
+        """
+        The SES client is created lazily, the first time it is needed, and then reused for the lifetime of the
+        backend. Each of these parameters falls back to the value of the same name in the `aws` section of the
+        maildown config file
+
+        ### Parameters:
+
+        - `max_pool_connections`: The size of the client's HTTP connection pool. Defaults to the number of workers
+        used by `send_many`
+        - `max_attempts`: The maximum number of attempts botocore makes for each request. Defaults to 3
+        - `retry_mode`: The botocore retry mode, e.g. `standard` or `adaptive`. Defaults to botocore's own default
+        - `share_client`: When true (the default), one client is shared by every thread. botocore clients are thread
+        safe, so this is normally what you want. When false, each thread gets its own client
+        - `rate_limit`: When true (the default), sends are paced to the account's SES quota and throttled requests
+        are retried with back off. See `rate_limiter`
+        - `endpoint_url`: Sends requests to this URL rather than to Amazon, e.g. for a local SES stand in
+        - `access_key`, `secret_key` and `region`: The account and region to send through, e.g. for one shard of a
+        `ShardedAwsBackend`. Default to the credentials stored by `login`
+        - `throttle_retries`: How many times a throttled request is retried. Defaults to `MAX_THROTTLE_RETRIES`
+        """
+        super().__init__()
+        self.max_pool_connections = max_pool_connections
+        self.max_attempts = max_attempts
+        self.retry_mode = retry_mode
+        self.share_client = share_client
+        self.rate_limit = rate_limit
+        self.endpoint_url = endpoint_url
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.throttle_retries = MAX_THROTTLE_RETRIES if throttle_retries is None else throttle_retries
+        self._client = None
+        self._local = threading.local()
+        self._client_lock = threading.Lock()
+        self._rate_limiter: Optional[AdaptiveRateLimiter] = None
+        self._rate_limiter_lock = threading.Lock()
+        self._identities: Optional[IdentityCache] = None
+
     def login(  # type: ignore
         self,
         access_key: Optional[str] = None,
@@ -46,52 +154,312 @@ class AwsBackend(BaseBackend):
             if not self.verify_auth(access_key, secret_key, region_name):
                 raise AttributeError("The supplied credentials are not valid")
 
-            self.config["access_key"] = access_key  # type: ignore
-            self.config["secret_key"] = secret_key  # type: ignore
-            self.config["region_name"] = region_name  # type: ignore
+            self.config.update(  # type: ignore
+                access_key=access_key, secret_key=secret_key, region_name=region_name
+            )
 
     def send_message(
         self, to: list, sender: str, html: str, content: str, subject: str
     ):
-        return self.client.send_email(
-            Source=sender,
-            Destination=dict(ToAddresses=to),
-            Message=dict(
-                Body=dict(
-                    Html=dict(Charset="utf-8", Data=html),
-                    Text=dict(Charset="utf-8", Data=content),
-                ),
-                Subject=dict(Charset="utf-8", Data=subject),
-            ),
-        )
+        return self.call("send_email", **email_request(to, sender, html, content, subject))
+
+    def send_raw_message(self, to: list, sender: str, raw: bytes):
+        return self.call("send_raw_email", Source=sender, Destinations=to, RawMessage=dict(Data=raw))
+
+    def call(self, operation: str, messages: int = 1, **kwargs):
+        """
+        Calls an SES sending operation through the rate limiter. Throttled requests are retried, with back off, up to
+        `throttle_retries` times. Throttling because the daily quota has been used up raises `QuotaExceeded`.
+        Each attempt is reported as an `aws.<operation>` span, time spent waiting on the rate limiter as `aws.wait`,
+        and each throttle as an `aws.throttle` event
+
+        ### Parameters:
+
+        - `operation`: The name of the boto3 client method to call, e.g. `send_email`
+        - `messages`: The number of messages the call sends, which is how many tokens it takes from the rate limiter
+        - `kwargs`: The arguments to pass to that method
+        """
+        limiter = self.rate_limiter
+        client = self.client
+        region = client.meta.region_name
+        attempt = 0
+        while True:
+            if limiter:
+                with instrumentation.span("aws.wait", region=region):
+                    limiter.acquire(messages)
+            try:
+                with instrumentation.span(f"aws.{operation}", region=region):
+                    response = getattr(client, operation)(**kwargs)
+            except ClientError as e:
+                if not is_throttle(e) or not limiter or attempt >= self.throttle_retries:
+                    raise
+                instrumentation.event("aws.throttle", region=region)
+                limiter.throttled(attempt, messages)
+                attempt += 1
+            else:
+                if limiter:
+                    limiter.succeeded()
+                return response
+
+    def iter_send_bulk(
+        self,
+        sender: str,
+        subject: str,
+        recipients: Iterable[dict],
+        content: Optional[str] = None,
+        file_path: Optional[str] = None,
+        context: Optional[dict] = None,
+        theme=None,
+    ) -> Iterator[SendResult]:
+        """
+        Sends a personalised copy of an email to each recipient with SES's `SendBulkTemplatedEmail` API, which takes
+        up to 50 destinations per call. The rendered, css-inlined HTML is uploaded once as an SES template, and each
+        recipient's own variables are sent as that destination's replacement data. Destinations which fail with a
+        transient status are retried on their own, up to `MAX_BULK_RETRIES` times. Results are yielded per recipient
+
+        Because SES fills in the per-recipient values, recipient variables can only be used for simple substitutions
+        such as `{{ name }}` - jinja loops, filters and conditions can only use the shared `context`
+
+        ### Parameters:
+
+        - `sender`: the email address to send the message from
+        - `subject`: The subject line of the email
+        - `recipients`: An iterable of dicts, each of which must contain an `email` key
+        - `content`: The content of the email to send. Either this parameter, or `file_path`, must be supplied
+        - `file_path`: A local file path to a file to be send as the email body
+        - `context`: Context shared by every message
+        - `theme`: A local file path to a css style sheet. If not supplied, the default style is used
+        """
+        from maildown import templates
+
+        if file_path:
+            content = templates.read_file(file_path)
+
+        if not content:
+            raise AttributeError(
+                "You must provide either the content or filepath attribute"
+            )
+
+        html = templates.compile_content(content, theme=theme).render_placeholders(context)
+        name = "maildown-" + hashlib.sha1(
+            "\0".join([subject, html, content]).encode("utf-8")
+        ).hexdigest()
+        try:
+            self.client.create_template(
+                Template=dict(
+                    TemplateName=name, SubjectPart=subject, HtmlPart=html, TextPart=content
+                )
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "AlreadyExists":
+                raise
+
+        skipped: List[SendResult] = []
+        try:
+            for chunk in recipients_module.chunked(self.filter_suppressed(recipients, skipped.append), BULK_CHUNK_SIZE):
+                yield from skipped
+                skipped.clear()
+                yield from self._send_bulk_chunk(sender, name, chunk, context or {})
+            yield from skipped
+        finally:
+            self.client.delete_template(TemplateName=name)
+
+    def _send_bulk_chunk(
+        self, sender: str, template: str, chunk: List[dict], context: dict
+    ) -> Iterator[SendResult]:
+        for attempt in range(MAX_BULK_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                response = self.call(
+                    "send_bulk_templated_email",
+                    messages=len(chunk),
+                    Source=sender,
+                    Template=template,
+                    DefaultTemplateData=json.dumps(context, default=str),
+                    Destinations=[
+                        dict(
+                            Destination=dict(ToAddresses=[recipient["email"]]),
+                            ReplacementTemplateData=json.dumps(recipient, default=str),
+                        )
+                        for recipient in chunk
+                    ],
+                )
+            except ClientError as e:
+                latency = time.perf_counter() - start
+                yield from (SendResult(recipient["email"], error=e, latency=latency) for recipient in chunk)
+                return
+
+            latency = time.perf_counter() - start
+            retry = []
+            statuses = response.get("Status", [])
+            for recipient, status in zip(chunk, statuses):
+                if status.get("Status") == "Success":
+                    yield SendResult(recipient["email"], status, latency=latency)
+                elif status.get("Status") in RETRYABLE_BULK_STATUSES and attempt < MAX_BULK_RETRIES:
+                    retry.append(recipient)
+                else:
+                    yield SendResult(recipient["email"], status, BulkSendError(status), latency)
+            # SES should return a status per destination, but a destination without one mustn't go unreported
+            for recipient in chunk[len(statuses):]:
+                status = dict(Status="MissingStatus", Error="SES returned no status for this destination")
+                yield SendResult(recipient["email"], status, BulkSendError(status), latency)
+
+            if not retry:
+                return
+            instrumentation.event("aws.bulk_retry", region=self.client.meta.region_name)
+            if self.rate_limiter:
+                self.rate_limiter.throttled(attempt, len(retry))
+            chunk = retry
+
+    @property
+    def rate_limiter(self) -> Optional[AdaptiveRateLimiter]:
+        """
+        Returns the rate limiter shared by every thread sending through this backend. It is built the first time it is
+        needed from the account's `GetSendQuota` limits. If the quota can't be read, sends are paced at
+        `DEFAULT_SEND_RATE` with no daily limit. Returns None if rate limiting is disabled
+        """
+        if self.rate_limit is None:
+            self.rate_limit = self.config.get("rate_limit", True)  # type: ignore
+
+        if not self.rate_limit:
+            return None
+
+        if self._rate_limiter is None:
+            with self._rate_limiter_lock:
+                if self._rate_limiter is None:
+                    try:
+                        quota = self.client.get_send_quota()
+                    except ClientError:
+                        quota = dict(MaxSendRate=DEFAULT_SEND_RATE)
+                    self._rate_limiter = AdaptiveRateLimiter.from_quota(quota)
+        return self._rate_limiter
 
     @property
     def client(self) -> boto3.client:
         """
-        Returns an authenticated boto3.ses client
+        Returns an authenticated boto3.ses client. The client is only built once per backend (or once per thread, if
+        `share_client` is false)
         """
-        return boto3.client(
-            "ses",
-            aws_access_key_id=self.config.get("access_key"),  # type: ignore
-            aws_secret_access_key=self.config.get("secret_key"),  # type: ignore
-            region_name=self.config.get("region", "us-east-1"),  # type: ignore
+        if self.share_client is None:
+            self.share_client = self.config.get("share_client", True)  # type: ignore
+
+        if not self.share_client:
+            if getattr(self._local, "client", None) is None:
+                with self._client_lock:
+                    self._local.client = self.create_client()
+            return self._local.client
+
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.create_client()
+        return self._client
+
+    def create_client(self) -> boto3.client:
+        """
+        Builds a new boto3.ses client from the stored credentials. `boto3.client` uses the default session, which is
+        not thread safe, so this should only be called while holding `_client_lock`
+        """
+        return boto3.client("ses", **self.client_kwargs())
+
+    def client_kwargs(self) -> Dict[str, Any]:
+        """
+        Returns the arguments used to build an SES client: the stored credentials and region, and a botocore `Config`
+        with the connection pool and retry settings
+        """
+        max_pool_connections = self.max_pool_connections or self.config.get(
+            "max_pool_connections", DEFAULT_WORKERS  # type: ignore
+        )
+        max_attempts = self.max_attempts or self.config.get("max_attempts", 3)  # type: ignore
+        retries: Dict[str, Any] = dict(max_attempts=int(max_attempts))
+        retry_mode = self.retry_mode or self.config.get("retry_mode")  # type: ignore
+        if retry_mode:
+            retries["mode"] = retry_mode
+
+        kwargs = dict(
+            aws_access_key_id=self.access_key or self.config.get("access_key"),  # type: ignore
+            aws_secret_access_key=self.secret_key or self.config.get("secret_key"),  # type: ignore
+            region_name=self.region_name,
+            config=Config(
+                max_pool_connections=int(max_pool_connections), retries=retries
+            ),
         )
+        endpoint_url = self.endpoint_url or self.config.get("endpoint_url")  # type: ignore
+        if endpoint_url:
+            kwargs["endpoint_url"] = endpoint_url
+        return kwargs
+
+    @property
+    def region_name(self) -> str:
+        return self.region or self.config.get("region", "us-east-1")  # type: ignore
+
+    @property
+    def identities(self) -> IdentityCache:
+        """
+        Returns the cache of the account's verified identities. It is kept in `~/.maildown`, in a file per access key
+        and region, and trusted for `identity_ttl` seconds (from the config file, an hour by default)
+        """
+        if self._identities is None:
+            access_key = self.access_key or self.config.get("access_key")  # type: ignore
+            account = hashlib.sha1(f"{access_key}:{self.region_name}".encode("utf-8")).hexdigest()[:12]
+            self._identities = IdentityCache(
+                self.fetch_identities,
+                os.path.join(os.path.expanduser("~"), ".maildown", f"identities-{account}.json"),
+                float(self.config.get("identity_ttl", IDENTITY_TTL)),  # type: ignore
+            )
+        return self._identities
+
+    def fetch_identities(self) -> Set[str]:
+        """
+        Returns every verified email address and domain of the account, lower cased. Identities are listed a page at a
+        time with `ListIdentities`, and their status looked up in batches with `GetIdentityVerificationAttributes`
+        """
+        client = self.client
+        verified: Set[str] = set()
+        kwargs: Dict[str, Any] = dict(MaxItems=IDENTITY_PAGE_SIZE)
+        while True:
+            page = client.list_identities(**kwargs)
+            identities = page.get("Identities", [])
+            for batch in recipients_module.chunked(identities, VERIFICATION_BATCH_SIZE):
+                attributes = client.get_identity_verification_attributes(Identities=batch)
+                verified.update(
+                    identity.lower()
+                    for identity, status in attributes.get("VerificationAttributes", {}).items()
+                    if status.get("VerificationStatus") == "Success"
+                )
+            if not page.get("NextToken"):
+                return verified
+            kwargs["NextToken"] = page["NextToken"]
+
+    def is_verified(self, email: str) -> bool:
+        """
+        Returns True if an email address, or its domain, is verified for sending. This is a lookup in the cached set
+        of identities - see `identities`
+        """
+        return self.identities.is_verified(email)
+
+    def verify_addresses(self, emails: Iterable[str]) -> Dict[str, bool]:
+        """
+        Returns whether each of many email addresses is verified for sending, without sending any verification emails
+        """
+        return self.identities.check(emails)
 
     def verify_address(self, email: str) -> bool:
         """
         Asks Amazon to send an email to a given email address to verify the user's ownership of that address.
 
-        Email addresses must be verified by Amazon before you can send emails from them with SES
+        Email addresses must be verified by Amazon before you can send emails from them with SES. Addresses are first
+        checked against the cached identities, which are refreshed (at most once a minute) if the address isn't found
 
         ### Parameters:
 
         - `email`: The email address to be verified
         """
-        addresses = self.client.list_verified_email_addresses().get(
-            "VerifiedEmailAddresses"
-        )
+        if self.identities.is_verified(email):
+            return True
 
-        if email in addresses:
+        self.identities.refresh(force=False)
+        if self.identities.is_verified(email):
             return True
 
         self.client.verify_email_address(EmailAddress=email)
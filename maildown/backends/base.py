@@ -1,5 +1,25 @@
-from typing import Optional, Any
-from maildown import utilities, renderer
+from typing import Optional, Any, Callable, Iterable, Iterator, List, NamedTuple
+import contextlib
+import os
+import time
+from concurrent import futures
+from maildown import instrumentation, utilities
+
+
+DEFAULT_WORKERS = 10
+
+
+class SendResult(NamedTuple):
+    recipient: str
+    response: Any = None
+    error: Optional[Exception] = None
+    latency: Optional[float] = None
+
+
+class Suppressed(Exception):
+    """
+    The error of a `SendResult` for a recipient who wasn't sent to, because they are on the local suppression list
+    """
 
 
 class BaseConfig(object):
@@ -7,7 +27,7 @@ class BaseConfig(object):
         self.backend = backend
 
     def __getitem__(self, item):
-        config = utilities.get_config()
+        config = utilities.get_config(copy=False)
         backend_config = config.get(self.backend.name, {})
         return backend_config[item]
 
@@ -18,11 +38,16 @@ class BaseConfig(object):
             return default
 
     def __setitem__(self, key, value):
+        self.update(**{key: value})
+
+    def update(self, **items):
+        """
+        Sets several config values for this backend with a single write to the config file
+        """
         config = utilities.get_config()
         backend_config = config.get(self.backend.name, {})
-        backend_config[key] = value
-        config[self.backend.name] = backend_config
-        utilities.write_config(**config)
+        backend_config.update(items)
+        utilities.write_config(**{self.backend.name: backend_config})
 
 
 class BaseBackend(object):
@@ -35,12 +60,45 @@ class BaseBackend(object):
     def login(self, *args, **kwargs):
         raise NotImplementedError()
 
+    @property
+    def suppressions(self):
+        """
+        Returns the index of the local suppression list, or None if it is empty. See `suppression.SuppressionList`
+        """
+        from maildown import suppression
+
+        return suppression.default_index()
+
+    def filter_suppressed(
+        self, recipients: Iterable[dict], skip: Callable[[SendResult], Any]
+    ) -> Iterator[dict]:
+        """
+        Lazily drops recipients who are on the suppression list, before anything is rendered for them, and calls
+        `skip` with a `SendResult` for each one dropped
+        """
+        suppressions = self.suppressions
+        if suppressions is None:
+            yield from recipients
+            return
+        for recipient in recipients:
+            if recipient["email"] in suppressions:
+                skip(SendResult(recipient["email"], error=Suppressed("The address is on the suppression list")))
+            else:
+                yield recipient
+
     def verify_address(self, email: str) -> bool:
         raise NotImplementedError()
 
     def send_message(
         self, to: list, sender: str, html: str, content: str, subject: str
-    ) -> None:
+    ) -> Any:
+        raise NotImplementedError()
+
+    def send_raw_message(self, to: list, sender: str, raw: bytes) -> Any:
+        """
+        Sends a complete MIME message, as built by `mime.RawMessage`. Used for messages with attachments or inline
+        images
+        """
         raise NotImplementedError()
 
     def send(
@@ -52,21 +110,168 @@ class BaseBackend(object):
         file_path: Optional[str] = None,
         context: Optional[dict] = None,
         theme=None,
-    ) -> None:
-
+        attachments: Optional[List[str]] = None,
+    ) -> Any:
+        """
+        Sends one message to every address in `to`, and returns the backend's response, or None if every address is
+        on the suppression list
+        """
         if not context:
             context = {}
 
+        suppressions = self.suppressions
+        if suppressions is not None:
+            to = [email for email in to if email not in suppressions]
+            if not to:
+                return None
+
+        from maildown import templates
+
         if file_path:
-            with open(file_path) as f:
-                content = f.read()
+            content = templates.read_file(file_path)
 
         if content:
-            html = renderer.generate_content(content, context=context, theme=theme)
+            from maildown import mime
 
-            self.send_message(to, sender, html, content, subject)
+            html = templates.compile_content(content, theme=theme).render(context)
+            raw = mime.campaign(html, attachments, os.path.dirname(os.path.abspath(file_path)) if file_path else None)
+
+            with instrumentation.span("send.message", backend=self.name):
+                if raw:
+                    return self.send_raw_message(to, sender, raw.build(to, sender, subject, html, content))
+                return self.send_message(to, sender, html, content, subject)
 
         else:
             raise AttributeError(
                 "You must provide either the content or filepath attribute"
             )
+
+    def send_many(
+        self,
+        sender: str,
+        subject: str,
+        recipients: Iterable[dict],
+        content: Optional[str] = None,
+        file_path: Optional[str] = None,
+        context: Optional[dict] = None,
+        theme=None,
+        workers: int = DEFAULT_WORKERS,
+        executor: Optional[futures.Executor] = None,
+        attachments: Optional[List[str]] = None,
+    ) -> List[SendResult]:
+        """
+        Sends a personalised copy of an email to each of the given recipients. The content is compiled once, and each
+        message is then rendered with the shared `context` updated with that recipient's own variables. Messages are
+        sent individually from a pool of worker threads, so one failed address does not hold back the others
+
+        ### Parameters:
+
+        - `sender`: the email address to send the message from
+        - `subject`: The subject line of the email
+        - `recipients`: An iterable of dicts, each of which must contain an `email` key. Any other keys are passed to
+        that recipient's message as context variables
+        - `content`: The content of the email to send. Either this parameter, or `file_path`, must be supplied
+        - `file_path`: A local file path to a file to be send as the email body
+        - `context`: Context shared by every message
+        - `theme`: A local file path to a css style sheet. If not supplied, the default style is used
+        - `workers`: The number of messages to send concurrently
+        - `executor`: A thread pool to send from, which is left running afterwards. If not supplied, a pool of
+        `workers` threads is created for the call
+        - `attachments`: Paths to files to attach to every message. Messages with attachments, or with images from
+        local files, are sent as raw MIME messages, whose shared parts are only encoded once - see `mime.RawMessage`
+        """
+        return list(
+            self.iter_send_many(
+                sender,
+                subject,
+                recipients,
+                content=content,
+                file_path=file_path,
+                context=context,
+                theme=theme,
+                workers=workers,
+                executor=executor,
+                attachments=attachments,
+            )
+        )
+
+    def iter_send_many(
+        self,
+        sender: str,
+        subject: str,
+        recipients: Iterable[dict],
+        content: Optional[str] = None,
+        file_path: Optional[str] = None,
+        context: Optional[dict] = None,
+        theme=None,
+        workers: int = DEFAULT_WORKERS,
+        executor: Optional[futures.Executor] = None,
+        attachments: Optional[List[str]] = None,
+        sandbox: bool = False,
+        compiled=None,
+    ) -> Iterator[SendResult]:
+        """
+        The streaming version of `send_many`. Recipients are consumed lazily and results are yielded as each send
+        completes, in no particular order. At most `workers * 2` messages are in flight at once, so memory use stays
+        flat however many recipients there are. Recipients on the suppression list aren't sent to, and their results
+        have a `Suppressed` error. If `sandbox` is true the content is treated as untrusted: it is rendered in jinja's
+        sandbox, compiled artifacts are refused, and only images inside the directory of `file_path` are embedded. If
+        the caller has already compiled the message, it can pass the `CompiledTemplate` as `compiled`, which is sent as
+        it is rather than reading and compiling the content again
+        """
+        from maildown import mime, templates
+
+        if compiled is None:
+            if file_path:
+                content = templates.read_file(file_path, trusted=not sandbox)
+
+            if not content:
+                raise AttributeError(
+                    "You must provide either the content or filepath attribute"
+                )
+
+            compiled = templates.compile_content(content, theme=theme)
+            if sandbox:
+                compiled = compiled.sandboxed()
+        content = compiled.content
+        raw = mime.campaign(
+            compiled.source,
+            attachments,
+            os.path.dirname(os.path.abspath(file_path)) if file_path else None,
+            confine=sandbox,
+        )
+
+        def send_one(recipient: dict) -> SendResult:
+            email = recipient["email"]
+            start = None
+            try:
+                html = compiled.render(dict(context or {}, **recipient))
+                start = time.perf_counter()
+                with instrumentation.span("send.message", backend=self.name):
+                    if raw:
+                        response = self.send_raw_message(
+                            [email], sender, raw.build([email], sender, subject, html, content)
+                        )
+                    else:
+                        response = self.send_message([email], sender, html, content, subject)
+                return SendResult(email, response, latency=time.perf_counter() - start)
+            except Exception as e:
+                return SendResult(email, error=e, latency=time.perf_counter() - start if start else None)
+
+        skipped: List[SendResult] = []
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(futures.ThreadPoolExecutor(max_workers=workers))
+            pending: set = set()
+            for recipient in self.filter_suppressed(recipients, skipped.append):
+                if skipped:
+                    yield from skipped
+                    skipped.clear()
+                if len(pending) >= workers * 2:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED
+                    )
+                    yield from (f.result() for f in done)
+                pending.add(executor.submit(send_one, recipient))
+            yield from skipped
+            yield from (f.result() for f in futures.as_completed(pending))
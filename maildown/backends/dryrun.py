@@ -0,0 +1,91 @@
+from typing import Any, Iterable, Iterator, List, Optional
+import os
+from concurrent import futures
+from maildown import outbox
+from maildown.backends.base import BaseBackend, SendResult, DEFAULT_WORKERS
+
+
+class DryRunBackend(BaseBackend):
+    """
+    Builds every message exactly as it would be sent, and writes it to an `outbox.Writer` instead of sending it
+
+    ### Parameters:
+
+    - `writer`: Where to write the messages - see `outbox.open_writer`
+    - `processes`: The number of processes to render messages in with `iter_send_many`. By default they are rendered
+    in this process
+    """
+
+    name = "dry-run"
+
+    def __init__(self, writer: outbox.Writer, processes: Optional[int] = None):
+        super().__init__()
+        self.writer = writer
+        self.processes = processes
+
+    def login(self, *args, **kwargs):
+        pass
+
+    def verify_address(self, email: str) -> bool:
+        return True
+
+    def send_message(self, to: list, sender: str, html: str, content: str, subject: str) -> Any:
+        from maildown import mime
+
+        return self.send_raw_message(to, sender, mime.RawMessage().build(to, sender, subject, html, content))
+
+    def send_raw_message(self, to: list, sender: str, raw: bytes) -> Any:
+        return dict(MessageId=f"dry-run-{self.writer.write(', '.join(to), raw)}")
+
+    def iter_send_many(
+        self,
+        sender: str,
+        subject: str,
+        recipients: Iterable[dict],
+        content: Optional[str] = None,
+        file_path: Optional[str] = None,
+        context: Optional[dict] = None,
+        theme=None,
+        workers: int = DEFAULT_WORKERS,
+        executor: Optional[futures.Executor] = None,
+        attachments: Optional[List[str]] = None,
+        sandbox: bool = False,
+        compiled=None,
+    ) -> Iterator[SendResult]:
+        """
+        Builds each recipient's message with `outbox.build_messages`, in `processes` processes, and writes them in the
+        order of `recipients`. `workers` and `executor` are ignored, as nothing is sent. Only the content of
+        `compiled` is used, as each process compiles the message itself
+        """
+        if compiled is not None:
+            content = compiled.content
+        elif file_path:
+            from maildown import templates
+
+            content = templates.read_file(file_path, trusted=not sandbox)
+
+        if not content:
+            raise AttributeError(
+                "You must provide either the content or filepath attribute"
+            )
+
+        skipped: List[SendResult] = []
+        for email, message, error in outbox.build_messages(
+            sender,
+            subject,
+            self.filter_suppressed(recipients, skipped.append),
+            content,
+            context=context,
+            theme=theme,
+            attachments=attachments,
+            base_dir=os.path.dirname(os.path.abspath(file_path)) if file_path else None,
+            processes=self.processes,
+            sandbox=sandbox,
+        ):
+            yield from skipped
+            skipped.clear()
+            if message is None:
+                yield SendResult(email, error=error)
+            else:
+                yield SendResult(email, self.send_raw_message([email], sender, message))
+        yield from skipped
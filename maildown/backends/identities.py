@@ -0,0 +1,111 @@
+from typing import Callable, Dict, Iterable, Optional, Set
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+IDENTITY_TTL = 3600.0
+MIN_REFRESH_INTERVAL = 60.0
+
+
+def domain(email: str) -> str:
+    return email.rsplit("@", 1)[-1]
+
+
+class IdentityCache(object):
+    """
+    The verified identities (email addresses and domains) of an account, held in memory as a set and saved to a JSON
+    file so that they survive between runs. Checking an address is a set lookup. Once the cache is older than `ttl`,
+    lookups carry on using it while it is refreshed in a background thread. It is only fetched in the foreground when
+    there is nothing cached at all
+
+    ### Parameters:
+
+    - `fetch`: Called to fetch the current set of verified identities, lower cased
+    - `path`: The file the identities are saved to
+    - `ttl`: The number of seconds the identities are trusted for before being refreshed
+    - `clock`: Returns the current time, in seconds since the epoch
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], Set[str]],
+        path: str,
+        ttl: float = IDENTITY_TTL,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.fetched = 0.0
+        self._identities: Optional[Set[str]] = None
+        self._lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._refreshing: Optional[threading.Thread] = None
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._identities = set(data.get("identities", []))
+        self.fetched = float(data.get("fetched", 0))
+
+    def save(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".identities-")
+        with open(fd, "w") as f:
+            json.dump(dict(fetched=self.fetched, identities=sorted(self._identities or ())), f)
+        os.replace(tmp, self.path)
+
+    def refresh(self, force: bool = True) -> None:
+        """
+        Fetches the identities and saves them. Unless `force` is true, nothing is fetched if the identities were
+        fetched less than `MIN_REFRESH_INTERVAL` seconds ago
+        """
+        with self._lock:
+            if not force and self._identities is not None and self.clock() - self.fetched < MIN_REFRESH_INTERVAL:
+                return
+            identities = self.fetch()
+            self._identities = identities
+            self.fetched = self.clock()
+            self.save()
+
+    def refresh_in_background(self) -> None:
+        """
+        Starts refreshing the identities in a daemon thread, unless a refresh is already running
+        """
+        with self._thread_lock:
+            if self._refreshing is not None and self._refreshing.is_alive():
+                return
+            self._refreshing = threading.Thread(target=self.refresh, daemon=True)
+            self._refreshing.start()
+
+    @property
+    def identities(self) -> Set[str]:
+        if self._identities is None:
+            self.load()
+        if self._identities is None:
+            self.refresh()
+        elif self.clock() - self.fetched > self.ttl:
+            self.refresh_in_background()
+        return self._identities  # type: ignore
+
+    def is_verified(self, email: str) -> bool:
+        """
+        Returns True if the address, or its domain, is a verified identity
+        """
+        identities = self.identities
+        email = email.strip().lower()
+        return email in identities or domain(email) in identities
+
+    def check(self, emails: Iterable[str]) -> Dict[str, bool]:
+        """
+        Checks many addresses at once, and returns whether each one is verified
+        """
+        return {email: self.is_verified(email) for email in emails}
@@ -0,0 +1,182 @@
+from typing import Optional, Callable
+import asyncio
+import random
+import threading
+import time
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when the daily sending quota has been used up
+    """
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket. Tokens are added at `rate` per second, up to `capacity`, and each call to `acquire`
+    blocks until a token is available
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def _take(self, tokens: float) -> float:
+        """
+        Takes `tokens` tokens if they are available and returns 0, or otherwise returns how long to wait for them
+        """
+        needed = min(tokens, self.capacity)
+        with self._lock:
+            self._refill()
+            if self.tokens >= needed:
+                self.tokens -= tokens
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """
+        Blocks until `tokens` tokens are available. Requests for more than `capacity` tokens wait for a full bucket
+        and then leave it in debt, so that later callers wait for the difference
+        """
+        wait = self._take(tokens)
+        while wait:
+            self.sleep(wait)
+            wait = self._take(tokens)
+
+    async def acquire_async(self, tokens: float = 1.0) -> None:
+        """
+        The same as `acquire`, but waits with `asyncio.sleep` rather than blocking the event loop
+        """
+        wait = self._take(tokens)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take(tokens)
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Paces sends to stay within a maximum send rate and a daily quota. When the provider throttles a request, the rate
+    is cut and the caller backs off for a random (jittered), exponentially growing delay. Each successful send then
+    ramps the rate back up towards the maximum
+
+    ### Parameters:
+
+    - `max_rate`: The maximum number of messages per second
+    - `daily_quota`: The number of messages which may still be sent today. `None` means unlimited
+    - `min_rate`: The rate will never be cut below this value
+    - `decrease`: The factor the rate is multiplied by after each throttle
+    - `increase`: The fraction of `max_rate` added back to the rate after each success
+    - `base_delay`: The back off delay after the first throttle, in seconds. This doubles with each attempt
+    - `max_delay`: The longest back off delay, in seconds
+    """
+
+    def __init__(
+        self,
+        max_rate: float,
+        daily_quota: Optional[int] = None,
+        min_rate: float = 0.5,
+        decrease: float = 0.5,
+        increase: float = 0.05,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.daily_quota = daily_quota
+        self.min_rate = min(min_rate, max_rate)
+        self.decrease = decrease
+        self.increase = increase
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.sent = 0
+        self.bucket = TokenBucket(max_rate, clock=clock, sleep=sleep)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_quota(cls, quota: dict, **kwargs) -> "AdaptiveRateLimiter":
+        """
+        Builds a limiter from the response of the SES `GetSendQuota` API. A `Max24HourSend` of -1 means the daily
+        quota is unlimited
+        """
+        max_24_hour_send = int(quota.get("Max24HourSend", -1))
+        daily_quota = None
+        if max_24_hour_send >= 0:
+            daily_quota = max(max_24_hour_send - int(quota.get("SentLast24Hours", 0)), 0)
+        return cls(float(quota["MaxSendRate"]), daily_quota=daily_quota, **kwargs)
+
+    def _reserve(self, messages: int) -> None:
+        with self._lock:
+            if self.daily_quota is not None and self.sent + messages > self.daily_quota:
+                raise QuotaExceeded(f"The daily sending quota of {self.daily_quota} messages has been reached")
+            self.sent += messages
+
+    def acquire(self, messages: int = 1) -> None:
+        """
+        Blocks until the next `messages` messages may be sent. Raises `QuotaExceeded` if they would go over the daily
+        quota
+        """
+        self._reserve(messages)
+        self.bucket.acquire(messages)
+
+    async def acquire_async(self, messages: int = 1) -> None:
+        """
+        The same as `acquire`, but waits without blocking the event loop
+        """
+        self._reserve(messages)
+        await self.bucket.acquire_async(messages)
+
+    def _back_off(self, attempt: int, messages: int) -> float:
+        with self._lock:
+            self.sent -= messages
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.bucket.set_rate(self.rate)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def throttled(self, attempt: int = 0, messages: int = 1) -> float:
+        """
+        Records a throttled request, cuts the rate and sleeps for a jittered back off delay, which is returned
+        """
+        delay = self._back_off(attempt, messages)
+        self.sleep(delay)
+        return delay
+
+    async def throttled_async(self, attempt: int = 0, messages: int = 1) -> float:
+        """
+        The same as `throttled`, but waits without blocking the event loop
+        """
+        delay = self._back_off(attempt, messages)
+        await asyncio.sleep(delay)
+        return delay
+
+    def succeeded(self) -> None:
+        """
+        Records a successful request, and ramps the rate back up towards the maximum
+        """
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.increase)
+                self.bucket.set_rate(self.rate)
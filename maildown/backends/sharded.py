@@ -0,0 +1,254 @@
+"""
+Sends through several SES accounts and regions as though they were one, for campaigns which need more than any single
+account's send rate or daily quota. Each shard is an `AwsBackend` of its own, with its own client and rate limiter, and
+messages are shared between them in proportion to their send rates. A shard which is throttled, out of quota or
+failing is skipped for a while, and the messages it couldn't send are sent through another
+"""
+from typing import Any, Dict, List, Optional, Sequence
+import math
+import threading
+import time
+from botocore.exceptions import BotoCoreError, ClientError
+from maildown import instrumentation
+from maildown.backends.aws import AwsBackend, email_request
+from maildown.backends.base import BaseBackend
+from maildown.backends.ratelimit import QuotaExceeded
+
+
+DEFAULT_COOLDOWN = 30.0
+DEFAULT_THROTTLE_RETRIES = 1
+
+# SES errors which are the fault of the account or region rather than the message, so are worth sending elsewhere
+FAILOVER_ERRORS = (
+    "Throttling",
+    "ServiceUnavailable",
+    "InternalFailure",
+    "AccountSendingPausedException",
+    "RequestExpired",
+)
+
+# Options of the `sharded` config section which are passed on to every shard's `AwsBackend`, unless the shard has its
+# own value
+SHARD_OPTIONS = ("max_pool_connections", "max_attempts", "retry_mode", "share_client", "rate_limit", "endpoint_url")
+
+
+class NoShardsAvailable(Exception):
+    """
+    Raised when no shard is able to send a message, e.g. because every shard's daily quota has been used up
+    """
+
+
+def is_failover(error: Exception) -> bool:
+    """
+    Returns True if a send failed because of the shard it was sent through, so should be tried on another shard
+    """
+    if isinstance(error, (QuotaExceeded, BotoCoreError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in FAILOVER_ERRORS
+    return False
+
+
+class Shard(object):
+    """
+    One account and region of a `ShardedAwsBackend`
+
+    ### Parameters:
+
+    - `backend`: The `AwsBackend` which sends through this account and region
+    - `weight`: The shard's share of messages, relative to the other shards. If not supplied, its current send rate is
+    used - see `capacity`
+    """
+
+    def __init__(self, backend: AwsBackend, weight: Optional[float] = None):
+        self.backend = backend
+        self.weight = weight
+        self.current = 0.0
+        self.down_until = 0.0
+        self.sent = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return f"<Shard {self.backend.region_name}>"
+
+    @property
+    def capacity(self) -> float:
+        """
+        The shard's share of messages: its `weight` if it has one, otherwise the current rate of its rate limiter,
+        which starts at the account's maximum send rate and is cut each time the shard is throttled
+        """
+        if self.weight is not None:
+            return self.weight
+        limiter = self.backend.rate_limiter
+        return limiter.rate if limiter else 1.0
+
+
+class ShardedAwsBackend(BaseBackend):
+    """
+    Sends each message through one of several SES accounts and regions, listed in the `sharded` section of the
+    maildown config file:
+
+        [sharded]
+        shards = [
+            { access_key = "...", secret_key = "...", region = "us-east-1" },
+            { access_key = "...", secret_key = "...", region = "eu-west-1", weight = 2 },
+        ]
+
+    A shard without credentials uses those stored by `maildown init`, so one account can be sharded across several
+    regions. Shards can be added with `maildown init --backend=sharded access_key=... region_name=...`. The sender must
+    be verified in every shard
+
+    ### Parameters:
+
+    - `shards`: The shards' settings, in place of those in the config file
+    - `cooldown`: How many seconds a shard is skipped for after it fails. Defaults to 30
+    - `clock`: The clock cool downs are measured with
+    """
+
+    name = "sharded"
+
+    def __init__(
+        self,
+        shards: Optional[List[Dict[str, Any]]] = None,
+        cooldown: Optional[float] = None,
+        clock=time.monotonic,
+    ):
+        super().__init__()
+        self.shard_config = shards
+        self.cooldown = cooldown
+        self.clock = clock
+        self._shards: Optional[List[Shard]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def shards(self) -> List[Shard]:
+        """
+        Returns the shards, which are built the first time they are needed. Their clients and rate limiters are each
+        built the first time the shard sends
+        """
+        if self._shards is None:
+            with self._lock:
+                if self._shards is None:
+                    settings = self.shard_config or self.config.get("shards", [])  # type: ignore
+                    if not settings:
+                        raise AttributeError(
+                            "No shards are configured - add them to the `sharded` section of the config file, or with "
+                            "`maildown init --backend=sharded`"
+                        )
+                    self._shards = [self.create_shard(shard) for shard in settings]
+        return self._shards
+
+    def create_shard(self, settings: Dict[str, Any]) -> Shard:
+        options = {key: settings.get(key, self.config.get(key)) for key in SHARD_OPTIONS}  # type: ignore
+        retries = settings.get(
+            "throttle_retries", self.config.get("throttle_retries", DEFAULT_THROTTLE_RETRIES)  # type: ignore
+        )
+        backend = AwsBackend(
+            access_key=settings.get("access_key"),
+            secret_key=settings.get("secret_key"),
+            region=settings.get("region"),
+            throttle_retries=int(retries),  # type: ignore
+            **options,
+        )
+        weight = settings.get("weight")
+        return Shard(backend, float(weight) if weight is not None else None)
+
+    def login(  # type: ignore
+        self,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        region_name: str = "us-east-1",
+        weight: Optional[float] = None,
+    ) -> None:
+        """
+        Adds a shard to the config file. If credentials are given they are checked first, otherwise the shard uses
+        the credentials stored by `AwsBackend.login`
+        """
+        if access_key or secret_key:
+            if not (access_key and secret_key):
+                raise AttributeError("You must supply both the `access_key` and `secret_key`, or neither")
+            if not AwsBackend.verify_auth(access_key, secret_key, region_name):
+                raise AttributeError("The supplied credentials are not valid")
+
+        shard: Dict[str, Any] = dict(region=region_name)
+        if access_key:
+            shard.update(access_key=access_key, secret_key=secret_key)
+        if weight is not None:
+            shard["weight"] = float(weight)
+        self.config["shards"] = list(self.config.get("shards", [])) + [shard]  # type: ignore
+        self._shards = None
+
+    def pick(self, exclude: Sequence[Shard] = ()) -> Optional[Shard]:
+        """
+        Returns the shard to send the next message through, by smooth weighted round robin: each shard gets a share of
+        messages in proportion to its `capacity`, interleaved with the others' rather than in runs. Shards which
+        failed recently are skipped until their cool down is over, unless every shard has, in which case the one
+        which will recover first is used. Returns None if every shard is excluded or out of quota
+        """
+        candidates = [shard for shard in self.shards if shard not in exclude]
+        now = self.clock()
+        up = [shard for shard in candidates if shard.down_until <= now]
+        if not up:
+            soonest = min(candidates, key=lambda shard: shard.down_until, default=None)
+            return soonest if soonest is not None and soonest.down_until != math.inf else None
+
+        capacities = [shard.capacity for shard in up]
+        total = sum(capacities)
+        with self._lock:
+            for shard, capacity in zip(up, capacities):
+                shard.current += capacity
+            chosen = max(up, key=lambda shard: shard.current)
+            chosen.current -= total
+        return chosen
+
+    def fail(self, shard: Shard, error: Exception) -> None:
+        """
+        Takes a shard out of use for `cooldown` seconds, or for good if its daily quota has been used up
+        """
+        if self.cooldown is None:
+            self.cooldown = float(self.config.get("cooldown", DEFAULT_COOLDOWN))  # type: ignore
+        with self._lock:
+            shard.failed += 1
+            shard.down_until = math.inf if isinstance(error, QuotaExceeded) else self.clock() + self.cooldown
+        instrumentation.event("sharded.failover", region=shard.backend.region_name, error=type(error).__name__)
+
+    def call(self, operation: str, messages: int = 1, **kwargs):
+        """
+        Calls an SES sending operation through the next shard - see `AwsBackend.call`. If it fails because of the
+        shard, it is tried again on each of the other shards in turn
+        """
+        tried: List[Shard] = []
+        error: Optional[Exception] = None
+        while True:
+            shard = self.pick(tried)
+            if shard is None:
+                if error is not None:
+                    raise error
+                raise NoShardsAvailable("Every shard has used up its daily sending quota")
+            try:
+                response = shard.backend.call(operation, messages, **kwargs)
+            except Exception as e:
+                if not is_failover(e):
+                    raise
+                self.fail(shard, e)
+                tried.append(shard)
+                error = e
+                continue
+            with self._lock:
+                shard.sent += messages
+                if shard.down_until != math.inf:
+                    shard.down_until = 0.0
+            return response
+
+    def send_message(self, to: list, sender: str, html: str, content: str, subject: str):
+        return self.call("send_email", **email_request(to, sender, html, content, subject))
+
+    def send_raw_message(self, to: list, sender: str, raw: bytes):
+        return self.call("send_raw_email", Source=sender, Destinations=to, RawMessage=dict(Data=raw))
+
+    def verify_address(self, email: str) -> bool:
+        """
+        Checks an address with every shard, each of which sends its own verification email if it isn't verified
+        there. Returns True only if it is verified in every shard
+        """
+        return all([shard.backend.verify_address(email) for shard in self.shards])
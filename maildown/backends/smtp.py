@@ -0,0 +1,277 @@
+from typing import Callable, List, Optional, Union
+import contextlib
+import queue
+import smtplib
+import ssl
+import threading
+import weakref
+from email.message import EmailMessage
+from maildown import instrumentation
+from maildown.backends.base import BaseBackend, DEFAULT_WORKERS
+
+
+DEFAULT_PORT = 587
+DEFAULT_TIMEOUT = 30.0
+MAX_MESSAGES_PER_CONNECTION = 100
+MAX_RECONNECTS = 2
+
+
+def is_dropped(error: BaseException) -> bool:
+    """
+    Returns True if an error means the connection itself is unusable, rather than that the relay refused the message.
+    `smtplib`'s own errors are all `OSError`s, so have to be told apart from socket errors
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def build_message(to: list, sender: str, html: str, content: str, subject: str) -> EmailMessage:
+    """
+    Returns a multipart/alternative message with a plain text part holding the markdown, and an html part
+    """
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = ", ".join(to)
+    message["Subject"] = subject
+    message.set_content(content)
+    message.add_alternative(html, subtype="html")
+    return message
+
+
+class Connection(object):
+    """
+    An open SMTP connection, and the number of messages which have been sent over it
+    """
+
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.sent = 0
+
+    def close(self) -> None:
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of SMTP connections. Connections are opened as they are needed, up to `size` at once, and
+    handed back to the pool after each message, so the TCP, TLS and AUTH handshakes are paid once per connection
+    rather than once per message. A connection is closed once it has sent `max_messages` messages, as many relays
+    limit how many messages they accept per session. Threads wanting a connection when `size` are already in use wait
+    for one to be returned
+
+    ### Parameters:
+
+    - `connect`: Called to open a new, ready to use `smtplib.SMTP` connection
+    - `size`: The maximum number of open connections
+    - `max_messages`: The number of messages to send over a connection before replacing it
+    """
+
+    def __init__(self, connect: Callable[[], smtplib.SMTP], size: int, max_messages: int):
+        self.connect = connect
+        self.size = size
+        self.max_messages = max_messages
+        self.idle: "queue.LifoQueue[Connection]" = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def acquire(self) -> Connection:
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return Connection(self.connect())
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection: Connection, broken: bool = False) -> None:
+        try:
+            if broken or connection.sent >= self.max_messages:
+                connection.close()
+            else:
+                self.idle.put(connection)
+        finally:
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Lends out a connection for the length of a `with` block. If the block raises an error which means the
+        connection has been dropped, it is thrown away rather than returned to the pool
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException as e:
+            self.release(connection, broken=is_dropped(e))
+            raise
+        else:
+            self.release(connection)
+
+    def close(self) -> None:
+        """
+        Closes every idle connection
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class SmtpBackend(BaseBackend):
+    name = "smtp"
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        starttls: Optional[bool] = None,
+        pool_size: Optional[int] = None,
+        max_messages: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Sends through an SMTP relay, over a pool of persistent connections - see `ConnectionPool`. Each parameter
+        falls back to the value of the same name in the `smtp` section of the maildown config file
+
+        ### Parameters:
+
+        - `host`: The relay's host name
+        - `port`: The relay's port. Defaults to 587
+        - `username`: The user to authenticate as. If not set, no AUTH is attempted
+        - `password`: The password to authenticate with
+        - `starttls`: When true (the default), each connection is upgraded with STARTTLS before authenticating
+        - `pool_size`: The maximum number of open connections. Defaults to the number of workers used by `send_many`
+        - `max_messages`: The number of messages to send over a connection before replacing it. Defaults to 100
+        - `timeout`: The socket timeout, in seconds. Defaults to 30
+        """
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.pool_size = pool_size
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._pool: Optional[ConnectionPool] = None
+        self._pool_lock = threading.Lock()
+
+    def setting(self, name: str, default=None):
+        value = getattr(self, name)
+        if value is None:
+            value = self.config.get(name, default)  # type: ignore
+        return value
+
+    def login(  # type: ignore
+        self,
+        host: str,
+        port: int = DEFAULT_PORT,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        starttls: Union[bool, str] = True,
+    ) -> None:
+        """
+        Checks that the relay accepts the given settings by opening a connection, and stores them to the maildown
+        config file. Settings given on the command line arrive as strings, so `port` and `starttls` are converted
+        """
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.starttls = str(starttls).lower() not in ("false", "no", "0")
+        self.connect().quit()
+        settings = dict(host=self.host, port=self.port, starttls=self.starttls)
+        if username:
+            settings.update(username=username, password=password or "")
+        self.config.update(**settings)  # type: ignore
+
+    def verify_address(self, email: str) -> bool:
+        """
+        SMTP relays don't have a verification step, so every address counts as verified
+        """
+        return True
+
+    def connect(self) -> smtplib.SMTP:
+        """
+        Opens a new connection to the relay, upgrades it with STARTTLS and authenticates, as configured
+        """
+        host = self.setting("host")
+        if not host:
+            raise AttributeError("No SMTP host configured - run `maildown init --backend=smtp host=...` first")
+
+        smtp = smtplib.SMTP(
+            host, int(self.setting("port", DEFAULT_PORT)), timeout=float(self.setting("timeout", DEFAULT_TIMEOUT))
+        )
+        try:
+            smtp.ehlo()
+            if self.setting("starttls", True):
+                smtp.starttls(context=ssl.create_default_context())
+                smtp.ehlo()
+            username = self.setting("username")
+            if username:
+                smtp.login(username, self.setting("password", ""))
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    @property
+    def pool(self) -> ConnectionPool:
+        """
+        Returns the connection pool, which is created the first time it is needed. Its idle connections are closed
+        when the backend is garbage collected, or at exit
+        """
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        self.connect,
+                        int(self.setting("pool_size", DEFAULT_WORKERS)),
+                        int(self.setting("max_messages", MAX_MESSAGES_PER_CONNECTION)),
+                    )
+                    weakref.finalize(self, self._pool.close)
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+
+    def send_message(self, to: list, sender: str, html: str, content: str, subject: str) -> List[str]:
+        """
+        Sends a message over a pooled connection. If the connection turns out to have been dropped, e.g. because the
+        relay closed it while it was idle, the message is retried on a fresh one, up to `MAX_RECONNECTS` times.
+        Returns the recipients the relay accepted
+        """
+        message = build_message(to, sender, html, content, subject)
+        return self.deliver(to, lambda smtp: smtp.send_message(message, from_addr=sender, to_addrs=to))
+
+    def send_raw_message(self, to: list, sender: str, raw: bytes) -> List[str]:
+        return self.deliver(to, lambda smtp: smtp.sendmail(sender, to, raw))
+
+    def deliver(self, to: list, send: Callable[[smtplib.SMTP], dict]) -> List[str]:
+        """
+        Calls `send` with a pooled connection, retrying on a fresh one if it has been dropped, and returns the
+        recipients which weren't refused
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.pool.connection() as connection, instrumentation.span("smtp.send"):
+                    refused = send(connection.smtp)
+                    connection.sent += 1
+            except Exception as e:
+                if not is_dropped(e) or attempt >= MAX_RECONNECTS:
+                    raise
+                instrumentation.event("smtp.reconnect")
+                attempt += 1
+            else:
+                return [address for address in to if address not in refused]
@@ -0,0 +1,146 @@
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+import glob
+import json
+import os
+from concurrent import futures
+
+
+EXTENSIONS = (".md", ".markdown")
+
+
+class RenderJob(NamedTuple):
+    source: str
+    output: str
+    context: dict
+    error: Optional[str] = None
+
+
+class RenderResult(NamedTuple):
+    source: str
+    output: str
+    error: Optional[str] = None
+
+
+def find_files(paths: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    Expands a list of markdown files, directories and glob patterns. Directories and patterns only match `.md` and
+    `.markdown` files, and directories are searched recursively. Returns `(path, relative path)` pairs, where the
+    relative path is the file's location within the directory it was found in, in the order they were given, without
+    duplicates
+    """
+    found: Dict[str, Tuple[str, str]] = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    if name.lower().endswith(EXTENSIONS):
+                        source = os.path.join(directory, name)
+                        found.setdefault(os.path.abspath(source), (source, os.path.relpath(source, path)))
+        elif os.path.isfile(path):
+            found.setdefault(os.path.abspath(path), (path, os.path.basename(path)))
+        else:
+            for source in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(source) and source.lower().endswith(EXTENSIONS):
+                    found.setdefault(os.path.abspath(source), (source, os.path.basename(source)))
+    return list(found.values())
+
+
+def plan(paths: Iterable[str], output_dir: Optional[str] = None, context: Optional[dict] = None) -> List[RenderJob]:
+    """
+    Returns a `RenderJob` for each markdown file found in `paths`. Each file is rendered with the shared `context`,
+    updated with the contents of a JSON file of the same name next to it if there is one, e.g. `digest.json` for
+    `digest.md`. A JSON file which can't be read is reported as its markdown file's error, rather than stopping the
+    rest. Raises a `ValueError` if two files would be written to the same html file
+
+    ### Parameters:
+
+    - `paths`: Markdown files, directories and glob patterns
+    - `output_dir`: The directory to write the html to, keeping the layout of any directories given. If not
+    supplied, each html file is written next to its markdown file
+    - `context`: Context shared by every file
+    """
+    jobs = []
+    outputs: Dict[str, str] = {}
+    for source, relative in find_files(paths):
+        stem = os.path.splitext(source)[0]
+        if output_dir:
+            output = os.path.join(output_dir, os.path.splitext(relative)[0] + ".html")
+        else:
+            output = stem + ".html"
+        other = outputs.setdefault(os.path.abspath(output), source)
+        if other != source:
+            raise ValueError(f"{other} and {source} would both be rendered to {output}")
+
+        file_context = dict(context or {})
+        error = None
+        if os.path.isfile(stem + ".json"):
+            try:
+                with open(stem + ".json") as f:
+                    file_context.update(json.load(f))
+            except ValueError as e:
+                error = f"Can't read the context in {stem}.json: {e}"
+        jobs.append(RenderJob(source, output, file_context, error))
+    return jobs
+
+
+def warm(theme: Optional[str] = None) -> None:
+    """
+    Loads the template and theme, and compiles the stylesheet, so that the first real document rendered by a worker
+    process doesn't pay for it
+    """
+    from maildown import renderer
+
+    renderer.compile_content("```python\n\n```", theme=theme)
+
+
+_warmed: Set[Optional[str]] = set()
+
+
+def render_file(job: RenderJob, theme: Optional[str] = None) -> RenderResult:
+    from maildown import renderer
+
+    if job.error:
+        return RenderResult(job.source, job.output, job.error)
+    try:
+        with open(job.source) as f:
+            content = f.read()
+        html = renderer.generate_content(content, theme=theme, context=job.context)
+        os.makedirs(os.path.dirname(os.path.abspath(job.output)), exist_ok=True)
+        with open(job.output, "w") as f:
+            f.write(html)
+    except Exception as e:
+        return RenderResult(job.source, job.output, f"{type(e).__name__}: {e}")
+    return RenderResult(job.source, job.output)
+
+
+def _render_file(args) -> RenderResult:
+    # Runs in a worker process, which warms its caches before the first file it renders
+    theme = args[1]
+    if theme not in _warmed:
+        warm(theme)
+        _warmed.add(theme)
+    return render_file(*args)
+
+
+def render_files(
+    jobs: List[RenderJob], theme: Optional[str] = None, workers: Optional[int] = None
+) -> Iterator[RenderResult]:
+    """
+    Renders markdown files to html in a pool of worker processes, and yields a `RenderResult` for each one, in order.
+    Rendering is pure python, so processes are used rather than threads. Each worker warms its template, theme and
+    stylesheet caches before its first file. With one worker, or one file, everything is rendered in this process
+
+    ### Parameters:
+
+    - `jobs`: The files to render - see `plan`
+    - `theme`: A local file path to a css style sheet. If not supplied, the default style is used
+    - `workers`: The number of processes to use. Defaults to the number of CPUs
+    """
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        yield from (render_file(job, theme) for job in jobs)
+        return
+
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_render_file, ((job, theme) for job in jobs), chunksize=chunksize)
@@ -1,8 +1,18 @@
+import contextlib
+import itertools
+import os
+import time
 from cleo.commands import Command
-from maildown import backends
+from maildown import jobs, recipients as recipient_stream
+from maildown.registry import LazyRegistry
 
 
-available_backends = dict(aws=backends.AwsBackend)
+available_backends = LazyRegistry(
+    aws="maildown.backends.aws:AwsBackend",
+    smtp="maildown.backends.smtp:SmtpBackend",
+    sharded="maildown.backends.sharded:ShardedAwsBackend",
+)
+async_backends = LazyRegistry(aws="maildown.backends.aio:AsyncAwsBackend")
 
 
 class InitCommand(Command):
@@ -10,7 +20,7 @@ class InitCommand(Command):
     Configures Maildown for use
 
     init
-        {--backend=aws : The email backend to use. Defaults to AWS SES }
+        {--backend=aws : The email backend to use: aws (AWS SES, the default), sharded (several SES accounts) or smtp}
         {options?* : Arguments to pass to the backend's login methods, e.g. `access_key=1234`}
 
     """
@@ -38,7 +48,7 @@ class VerifyCommand(Command):
 
     verify
         {email-address : The email address that you want to verify}
-        {--backend=aws : The email backend to use. Defaults to AWS SES }
+        {--backend=aws : The email backend to use: aws (AWS SES, the default), sharded (several SES accounts) or smtp}
     """
 
     def handle(self):
@@ -70,21 +80,107 @@ class SendCommand(Command):
         {sender : The source email address (you must have verified ownership)}
         {subject : The subject line of the email}
         {--c|content=? : The content of the email to send}
-        {--backend=aws : The email backend to use. Defaults to AWS SES }
+        {--backend=aws : The email backend to use: aws (AWS SES, the default), sharded (several SES accounts) or smtp}
         {--f|file-path=? : A path to a file containing content to send}
         {--t|theme=? : A path to a css file to be applied to the email}
+        {--highlight-workers=? : The number of processes to highlight the email's code blocks in before sending}
         {--e|variable=* : Context variables to pass to the email, e.g. `-e name=Chris`}
+        {--a|attach=* : A file to attach to every message}
+        {--r|recipients-file=? : A CSV, JSONL or plain text file of recipients, or `-` to read from stdin}
+        {--recipients-format=? : The format of the recipients file: csv, jsonl or lines. Guessed if not supplied}
+        {--dedupe=hash : How to drop duplicate recipients: hash (exact), bloom (approximate, fixed memory) or none}
+        {--w|workers=10 : The number of messages to send concurrently when using a recipients file}
+        {--bulk : Send to the recipients file in batches through the backend's bulk API, if it has one}
+        {--async : Send with the backend's asyncio engine rather than a thread pool}
+        {--concurrency=100 : The number of messages to keep in flight at once when using --async}
+        {--queue : Record the send in the local job queue, so that it can be resumed with `maildown resume`}
+        {--campaign=? : The name to log each message's outcome under, for `maildown report`. Defaults to the subject}
+        {--no-send-log : Don't log each message's outcome to the send log}
+        {--dry-run : Build every message and write it to --output rather than sending it}
+        {--o|output=? : With --dry-run, an mbox file, a directory of .eml files, or a JSONL file (gzipped if .gz)}
+        {--processes=? : With --dry-run, the number of processes to render messages in}
+        {--stats : Write the count, p50 and p99 time of each render and send phase when finished}
+        {--prometheus=? : Write render and send metrics to this file in the Prometheus text format}
+        {--trace=? : Write a JSON trace of every render and send phase to this file}
         {recipients?* : A list of email addresses to send the mail to}
     """
 
     def handle(self):
+        from maildown import instrumentation
+
+        self.sent = self.failed = self.skipped = 0
+        self.dry = False
+        self.log = None
+        self.campaign = None
+        with instrumentation.recording(*self.exporters()):
+            return self.send()
+
+    def exporters(self) -> list:
+        """
+        Returns the instrumentation exporters asked for with the `--stats`, `--prometheus` and `--trace` options
+        """
+        from maildown import instrumentation
+
+        exporters: list = []
+        if self.option("stats"):
+            exporters.append(instrumentation.LogExporter(self.line))
+        if self.option("prometheus"):
+            exporters.append(instrumentation.PrometheusExporter(self.option("prometheus")))
+        if self.option("trace"):
+            exporters.append(instrumentation.JsonTraceExporter(self.option("trace")))
+        return exporters
+
+    def send(self):
+        if self.option("dry-run"):
+            return self.dry_run()
+
         __backend = available_backends.get(self.option("backend"))
         if not __backend:
             return self.line(
                 f'No backend called {self.option("backend")} exists', "error"
             )
-        backend = __backend()
+        with self.send_log(self.option("campaign") or self.argument("subject")):
+            return self.deliver(__backend())
+
+    @contextlib.contextmanager
+    def send_log(self, campaign: str):
+        """
+        Logs the outcome of every message sent in the block to the send log, under the name `campaign`, unless
+        `--no-send-log` was given
+        """
+        if self.option("no-send-log"):
+            yield
+            return
+        from maildown import sendlog
 
+        with sendlog.SendLog() as log:
+            self.log, self.campaign = log, campaign
+            try:
+                yield
+            finally:
+                self.log = None
+
+    def dry_run(self):
+        from maildown import outbox
+        from maildown.backends.dryrun import DryRunBackend
+
+        output = self.option("output")
+        if not output:
+            return self.line("--dry-run needs an --output file or directory to write the messages to", "error")
+        if self.option("bulk") or self.option("async") or self.option("queue"):
+            return self.line("--dry-run can't be combined with --bulk, --async or --queue", "error")
+        try:
+            writer = outbox.open_writer(output)
+        except ValueError as e:
+            return self.line(str(e), "error")
+
+        processes = self.option("processes")
+        self.dry = True
+        with writer:
+            self.deliver(DryRunBackend(writer, int(processes) if processes else None))
+        self.info(f"{writer.count} messages written to {output}")
+
+    def deliver(self, backend):
         sender = self.argument("sender")
         subject = self.argument("subject")
 
@@ -92,6 +188,7 @@ class SendCommand(Command):
         file_path = self.option("file-path")
         theme = self.option("theme")
         recipients = self.argument("recipients")
+        recipients_file = self.option("recipients-file")
 
         variables = self.option("variable")
         environment = dict()
@@ -99,7 +196,7 @@ class SendCommand(Command):
             key, val = var.split("=")
             environment[key] = val
 
-        if not recipients:
+        if not recipients and not recipients_file:
             self.line("You must supply at least one recipient", "error")
             return
 
@@ -110,6 +207,10 @@ class SendCommand(Command):
             )
             return
 
+        if sum(bool(self.option(option)) for option in ("bulk", "async", "queue")) > 1:
+            self.line("Only one of --bulk, --async and --queue can be given", "error")
+            return
+
         kwargs = dict(
             sender=sender,
             subject=subject,
@@ -120,6 +221,450 @@ class SendCommand(Command):
         )
         if theme:
             kwargs["theme"] = theme
+        highlight_workers = self.option("highlight-workers")
+        if highlight_workers:
+            from maildown import templates
+
+            # Compiling here fills the highlight and compiled message caches, which the backend's compile then hits
+            templates.compile_content(
+                content or templates.read_file(file_path), theme=theme, highlight_workers=int(highlight_workers)
+            )
+
+        attachments = self.option("attach")
+        if attachments:
+            if self.option("bulk") or self.option("async") or self.option("queue"):
+                self.line("Attachments can't be sent with --bulk, --async or --queue", "error")
+                return
+            kwargs["attachments"] = attachments
+
+        if recipients_file or self.option("async") or self.option("queue"):
+            dedupe = self.option("dedupe")
+            if dedupe not in ("hash", "bloom", "none"):
+                self.line(f"Unknown dedupe option {dedupe}", "error")
+                return
+
+            del kwargs["to"]
+            stream = itertools.chain(
+                (dict(email=email) for email in recipients),
+                recipient_stream.read(recipients_file, self.option("recipients-format"))
+                if recipients_file
+                else (),
+            )
+            if dedupe == "hash":
+                stream = recipient_stream.dedupe(stream)
+            elif dedupe == "bloom":
+                stream = recipient_stream.dedupe(
+                    stream, recipient_stream.BloomFilter(recipient_stream.BLOOM_CAPACITY)
+                )
+
+            if self.option("async"):
+                __async_backend = async_backends.get(self.option("backend"))
+                if not __async_backend:
+                    self.line(f'The {backend.name} backend does not support async sending', "error")
+                    return
+                import asyncio
+
+                loop = asyncio.new_event_loop()
+                try:
+                    loop.run_until_complete(self.send_async(__async_backend(), stream, kwargs))
+                finally:
+                    loop.close()
+                self.info(self.summary())
+                return
+
+            if self.option("queue"):
+                if file_path:
+                    from maildown import templates
+
+                    kwargs["content"] = templates.read_file(file_path)
+                with jobs.SendQueue() as queue:
+                    job_id = queue.create_job(
+                        backend.name,
+                        sender,
+                        subject,
+                        kwargs["content"],
+                        theme=theme,
+                        context=environment,
+                    )
+                    queue.enqueue(job_id, stream)
+                    self.info(f"Messages added to queue as job {job_id}")
+                    self.run_job(queue, job_id, backend)
+                return
+
+            if self.option("bulk"):
+                if not hasattr(backend, "iter_send_bulk"):
+                    self.line(f'The {backend.name} backend does not support bulk sending', "error")
+                    return
+                results = backend.iter_send_bulk(recipients=stream, **kwargs)
+            else:
+                results = backend.iter_send_many(
+                    recipients=stream, workers=int(self.option("workers")), **kwargs
+                )
+
+            for result in results:
+                self.count(result)
+            self.info(self.summary())
+            return
+
+        from maildown import sendlog
+        from maildown.backends.base import SendResult
+
+        skipped: list = []
+        kwargs["to"] = [
+            recipient["email"]
+            for recipient in backend.filter_suppressed((dict(email=email) for email in recipients), skipped.append)
+        ]
+        for result in skipped:
+            self.count(result)
+        if kwargs["to"]:
+            start = time.perf_counter()
+            try:
+                response = backend.send(**kwargs)
+            except Exception as e:
+                for email in kwargs["to"]:
+                    self.record(SendResult(email, error=e, latency=time.perf_counter() - start))
+                raise
+            for email in kwargs["to"]:
+                self.count(SendResult(email, response, latency=time.perf_counter() - start))
+            message_id = sendlog.message_id(response)
+        else:
+            message_id = None
+        if backend.name != "dry-run":
+            self.info(self.summary() + (f" as message {message_id}" if message_id else ""))
+
+    async def send_async(self, backend, stream, kwargs):
+        async with backend:
+            async for result in backend.iter_send_many(
+                recipients=stream, concurrency=int(self.option("concurrency")), **kwargs
+            ):
+                self.count(result)
+
+    def run_job(self, queue, job_id, backend, retry_failed=False):
+        for result in jobs.run_job(
+            queue, job_id, backend, int(self.option("workers")), retry_failed
+        ):
+            self.count(result)
+        counts = queue.counts(job_id)
+        self.info(
+            f"Job {job_id}: {counts['sent']} sent, {counts['failed']} failed, {counts['pending']} pending"
+            + (f", {counts['suppressed']} skipped as suppressed" if counts.get("suppressed") else "")
+        )
+
+    def count(self, result) -> None:
+        """
+        Reports and logs a result, and adds it to the totals for `summary`
+        """
+        from maildown.backends.base import Suppressed
+
+        self.record(result)
+        if isinstance(result.error, Suppressed):
+            self.skipped += 1
+        elif self.report(result):
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def record(self, result) -> None:
+        """
+        Writes a result to the send log, if it is open
+        """
+        if self.log is not None:
+            self.log.record(self.campaign, result)
+
+    def summary(self) -> str:
+        message = f"{self.sent} of {self.sent + self.failed} messages {'built' if self.dry else 'sent'}"
+        if self.skipped:
+            message += f", {self.skipped} skipped as suppressed"
+        return message
+
+    def report(self, result) -> bool:
+        """
+        Writes out the error for a failed send. Returns True if the send succeeded
+        """
+        if result.error:
+            self.line(f"Failed to send to {result.recipient}: {result.error}", "error")
+            return False
+        return True
+
+
+class RenderCommand(Command):
+    """
+    Renders markdown files to html, in parallel
+
+    render
+        {paths* : Markdown files, directories or glob patterns to render}
+        {--o|output-dir=? : The directory to write the html to. Defaults to next to each markdown file}
+        {--t|theme=? : A path to a css file to be applied to the email}
+        {--e|variable=* : Context variables shared by every file, e.g. `-e name=Chris`}
+        {--w|workers=? : The number of processes to render with. Defaults to the number of CPUs}
+    """
+
+    def handle(self):
+        from maildown import batch
+
+        context = dict()
+        for var in self.option("variable"):
+            key, val = var.split("=")
+            context[key] = val
+
+        try:
+            jobs = batch.plan(self.argument("paths"), self.option("output-dir"), context)
+        except ValueError as e:
+            return self.line(str(e), "error")
+        if not jobs:
+            return self.line("No markdown files found", "error")
+
+        workers = self.option("workers")
+        rendered = 0
+        for result in batch.render_files(jobs, self.option("theme"), int(workers) if workers else None):
+            if result.error:
+                self.line(f"Failed to render {result.source}: {result.error}", "error")
+            else:
+                rendered += 1
+        self.info(f"{rendered} of {len(jobs)} files rendered")
+
+
+class CompileCommand(Command):
+    """
+    Compiles a markdown email into a ready to render artifact, which `send` can load without compiling it again
+
+    compile
+        {file-path : A path to a file containing the content of the email}
+        {--o|output=? : The file to write the artifact to. Defaults to the markdown file's name with a .mdc extension}
+        {--t|theme=? : A path to a css file to be applied to the email}
+        {--highlight-workers=? : The number of processes to highlight the email's code blocks in}
+    """
+
+    def handle(self):
+        from maildown import renderer, templates
+
+        file_path = self.argument("file-path")
+        output = self.option("output") or os.path.splitext(file_path)[0] + templates.ARTIFACT_EXTENSION
+        if not templates.is_artifact(output):
+            return self.line(f"The output file must have a {templates.ARTIFACT_EXTENSION} extension", "error")
+
+        with open(file_path) as f:
+            content = f.read()
+        highlight_workers = self.option("highlight-workers")
+        renderer.compile_content(
+            content,
+            theme=self.option("theme"),
+            highlight_workers=int(highlight_workers) if highlight_workers else None,
+        ).save(output)
+        self.info(f"Compiled {file_path} to {output}")
+
+
+class ServeCommand(Command):
+    """
+    Runs a long lived process which renders and sends emails, for other programs to call over HTTP or a Unix socket
+
+    serve
+        {--host=127.0.0.1 : The address to listen on}
+        {--p|port=8025 : The port to listen on}
+        {--socket=? : Listen on a Unix socket at this path instead of a port}
+        {--backend=aws : The backend to use for jobs which don't name one: aws (AWS SES, the default), sharded or smtp}
+        {--w|workers=10 : The number of messages to send concurrently, across every job}
+        {--t|theme=? : A path to a css file to warm the template cache with}
+        {--root=? : The directory requests may read files from. Without it, requests can't name local files}
+        {--token=? : The token clients must send. Defaults to the serve token in the config, or ~/.maildown/serve.token}
+        {--no-log : Don't log each request}
+        {--no-send-log : Don't log each message's outcome to the send log}
+    """
+
+    def handle(self):
+        from maildown import sendlog, server
+
+        if not available_backends.get(self.option("backend")):
+            return self.line(f'No backend called {self.option("backend")} exists', "error")
+
+        token = self.option("token")
+        if not token and not self.option("socket"):
+            token = server.default_token()
+        send_log = None if self.option("no-send-log") else sendlog.SendLog()
+        daemon = server.Daemon(
+            self.option("backend"),
+            int(self.option("workers")),
+            self.option("theme"),
+            send_log=send_log,
+            root=self.option("root"),
+        )
+        daemon.warm()
+        httpd = server.create_server(
+            daemon, self.option("host"), int(self.option("port")), self.option("socket"), self.option("no-log"), token
+        )
+        where = self.option("socket") or f'http://{self.option("host")}:{self.option("port")}'
+        self.info(f"Listening on {where}")
+        if token and not self.option("token"):
+            self.line(
+                f"Requests must send the token in the config or {server.token_path()}, as an `Authorization: Bearer` "
+                "header"
+            )
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            daemon.close()
+            if send_log is not None:
+                send_log.close()
+            if self.option("socket") and os.path.exists(self.option("socket")):
+                os.remove(self.option("socket"))
+
+
+class PreviewCommand(Command):
+    """
+    Serves a preview of an email on a local port
+
+    preview
+        {file-path : A path to a file containing the content of the email}
+        {--t|theme=? : A path to a css file to be applied to the email}
+        {--e|variable=* : Context variables to pass to the email, e.g. `-e name=Chris`}
+        {--host=127.0.0.1 : The address to listen on}
+        {--p|port=8000 : The port to listen on}
+        {--watch : Render the email again when the markdown, theme, template or context file changes, and reload it}
+    """
+
+    def handle(self):
+        import threading
+        from maildown import preview
+
+        context = dict()
+        for var in self.option("variable"):
+            key, val = var.split("=")
+            context[key] = val
+
+        def on_render(elapsed, error):
+            if error:
+                self.line(f"Failed to render {self.argument('file-path')}: {error}", "error")
+            else:
+                self.line(f"Rendered {self.argument('file-path')} in {elapsed * 1000:.1f} ms")
+
+        page = preview.Preview(self.argument("file-path"), self.option("theme"), context, on_render)
+        page.poll()
+        httpd = preview.PreviewServer(page, (self.option("host"), int(self.option("port"))), self.option("watch"))
+        self.info(f'Serving a preview on http://{self.option("host")}:{httpd.server_address[1]}')
+
+        stop = threading.Event()
+        if self.option("watch"):
+            threading.Thread(target=page.watch, args=(stop,), daemon=True).start()
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            httpd.server_close()
+
+
+class SuppressCommand(Command):
+    """
+    Imports addresses into the local suppression list, which every send skips
+
+    suppress
+        {paths?* : SES suppression list exports, bounce or complaint notifications, or CSV or text files of addresses}
+        {--reason=? : The reason to record for addresses which don't come with one}
+        {--remove=* : An address to take off the suppression list}
+    """
+
+    def handle(self):
+        from maildown import suppression
+
+        paths = self.argument("paths")
+        removals = self.option("remove")
+        if not paths and not removals:
+            return self.line("You must supply a file to import, or an address to --remove", "error")
+
+        start = time.perf_counter()
+        with suppression.SuppressionList() as suppressions:
+            for path in paths:
+                entries = (
+                    (email, reason or self.option("reason")) for email, reason in suppression.read(path)
+                )
+                try:
+                    added = suppressions.add(entries, source=os.path.basename(path))
+                except (OSError, ValueError, KeyError) as e:
+                    self.line(f"Failed to import {path}: {e}", "error")
+                    continue
+                self.line(f"Added {added} addresses from {path}")
+            if removals:
+                self.line(f"Removed {suppressions.remove(removals)} addresses")
+            total = len(suppressions)
+        self.info(f"{total} addresses suppressed ({time.perf_counter() - start:.1f}s)")
+
+
+class ReportCommand(Command):
+    """
+    Totals the outcome of logged sends by campaign: messages delivered, failed and suppressed, and send latencies
+
+    report
+        {campaigns?* : The campaigns to report on. Defaults to every campaign in the log}
+        {--log=? : The send log to read. Defaults to ~/.maildown/sends.log}
+        {--since=? : Only count sends since a time, e.g. 12h, 7d or 2024-05-01}
+        {--errors : List how many of each error each campaign failed with}
+    """
+
+    def handle(self):
+        from maildown import sendlog
+
+        path = self.option("log") or sendlog.log_path()
+        try:
+            since = sendlog.parse_since(self.option("since")) if self.option("since") else None
+        except ValueError as e:
+            return self.line(str(e), "error")
+        try:
+            summaries = sendlog.summarise(path, self.argument("campaigns"), since)
+        except FileNotFoundError:
+            return self.line(f"No sends have been logged to {path}", "error")
+        if not summaries:
+            return self.line("No logged sends match", "comment")
+
+        rows = []
+        for summary in summaries.values():
+            percentiles = [
+                "-" if value is None else f"{value * 1000:.0f}" for value in summary.percentiles(50, 90, 99)
+            ]
+            rows.append(
+                [summary.campaign, str(summary.delivered), str(summary.failed), str(summary.suppressed)] + percentiles
+            )
+        self.render_table(
+            ["Campaign", "Delivered", "Failed", "Suppressed", "p50 ms", "p90 ms", "p99 ms"], rows
+        )
+
+        if self.option("errors"):
+            for summary in summaries.values():
+                if summary.errors:
+                    self.line(f"<comment>{summary.campaign}</comment>")
+                    for code, count in summary.errors.most_common():
+                        self.line(f"  {code}: {count}")
+
+
+class ResumeCommand(SendCommand):
+    """
+    Resumes an interrupted send job from the local queue, sending only to recipients who have not yet been sent to
+
+    resume
+        {job-id : The id of the job to resume}
+        {--w|workers=10 : The number of messages to send concurrently}
+        {--retry-failed : Also retry recipients whose message failed}
+        {--campaign=? : The name to log each message's outcome under, for `maildown report`. Defaults to the subject}
+        {--no-send-log : Don't log each message's outcome to the send log}
+        {--stats : Write the count, p50 and p99 time of each render and send phase when finished}
+        {--prometheus=? : Write render and send metrics to this file in the Prometheus text format}
+        {--trace=? : Write a JSON trace of every render and send phase to this file}
+    """
+
+    def send(self):
+        job_id = self.argument("job-id")
+        with jobs.SendQueue() as queue:
+            try:
+                job = queue.get_job(job_id)
+            except KeyError as e:
+                return self.line(str(e.args[0]), "error")
+
+            __backend = available_backends.get(job["backend"])
+            if not __backend:
+                return self.line(f'No backend called {job["backend"]} exists', "error")
 
-        backend.send(**kwargs)
-        self.info("Messages added to queue")
+            with self.send_log(self.option("campaign") or job["subject"]):
+                self.run_job(queue, job_id, __backend(), self.option("retry-failed"))
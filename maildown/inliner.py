@@ -0,0 +1,267 @@
+"""
+A css inliner which produces the same output as `premailer.transform`, but does the expensive work once per
+stylesheet rather than once per document. Each stylesheet is parsed with cssutils a single time, and turned into a
+list of rules which are already sorted by specificity, with their selectors compiled to XPath and their declarations
+split into property pairs. The style each element ends up with depends only on its existing inline style and the
+rules it matches, so that is worked out once per combination and reused
+"""
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import functools
+import re
+import threading
+import cssutils
+from lxml import etree
+from lxml.cssselect import CSSSelector
+import premailer
+from premailer.merge_style import csstext_to_pairs, merge_styles
+
+
+STYLESHEET_CACHE_SIZE = 32
+MERGED_CACHE_SIZE = 4096
+
+FILTER_PSEUDOSELECTORS = premailer.premailer.FILTER_PSEUDOSELECTORS
+
+_element_selector_regex = re.compile(r"(^|\s)\w")
+_importants = re.compile(r"\s*!important")
+_short_color_codes = re.compile(r"^#([0-9a-f])([0-9a-f])([0-9a-f])$", re.I)
+_simple_selector = re.compile(r"^\.?-?[_a-zA-Z][\w-]*$")
+_class_separators = re.compile(r"[ \t\n\r]+")
+
+_styles = etree.XPath("//style | //link")
+_head = CSSSelector("head")
+_body = CSSSelector("body")
+_floating_images = etree.XPath("//img[@style]")
+
+
+_merged: Dict[tuple, Tuple[str, Dict[str, str]]] = {}
+_merged_lock = threading.Lock()
+
+
+class Rule(NamedTuple):
+    specificity: Tuple[int, int, int, int, int]
+    selector: CSSSelector
+    pairs: Tuple[Tuple[str, str], ...]
+    pseudo_class: str
+    simple: Optional[str] = None
+
+
+def _format_properties(properties) -> str:
+    return ";".join(f"{prop.name}:{prop.value}" for prop in properties)
+
+
+def _leftover_css(leftover: list) -> str:
+    """
+    Writes out the rules which can't be inlined, such as pseudo classes and media queries, as premailer does
+    """
+    lines = []
+    for item in leftover:
+        if isinstance(item, tuple):
+            selector, bulk = item
+            lines.append("%s {%s}" % (selector, premailer.premailer.make_important(bulk)))
+            continue
+        for rule in item.cssRules:
+            if isinstance(rule, (cssutils.css.CSSComment, cssutils.css.CSSUnknownRule)):
+                continue
+            for key in rule.style.keys():
+                rule.style[key] = (rule.style.getPropertyValue(key, False), "!important")
+        lines.append(item.cssText)
+    return _importants.sub("", "\n".join(lines))
+
+
+class Stylesheet(object):
+    """
+    A parsed, compiled stylesheet, as premailer would apply it with its default options
+
+    ### Parameters:
+
+    - `css`: The text of the stylesheet
+    """
+
+    def __init__(self, css: str):
+        self.rules: List[Rule] = []
+        leftover: list = []
+
+        sheet = cssutils.parseString(css, validate=True) if css else []
+        for rule in sheet:
+            if rule.type == rule.MEDIA_RULE:
+                leftover.append(rule)
+                continue
+            if rule.type != rule.STYLE_RULE:
+                continue
+
+            properties = rule.style.getProperties()
+            normal = [prop for prop in properties if prop.priority != "important"]
+            important = [prop for prop in properties if prop.priority == "important"]
+            bulk_normal = _format_properties(normal)
+            bulk_important = _format_properties(important)
+            bulk_all = _format_properties(normal + important)
+
+            for selector in (s.strip() for s in rule.selectorText.split(",")):
+                if not selector or selector.startswith("@"):
+                    continue
+                if ":" in selector and ":" + selector.split(":", 1)[1] not in FILTER_PSEUDOSELECTORS:
+                    leftover.append((selector, bulk_all))
+                    continue
+                if "*" in selector or selector.startswith(":"):
+                    continue
+
+                pseudo_class = ""
+                match = selector
+                if ":" in selector:
+                    match, pseudo_class = selector.split(":", 1)
+                    pseudo_class = ":" + pseudo_class
+                if pseudo_class in FILTER_PSEUDOSELECTORS or pseudo_class.startswith(":nth-child"):
+                    pseudo_class = ""
+                    match = selector
+
+                counts = (selector.count("#"), selector.count("."), len(_element_selector_regex.findall(selector)))
+                for is_important, bulk in ((1, bulk_important), (0, bulk_normal)):
+                    if bulk:
+                        self.rules.append(
+                            Rule(
+                                (is_important,) + counts + (len(self.rules),),
+                                CSSSelector(match),
+                                tuple(csstext_to_pairs(bulk)),
+                                pseudo_class,
+                                match if _simple_selector.match(match) else None,
+                            )
+                        )
+
+        self.rules.sort(key=lambda rule: rule.specificity)
+        self.leftover = _leftover_css(leftover) if leftover else ""
+
+
+@functools.lru_cache(maxsize=STYLESHEET_CACHE_SIZE)
+def compile_stylesheet(css: str) -> Stylesheet:
+    return Stylesheet(css)
+
+
+def merged_style(inline_style: str, rules: Tuple[Rule, ...]) -> Tuple[str, Dict[str, str]]:
+    """
+    Returns the style attribute for an element with the given inline style which matches the given rules, in order of
+    specificity, along with the basic html attributes (e.g. `bgcolor`) which go with it. Most elements of a document
+    share a handful of combinations, so results are cached
+    """
+    key = (inline_style, rules)
+    merged = _merged.get(key)
+    if merged is None:
+        style = merge_styles(
+            inline_style,
+            [rule.pairs for rule in rules],
+            [rule.pseudo_class for rule in rules],
+            remove_unset_properties=True,
+        )
+        merged = (style, basic_attributes(style))
+        with _merged_lock:
+            if len(_merged) >= MERGED_CACHE_SIZE:
+                _merged.clear()
+            _merged[key] = merged
+    return merged
+
+
+def basic_attributes(style: str) -> Dict[str, str]:
+    """
+    Returns the html attributes premailer adds for a style, for email clients which ignore css, e.g. `bgcolor` for
+    `background-color`
+    """
+    if style.count("}") and style.count("{") == style.count("}"):
+        style = style.split("}")[0][1:]
+
+    attributes: Dict[str, str] = {}
+    for declaration in style.split(";"):
+        parts = declaration.split(":")
+        if len(parts) != 2:
+            continue
+        key, value = parts[0].strip(), parts[1].strip()
+        if key == "text-align":
+            attributes["align"] = value
+        elif key == "vertical-align":
+            attributes["valign"] = value
+        elif key == "background-color" and "transparent" not in value.lower():
+            attributes["bgcolor"] = _short_color_codes.sub(r"#\1\1\2\2\3\3", value)
+        elif key in ("width", "height"):
+            attributes[key] = value[:-2] if value.endswith("px") else value
+    return attributes
+
+
+def _index(page) -> Dict[str, list]:
+    """
+    Returns the elements of a document keyed by tag name and by `.class`, in document order. Looking rules with a
+    single tag or class selector up in this is much quicker than running each of their XPath queries over the whole
+    document, which matters for large themes
+    """
+    index: Dict[str, list] = {}
+    for item in page.iter():
+        if not isinstance(item.tag, str):
+            continue
+        index.setdefault(item.tag, []).append(item)
+        classes = item.get("class")
+        if classes:
+            for name in dict.fromkeys(_class_separators.split(classes.strip(" \t\n\r"))):
+                index.setdefault("." + name, []).append(item)
+    return index
+
+
+def transform(html: str) -> str:
+    """
+    Inlines the css of an html document's `<style>` elements, and returns the result. This is a drop in replacement
+    for `premailer.transform(html)`. Documents which rely on premailer features this module doesn't implement, such as
+    external stylesheets, are handed to premailer itself
+    """
+    stripped = html.strip()
+    tree = etree.fromstring(stripped, etree.HTMLParser()).getroottree()
+    page = tree.getroot()
+    root = tree if stripped.startswith(tree.docinfo.doctype) else page
+
+    elements = _styles(page)
+    if any(element.tag == "link" or element.attrib for element in elements):
+        return premailer.transform(html)
+
+    if not _head(tree):
+        body = _body(tree)[0]
+        body.getparent().insert(0, etree.Element("head"))
+
+    sheets: List[Stylesheet] = []
+    for element in elements:
+        sheet = compile_stylesheet(element.text or "")
+        sheets.append(sheet)
+        if sheet.leftover:
+            element.text = sheet.leftover
+        else:
+            element.getparent().remove(element)
+
+    if len(sheets) == 1:
+        rules = sheets[0].rules
+    else:
+        ordered = sorted(
+            ((rule.specificity[:4] + (index, rule.specificity[4]), rule)
+             for index, sheet in enumerate(sheets)
+             for rule in sheet.rules),
+            key=lambda pair: pair[0],
+        )
+        rules = [rule for _, rule in ordered]
+
+    index = _index(page)
+    matched: Dict[int, Tuple[etree._Element, List[Rule]]] = {}
+    for rule in rules:
+        items = index.get(rule.simple, ()) if rule.simple else rule.selector(page)
+        for item in items:
+            key = id(item)
+            if key not in matched:
+                matched[key] = (item, [])
+            matched[key][1].append(rule)
+
+    for item, item_rules in matched.values():
+        style, attributes = merged_style(item.attrib.get("style", ""), tuple(item_rules))
+        if style:
+            item.attrib["style"] = style
+        for name, value in attributes.items():
+            item.attrib[name] = value
+
+    for item in _floating_images(page):
+        if "float" in item.attrib["style"]:
+            image_float = cssutils.parseStyle(item.attrib["style"]).float
+            if image_float in ("left", "right"):
+                item.attrib["align"] = image_float
+
+    return etree.tostring(root, method="html", pretty_print=False, encoding="utf-8").decode("utf-8")
@@ -0,0 +1,334 @@
+"""
+Timing hooks for the render and send pipeline. Code which does something worth measuring wraps it in `span`, and
+one-off occurrences such as throttles are reported with `event`. Each finished span or event is passed to every
+installed hook. When no hooks are installed, `span` returns a shared do-nothing context manager, so instrumentation
+costs almost nothing unless something is listening
+
+Three exporters are included: `LogExporter`, `PrometheusExporter` and `JsonTraceExporter`. Install them with
+`add_hook`, or for the length of a block with `recording`
+"""
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+import contextlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+
+RESERVOIR_SIZE = 10000
+QUANTILES = (0.5, 0.9, 0.99)
+
+logger = logging.getLogger(__name__)
+
+
+class Span(NamedTuple):
+    name: str
+    start: float
+    duration: Optional[float]
+    labels: Dict[str, Any]
+    error: Optional[str] = None
+    thread: int = 0
+
+
+Hook = Callable[[Span], None]
+
+_hooks: List[Hook] = []
+
+
+def add_hook(hook: Hook) -> None:
+    global _hooks
+    _hooks = _hooks + [hook]
+
+
+def remove_hook(hook: Hook) -> None:
+    global _hooks
+    _hooks = [h for h in _hooks if h is not hook]
+
+
+def enabled() -> bool:
+    return bool(_hooks)
+
+
+def emit(span: Span) -> None:
+    for hook in _hooks:
+        try:
+            hook(span)
+        except Exception:
+            logger.exception(f"Instrumentation hook {hook!r} failed")
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer(object):
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: Dict[str, Any]):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        error = exc_type.__name__ if exc_type else None
+        emit(Span(self.name, self.start, duration, self.labels, error, threading.get_ident()))
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, **labels):
+    """
+    Returns a context manager which times its block and reports it as a span called `name`. If the block raises, the
+    span records the exception's type as its error
+
+    ### Parameters:
+
+    - `name`: The name of the span, e.g. `render.markdown`
+    - `labels`: Extra dimensions to report the span under, e.g. `region="eu-west-1"`. Keep these low cardinality
+    """
+    if not _hooks:
+        return _NULL_SPAN
+    return _Timer(name, labels)
+
+
+def event(name: str, **labels) -> None:
+    """
+    Reports something which happened at a point in time, such as a throttled request, rather than took time
+    """
+    if _hooks:
+        emit(Span(name, time.perf_counter(), None, labels, None, threading.get_ident()))
+
+
+@contextlib.contextmanager
+def recording(*hooks):
+    """
+    Installs the given hooks for the length of a `with` block, then removes them and calls `close` on any that have
+    it, so exporters write out what they collected
+    """
+    for hook in hooks:
+        add_hook(hook)
+    try:
+        yield
+    finally:
+        for hook in hooks:
+            remove_hook(hook)
+            if hasattr(hook, "close"):
+                hook.close()
+
+
+class Series(object):
+    """
+    The durations and error count of one span name and set of labels. At most `RESERVOIR_SIZE` durations are kept, as
+    a uniform random sample, so quantiles stay cheap and memory stays flat however many spans are recorded
+    """
+
+    def __init__(self, reservoir: int = RESERVOIR_SIZE):
+        self.reservoir = reservoir
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.samples: List[float] = []
+        self._sorted = True
+
+    def add(self, span: Span) -> None:
+        self.count += 1
+        if span.error:
+            self.errors += 1
+        if span.duration is None:
+            return
+        self.total += span.duration
+        if len(self.samples) < self.reservoir:
+            self.samples.append(span.duration)
+        else:
+            index = random.randrange(self.count)
+            if index < self.reservoir:
+                self.samples[index] = span.duration
+        self._sorted = False
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        if not self._sorted:
+            self.samples.sort()
+            self._sorted = True
+        return self.samples[min(int(q * len(self.samples)), len(self.samples) - 1)]
+
+
+SeriesKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Metrics(object):
+    """
+    A hook which aggregates spans into a `Series` per span name and set of labels
+    """
+
+    def __init__(self, reservoir: int = RESERVOIR_SIZE):
+        self.reservoir = reservoir
+        self.series: Dict[SeriesKey, Series] = {}
+        self.events: Dict[SeriesKey, int] = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, span: Span) -> None:
+        key = (span.name, tuple(sorted((k, str(v)) for k, v in span.labels.items())))
+        with self.lock:
+            if span.duration is None:
+                self.events[key] = self.events.get(key, 0) + 1
+                return
+            if key not in self.series:
+                self.series[key] = Series(self.reservoir)
+            self.series[key].add(span)
+
+    def get(self, name: str, **labels) -> Optional[Series]:
+        return self.series.get((name, tuple(sorted((k, str(v)) for k, v in labels.items()))))
+
+    def close(self) -> None:
+        pass
+
+
+def _describe(key: SeriesKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "[" + ",".join(f"{k}={v}" for k, v in labels) + "]"
+
+
+class LogExporter(Metrics):
+    """
+    Writes one summary line per span, with its count, p50, p99 and error count, when closed
+
+    ### Parameters:
+
+    - `write`: Called with each line. Defaults to logging at `INFO` level
+    """
+
+    def __init__(self, write: Optional[Callable[[str], Any]] = None, reservoir: int = RESERVOIR_SIZE):
+        super().__init__(reservoir)
+        self.write = write or logger.info
+
+    def lines(self) -> List[str]:
+        with self.lock:
+            lines = [
+                f"{_describe(key)}: {series.count} calls, p50 {series.quantile(0.5) * 1000:.2f} ms, "
+                f"p99 {series.quantile(0.99) * 1000:.2f} ms, {series.errors} errors"
+                for key, series in sorted(self.series.items())
+            ]
+            lines.extend(f"{_describe(key)}: {count} times" for key, count in sorted(self.events.items()))
+        return lines
+
+    def close(self) -> None:
+        for line in self.lines():
+            self.write(line)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class PrometheusExporter(Metrics):
+    """
+    Writes spans to a file in the Prometheus text exposition format, e.g. for node_exporter's textfile collector.
+    Durations are written as a summary with p50, p90 and p99 quantiles, and errors and events as counters. The file is
+    replaced atomically each time `flush` is called, and when closed
+
+    ### Parameters:
+
+    - `path`: The file to write
+    - `prefix`: The prefix of each metric name
+    """
+
+    def __init__(self, path: str, prefix: str = "maildown", reservoir: int = RESERVOIR_SIZE):
+        super().__init__(reservoir)
+        self.path = path
+        self.prefix = prefix
+
+    def render(self) -> str:
+        seconds = f"{self.prefix}_span_seconds"
+        errors = f"{self.prefix}_span_errors_total"
+        events = f"{self.prefix}_events_total"
+        lines = [f"# TYPE {seconds} summary"]
+        with self.lock:
+            for (name, labels), series in sorted(self.series.items()):
+                base = dict(labels, span=name)
+                for q in QUANTILES:
+                    lines.append(f"{seconds}{_prometheus_labels(dict(base, quantile=str(q)))} {series.quantile(q)}")
+                lines.append(f"{seconds}_sum{_prometheus_labels(base)} {series.total}")
+                lines.append(f"{seconds}_count{_prometheus_labels(base)} {series.count}")
+            lines.append(f"# TYPE {errors} counter")
+            for (name, labels), series in sorted(self.series.items()):
+                lines.append(f"{errors}{_prometheus_labels(dict(labels, span=name))} {series.errors}")
+            lines.append(f"# TYPE {events} counter")
+            for (name, labels), count in sorted(self.events.items()):
+                lines.append(f"{events}{_prometheus_labels(dict(labels, event=name))} {count}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        with open(fd, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+
+    def close(self) -> None:
+        self.flush()
+
+
+class JsonTraceExporter(object):
+    """
+    Writes every span to a file in the Chrome trace event format, which can be opened in `chrome://tracing` or
+    Perfetto to see each phase of each message on a timeline. Spans are written out as they finish, so memory use
+    stays flat however long the trace is
+
+    ### Parameters:
+
+    - `path`: The file to write
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "w")
+        self.file.write("[\n")
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.first = True
+
+    def __call__(self, span: Span) -> None:
+        trace_event: Dict[str, Any] = dict(
+            name=span.name,
+            cat=span.name.split(".")[0],
+            ts=round((span.start - self.origin) * 1e6, 3),
+            pid=self.pid,
+            tid=span.thread,
+            args=dict(span.labels, error=span.error) if span.error else span.labels,
+        )
+        if span.duration is None:
+            trace_event.update(ph="i", s="t")
+        else:
+            trace_event.update(ph="X", dur=round(span.duration * 1e6, 3))
+        line = json.dumps(trace_event, default=str)
+        with self.lock:
+            self.file.write(line if self.first else ",\n" + line)
+            self.first = False
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.file.closed:
+                self.file.write("\n]\n")
+                self.file.close()
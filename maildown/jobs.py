@@ -0,0 +1,234 @@
+from typing import Any, Dict, Iterable, Iterator, Optional, TYPE_CHECKING
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+if TYPE_CHECKING:  # pragma: no cover
+    from maildown.backends.base import SendResult
+
+
+PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    backend TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    content TEXT NOT NULL,
+    theme TEXT,
+    context TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    job_id TEXT NOT NULL REFERENCES jobs(id),
+    key TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    variables TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    message_id TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, key)
+);
+CREATE INDEX IF NOT EXISTS messages_status ON messages (job_id, status);
+"""
+
+
+def queue_path() -> str:
+    """
+    Returns the location of the local send queue database
+    """
+    return os.path.join(os.path.expanduser("~"), ".maildown", "queue.db")
+
+
+def idempotency_key(job_id: str, email: str) -> str:
+    """
+    Returns the key which identifies a recipient's message within a job. Each recipient is only ever queued once
+    per job, however many times they are added
+    """
+    return hashlib.sha256(f"{job_id}:{email.strip().lower()}".encode("utf-8")).hexdigest()
+
+
+class SendQueue(object):
+    """
+    A persistent queue of send jobs, kept in a SQLite database in WAL mode. A job holds everything needed to render
+    its message, and has one row per recipient recording whether that recipient's message has been sent. Each result
+    is checkpointed as soon as it comes back, so an interrupted job can be resumed without resending to anyone who
+    has already received it. A message which was in flight when the process died may be sent again on resume.
+    Rendering isn't queued as jobs of its own: each recipient's message is rendered by the worker which sends it, just
+    before it is sent, so a resumed job renders only the messages it still has to send
+
+    ### Parameters:
+
+    - `path`: The location of the database. Defaults to `~/.maildown/queue.db`
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or queue_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def create_job(
+        self,
+        backend: str,
+        sender: str,
+        subject: str,
+        content: str,
+        theme: Optional[str] = None,
+        context: Optional[dict] = None,
+    ) -> str:
+        """
+        Creates a new job and returns its id. The theme's path is stored as an absolute path, so the job can be
+        resumed from any directory
+        """
+        job_id = uuid.uuid4().hex[:12]
+        if theme:
+            theme = os.path.abspath(theme)
+        with self.db:
+            self.db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued')",
+                (job_id, time.time(), backend, sender, subject, content, theme, json.dumps(context or {})),
+            )
+        return job_id
+
+    def get_job(self, job_id: str) -> Dict[str, Any]:
+        row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            raise KeyError(f"No job with id {job_id} exists")
+        job = dict(row)
+        job["context"] = json.loads(job["context"])
+        return job
+
+    def set_status(self, job_id: str, status: str) -> None:
+        with self.db:
+            self.db.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+
+    def enqueue(self, job_id: str, recipients: Iterable[Dict[str, Any]]) -> int:
+        """
+        Adds recipients to a job, in batches of `PAGE_SIZE` per transaction. Recipients already in the job are
+        ignored. Returns the number of recipients added
+        """
+        added = 0
+        batch = []
+        for recipient in recipients:
+            batch.append(
+                (job_id, idempotency_key(job_id, recipient["email"]), recipient["email"], json.dumps(recipient))
+            )
+            if len(batch) >= PAGE_SIZE:
+                added += self._insert(batch)
+                batch = []
+        if batch:
+            added += self._insert(batch)
+        return added
+
+    def _insert(self, batch: list) -> int:
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT OR IGNORE INTO messages (job_id, key, recipient, variables) VALUES (?, ?, ?, ?)", batch
+            )
+            return self.db.total_changes - before
+
+    def pending(self, job_id: str, retry_failed: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily yields the recipients of a job which still need to be sent to, a page at a time. Each recipient has an
+        extra `_key` entry holding its idempotency key
+        """
+        status = "status IN ('pending', 'failed')" if retry_failed else "status = 'pending'"
+        last = 0
+        while True:
+            rows = self.db.execute(
+                "SELECT rowid, key, variables FROM messages "
+                f"WHERE job_id = ? AND {status} AND rowid > ? ORDER BY rowid LIMIT ?",
+                (job_id, last, PAGE_SIZE),
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(json.loads(row["variables"]), _key=row["key"])
+            last = rows[-1]["rowid"]
+
+    def checkpoint(
+        self,
+        job_id: str,
+        key: str,
+        message_id: Optional[str] = None,
+        error: Optional[str] = None,
+        status: Optional[str] = None,
+    ) -> None:
+        """
+        Records the result of sending one message. The status is `failed` if there is an error, and `sent` otherwise,
+        unless another is given
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE messages SET status = ?, message_id = ?, error = ?, attempts = attempts + 1 "
+                "WHERE job_id = ? AND key = ?",
+                (status or ("failed" if error else "sent"), message_id, error, job_id, key),
+            )
+
+    def counts(self, job_id: str) -> Dict[str, int]:
+        """
+        Returns the number of messages in a job with each status
+        """
+        rows = self.db.execute(
+            "SELECT status, COUNT(*) FROM messages WHERE job_id = ? GROUP BY status", (job_id,)
+        ).fetchall()
+        return dict(dict(pending=0, sent=0, failed=0), **{status: count for status, count in rows})
+
+
+def run_job(
+    queue: SendQueue, job_id: str, backend, workers: int, retry_failed: bool = False
+) -> Iterator["SendResult"]:
+    """
+    Sends the outstanding messages of a job with `backend.iter_send_many`, checkpointing each result as it comes
+    back. Yields each `SendResult`. Recipients on the suppression list are recorded as `suppressed`, and aren't
+    retried
+    """
+    from maildown.backends.base import Suppressed
+
+    job = queue.get_job(job_id)
+    queue.set_status(job_id, "running")
+    keys: Dict[str, str] = {}
+
+    def recipients():
+        for recipient in queue.pending(job_id, retry_failed):
+            keys[recipient["email"]] = recipient.pop("_key")
+            yield recipient
+
+    for result in backend.iter_send_many(
+        job["sender"],
+        job["subject"],
+        recipients(),
+        content=job["content"],
+        context=job["context"],
+        theme=job["theme"],
+        workers=workers,
+    ):
+        message_id = None
+        if isinstance(result.response, dict):
+            message_id = result.response.get("MessageId")
+        error = f"{type(result.error).__name__}: {result.error}" if result.error else None
+        status = "suppressed" if isinstance(result.error, Suppressed) else None
+        queue.checkpoint(job_id, keys.pop(result.recipient), message_id, error, status)
+        yield result
+
+    queue.set_status(job_id, "done" if not queue.counts(job_id)["pending"] else "queued")
@@ -0,0 +1,268 @@
+"""
+Builds raw MIME messages for campaigns which send the same attachments and inline images to every recipient. The
+parts which are the same for every message are encoded once, when a `RawMessage` is created, and each recipient's
+message is made by joining its own headers and html/text part to those ready made bytes. Attachments are base64
+encoded straight from a memory map of the file, a chunk at a time, so they never need to be held in memory twice
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+import base64
+import email.header
+import email.utils
+import functools
+import html as html_module
+import mimetypes
+import mmap
+import os
+import re
+import urllib.parse
+import uuid
+
+
+LINE_LENGTH = 76
+CHUNK_SIZE = 57 * 1024  # a whole number of base64 lines
+ATTACHMENT_CACHE_SIZE = 8
+CRLF = b"\r\n"
+
+_image_sources = re.compile(r"""<img\b[^>]*?\bsrc\s*=\s*(["'])(.*?)\1""", re.I | re.S)
+_scheme = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:|^//")
+_alternative_marker = b"\0maildown-alternative\0"
+
+
+def encode_base64(data) -> bytes:
+    """
+    Base64 encodes a bytes-like object, e.g. a memory map, a chunk at a time, into lines of `LINE_LENGTH` characters
+    separated by CRLFs, as MIME requires
+    """
+    view = memoryview(data)
+    lines: List[bytes] = []
+    for start in range(0, len(view), CHUNK_SIZE):
+        encoded = base64.b64encode(view[start:start + CHUNK_SIZE])
+        lines.extend(encoded[i:i + LINE_LENGTH] for i in range(0, len(encoded), LINE_LENGTH))
+    lines.append(b"")
+    return CRLF.join(lines)
+
+
+@functools.lru_cache(maxsize=ATTACHMENT_CACHE_SIZE)
+def _encode_file(path: str, mtime: int, size: int) -> bytes:
+    if not size:
+        return b""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return encode_base64(data)
+
+
+def encode_file(path: str) -> bytes:
+    """
+    Returns the base64 encoding of a file, read through a memory map. The most recently used files are cached, keyed
+    on their path, modification time and size, so a file sent in several campaigns is only encoded once
+    """
+    stat = os.stat(path)
+    return _encode_file(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _is_ascii(value: str) -> bool:
+    try:
+        value.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def encode_header(value: str) -> str:
+    """
+    Returns a header value which is safe to send: line breaks are removed, and anything which isn't ASCII is encoded
+    as an RFC 2047 encoded word
+    """
+    value = " ".join(value.splitlines())
+    if _is_ascii(value):
+        return value
+    return email.header.Header(value, "utf-8").encode()
+
+
+def encode_address(address: str) -> str:
+    name, addr = email.utils.parseaddr(" ".join(address.splitlines()))
+    return email.utils.formataddr((name, addr), charset="utf-8")
+
+
+def _filename(name: str) -> str:
+    if _is_ascii(name) and '"' not in name and "\\" not in name:
+        return f'filename="{name}"'
+    return f"filename*=utf-8''{urllib.parse.quote(name)}"
+
+
+def part(content_type: str, body: bytes, *headers: str) -> bytes:
+    """
+    Returns a base64 encoded MIME part, with its headers
+    """
+    lines = [f"Content-Type: {content_type}", "Content-Transfer-Encoding: base64", *headers]
+    return "\r\n".join(lines).encode("ascii") + CRLF + CRLF + body
+
+
+def multipart(subtype: str, parts: Iterable[bytes]) -> Tuple[str, bytes]:
+    """
+    Returns the Content-Type header value and the body of a multipart part. Boundaries start with `=_`, which can't
+    appear in base64, so they can't clash with the parts' contents
+    """
+    boundary = f"=_{uuid.uuid4().hex}"
+    delimiter = b"--" + boundary.encode("ascii")
+    body = b"".join(delimiter + CRLF + item + CRLF for item in parts) + delimiter + b"--" + CRLF
+    return f'multipart/{subtype}; boundary="{boundary}"', body
+
+
+def find_images(html: str, base_dir: Optional[str] = None, confine: bool = False) -> Dict[str, str]:
+    """
+    Returns the local image files used by an html document, keyed by their `src` attribute as it appears in the
+    document. Relative paths are relative to `base_dir`, or the working directory. Remote images, data URIs and
+    images which don't exist are left out. If `confine` is true, so are images outside `base_dir`, and every local
+    image if there is no `base_dir`
+    """
+    images: Dict[str, str] = {}
+    if confine and not base_dir:
+        return images
+    for match in _image_sources.finditer(html):
+        src = match.group(2)
+        if not src or _scheme.match(src) or src in images:
+            continue
+        path = os.path.join(base_dir or os.getcwd(), urllib.parse.unquote(html_module.unescape(src)))
+        if confine and not is_within(path, base_dir):  # type: ignore
+            continue
+        if os.path.isfile(path):
+            images[src] = path
+    return images
+
+
+def is_within(path: str, directory: str) -> bool:
+    """
+    Returns True if `path` is inside `directory`, once symbolic links and `..`s have been resolved
+    """
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([directory, os.path.realpath(path)]) == directory
+
+
+class RawMessage(object):
+    """
+    The shared parts of a campaign's raw MIME messages, encoded once. `build` then makes each recipient's message
+    from its own headers and html, joined to the ready made bytes of everything else. The html and text part is
+    also reused from the last message built when its html and text are the same, which is the case whenever a
+    message isn't personalised
+
+    ### Parameters:
+
+    - `attachments`: Paths to files to attach to every message
+    - `images`: Local images to embed in every message, keyed by their `src` in the html - see `find_images`. They
+    are sent as related parts, and their `src`s rewritten to `cid:` URLs
+    """
+
+    def __init__(self, attachments: Iterable[str] = (), images: Optional[Dict[str, str]] = None):
+        self.images: Dict[str, str] = {}
+        image_parts = []
+        for src, path in (images or {}).items():
+            cid = f"{uuid.uuid4().hex}@maildown"
+            self.images[src] = cid
+            name = os.path.basename(path)
+            image_parts.append(
+                part(
+                    mimetypes.guess_type(name)[0] or "application/octet-stream",
+                    encode_file(path),
+                    f"Content-ID: <{cid}>",
+                    f"Content-Disposition: inline; {_filename(name)}",
+                )
+            )
+
+        attachment_parts = []
+        for path in attachments:
+            name = os.path.basename(path)
+            attachment_parts.append(
+                part(
+                    mimetypes.guess_type(name)[0] or "application/octet-stream",
+                    encode_file(path),
+                    f"Content-Disposition: attachment; {_filename(name)}",
+                )
+            )
+
+        body = _alternative_marker
+        content_type = ""
+        if image_parts:
+            content_type, body = multipart("related", [body, *image_parts])
+        if attachment_parts:
+            if content_type:
+                body = f"Content-Type: {content_type}".encode("ascii") + CRLF + CRLF + body
+            content_type, body = multipart("mixed", [body, *attachment_parts])
+
+        if content_type:
+            self.content_type = content_type
+            self.prefix, self.suffix = body.split(_alternative_marker)
+        else:
+            self.content_type = ""
+            self.prefix = self.suffix = b""
+
+        self._last: Tuple[Optional[str], Optional[str], bytes] = (None, None, b"")
+
+    @property
+    def shared_size(self) -> int:
+        """
+        The number of bytes each message reuses rather than encoding again
+        """
+        return len(self.prefix) + len(self.suffix)
+
+    def alternative(self, html: str, content: str) -> bytes:
+        """
+        Returns the multipart/alternative part holding the text and html versions of a message, with its headers
+        """
+        last_html, last_content, encoded = self._last
+        if html == last_html and content == last_content:
+            return encoded
+
+        content_type, body = multipart(
+            "alternative",
+            [
+                part('text/plain; charset="utf-8"', encode_base64(content.encode("utf-8"))),
+                part('text/html; charset="utf-8"', encode_base64(html.encode("utf-8"))),
+            ],
+        )
+        encoded = f"Content-Type: {content_type}".encode("ascii") + CRLF + CRLF + body
+        self._last = (html, content, encoded)
+        return encoded
+
+    def build(self, to: list, sender: str, subject: str, html: str, content: str) -> bytes:
+        """
+        Returns a recipient's complete message, ready to be sent
+        """
+        for src, cid in self.images.items():
+            html = html.replace(f'src="{src}"', f'src="cid:{cid}"').replace(f"src='{src}'", f"src='cid:{cid}'")
+
+        alternative = self.alternative(html, content)
+        headers = [
+            f"From: {encode_address(sender)}",
+            f"To: {', '.join(encode_address(address) for address in to)}",
+            f"Subject: {encode_header(subject)}",
+            f"Date: {email.utils.formatdate()}",
+            "MIME-Version: 1.0",
+        ]
+        if not self.content_type:
+            return "\r\n".join(headers).encode("utf-8") + CRLF + alternative
+
+        headers.append(f"Content-Type: {self.content_type}")
+        return b"".join(
+            ("\r\n".join(headers).encode("utf-8"), CRLF, CRLF, self.prefix, alternative, self.suffix)
+        )
+
+
+def campaign(
+    html: str, attachments: Optional[Iterable[str]] = None, base_dir: Optional[str] = None, confine: bool = False
+) -> Optional[RawMessage]:
+    """
+    Returns a `RawMessage` for a campaign's attachments and the local images in its html, or None if it has neither,
+    so can be sent as a plain html and text message
+
+    ### Parameters:
+
+    - `html`: The campaign's html, or the source of its template
+    - `attachments`: Paths to files to attach to every message
+    - `base_dir`: The directory relative image paths are relative to. Defaults to the working directory
+    - `confine`: Only use images inside `base_dir` - see `find_images`
+    """
+    attachments = list(attachments or ())
+    images = find_images(html, base_dir, confine) if "<img" in html else {}
+    if not attachments and not images:
+        return None
+    return RawMessage(attachments, images)
@@ -0,0 +1,259 @@
+"""
+Builds complete messages and writes them to files rather than sending them, for `maildown send --dry-run`. Messages
+go through the same rendering and MIME building as a real send, and can be written to an mbox file, a directory of
+`.eml` files, or a JSON lines file (gzip compressed if its name ends in `.gz`). Writes are collected in memory and
+made in blocks of `BUFFER_SIZE` bytes, and messages can be rendered in several processes at once
+"""
+from typing import IO, Deque, Iterable, Iterator, List, Optional, Tuple
+import collections
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from concurrent import futures
+from maildown import recipients as recipients_module
+
+
+BUFFER_SIZE = 1024 * 1024
+CHUNK_SIZE = 100
+COMPRESS_LEVEL = 6
+FORMATS = ("mbox", "eml", "jsonl")
+
+_from_line = re.compile(rb"^(>*From )", re.M)
+_unsafe = re.compile(r"[^\w.@+-]")
+
+Built = Tuple[str, Optional[bytes], Optional[Exception]]
+
+
+def guess_format(path: str) -> str:
+    """
+    Returns the format to write messages to `path` in: `mbox` for a `.mbox` file, `jsonl` for a `.jsonl` or `.gz`
+    file, or `eml` for a directory, or a path without an extension
+    """
+    name = path.lower()
+    if name.endswith(".mbox"):
+        return "mbox"
+    if name.endswith((".jsonl", ".gz")):
+        return "jsonl"
+    if os.path.isdir(path) or path.endswith(os.sep) or not os.path.splitext(name)[1]:
+        return "eml"
+    raise ValueError(f"Can't tell what to write to {path} - give a .mbox, .jsonl or .jsonl.gz file, or a directory")
+
+
+class Writer(object):
+    """
+    Writes messages to a stream, in blocks of at least `BUFFER_SIZE` bytes. Safe to use from several threads at once
+
+    ### Parameters:
+
+    - `stream`: The binary file to write to, which is closed with the writer
+    """
+
+    def __init__(self, stream: Optional[IO[bytes]] = None):
+        self.stream = stream
+        self.count = 0
+        self._pending: List[bytes] = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def encode(self, recipient: str, message: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def write(self, recipient: str, message: bytes) -> int:
+        """
+        Adds a message to the output, and returns its number, counting from 1
+        """
+        data = self.encode(recipient, message)
+        with self._lock:
+            self.count += 1
+            self._pending.append(data)
+            self._size += len(data)
+            if self._size >= BUFFER_SIZE:
+                self._flush()
+            return self.count
+
+    def _flush(self) -> None:
+        if self._pending and self.stream is not None:
+            self.stream.write(b"".join(self._pending))
+        self._pending.clear()
+        self._size = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            if self.stream is not None:
+                self.stream.close()
+
+
+class MboxWriter(Writer):
+    """
+    Writes messages to an mbox file, in the mboxrd format: each message starts with a `From ` line, any line of a
+    message which starts with `From `, after any number of `>`s, is quoted with another `>`, and lines end with `\\n`
+    """
+
+    def __init__(self, path: str):
+        super().__init__(open(path, "wb"))
+        self.separator = f"From maildown {time.asctime()}\n".encode("ascii")
+
+    def encode(self, recipient: str, message: bytes) -> bytes:
+        body = _from_line.sub(rb">\1", message.replace(b"\r\n", b"\n"))
+        return self.separator + body + (b"\n" if body.endswith(b"\n") else b"\n\n")
+
+
+class JsonlWriter(Writer):
+    """
+    Writes each message as a line of JSON, `{"recipient", "message"}`. If the path ends in `.gz` the file is gzip
+    compressed, at `COMPRESS_LEVEL`
+    """
+
+    def __init__(self, path: str):
+        if path.lower().endswith(".gz"):
+            super().__init__(gzip.open(path, "wb", compresslevel=COMPRESS_LEVEL))  # type: ignore
+        else:
+            super().__init__(open(path, "wb"))
+
+    def encode(self, recipient: str, message: bytes) -> bytes:
+        return json.dumps(dict(recipient=recipient, message=message.decode("utf-8"))).encode("utf-8") + b"\n"
+
+
+class EmlWriter(Writer):
+    """
+    Writes each message to a `.eml` file of its own in a directory, named after its number and recipient
+    """
+
+    def __init__(self, directory: str):
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def write(self, recipient: str, message: bytes) -> int:
+        with self._lock:
+            self.count += 1
+            number = self.count
+        with open(os.path.join(self.directory, f"{number:08d}-{_unsafe.sub('_', recipient)}.eml"), "wb") as f:
+            f.write(message)
+        return number
+
+
+def open_writer(path: str, format: Optional[str] = None) -> Writer:
+    """
+    Returns a writer for messages to `path`, in the given format, or the one `guess_format` picks
+    """
+    format = format or guess_format(path)
+    if format == "mbox":
+        return MboxWriter(path)
+    if format == "jsonl":
+        return JsonlWriter(path)
+    if format == "eml":
+        return EmlWriter(path)
+    raise ValueError(f"Unknown output format {format}: use one of {', '.join(FORMATS)}")
+
+
+class Campaign(object):
+    """
+    Builds each recipient's complete message for a campaign. The content is compiled, and the shared MIME parts
+    encoded, once
+
+    ### Parameters:
+
+    - `sender`: the email address to send the message from
+    - `subject`: The subject line of the email
+    - `content`: The content of the email
+    - `context`: Context shared by every message
+    - `theme`: A local file path to a css style sheet. If not supplied, the default style is used
+    - `attachments`: Paths to files to attach to every message
+    - `base_dir`: The directory relative image paths are relative to
+    - `sandbox`: Treat the content as untrusted - see `BaseBackend.iter_send_many`
+    """
+
+    def __init__(
+        self,
+        sender: str,
+        subject: str,
+        content: str,
+        context: Optional[dict] = None,
+        theme: Optional[str] = None,
+        attachments: Optional[List[str]] = None,
+        base_dir: Optional[str] = None,
+        sandbox: bool = False,
+    ):
+        from maildown import mime, templates
+
+        self.sender = sender
+        self.subject = subject
+        self.content = content
+        self.context = context or {}
+        self.compiled = templates.compile_content(content, theme=theme)
+        if sandbox:
+            self.compiled = self.compiled.sandboxed()
+        self.raw = mime.campaign(self.compiled.source, attachments, base_dir, sandbox) or mime.RawMessage()
+
+    def build(self, recipients: Iterable[dict]) -> List[Built]:
+        """
+        Returns `(email, message, error)` for each recipient
+        """
+        built: List[Built] = []
+        for recipient in recipients:
+            email = recipient["email"]
+            try:
+                html = self.compiled.render(dict(self.context, **recipient))
+                built.append((email, self.raw.build([email], self.sender, self.subject, html, self.content), None))
+            except Exception as e:
+                built.append((email, None, e))
+        return built
+
+
+# The campaign a worker process is building, and the arguments it was made from
+_campaign: Optional[Tuple[tuple, Campaign]] = None
+
+
+def _build(args: tuple, recipients: List[dict]) -> List[Built]:
+    # Runs in a worker process, which compiles the campaign when it is given its first chunk
+    global _campaign
+    if _campaign is None or _campaign[0] != args:
+        _campaign = (args, Campaign(*args))
+    return _campaign[1].build(recipients)
+
+
+def build_messages(
+    sender: str,
+    subject: str,
+    recipients: Iterable[dict],
+    content: str,
+    context: Optional[dict] = None,
+    theme: Optional[str] = None,
+    attachments: Optional[List[str]] = None,
+    base_dir: Optional[str] = None,
+    processes: Optional[int] = None,
+    sandbox: bool = False,
+) -> Iterator[Built]:
+    """
+    Lazily builds each recipient's message, and yields `(email, message, error)` in the order of `recipients`. With
+    more than one process, recipients are rendered in chunks of `CHUNK_SIZE` by a pool of worker processes, each of
+    which compiles the campaign once, for its first chunk. At most two chunks per process are in flight at once, so
+    memory use stays flat however many recipients there are. The other parameters are those of `Campaign`
+    """
+    args = (sender, subject, content, context, theme, attachments, base_dir, sandbox)
+    chunks = recipients_module.chunked(recipients, CHUNK_SIZE)
+    if not processes or processes <= 1:
+        campaign = Campaign(*args)
+        for chunk in chunks:
+            yield from campaign.build(chunk)
+        return
+
+    with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        pending: Deque[futures.Future] = collections.deque()
+        for chunk in chunks:
+            if len(pending) >= processes * 2:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(_build, args, chunk))
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,194 @@
+"""
+Live previews of an email while it is being written. The markdown, theme, local template and context files are
+polled for changes, and the email is rendered again as soon as one of them is saved. Each stage of rendering is
+cached on its own inputs - see `renderer.render_markdown`, `inliner.compile_stylesheet` and `renderer.compile_content`
+- so a change to the theme doesn't parse the markdown again, and a change to the markdown doesn't parse the theme. The
+result is served on a local port, and open pages reload themselves whenever it changes
+"""
+from typing import Callable, Dict, Optional, Tuple
+import html
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+POLL_INTERVAL = 0.05
+KEEPALIVE_INTERVAL = 15.0
+
+RELOAD_SCRIPT = (
+    '<script>new EventSource("/events?version=%d").onmessage = function () { location.reload(); };</script>'
+)
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Preview(object):
+    """
+    The latest rendering of a markdown file. Call `poll` (or `watch`) to render it again when its inputs change.
+    The context comes from `context`, updated with a JSON file of the same name as the markdown file if there is one,
+    as with `maildown render`
+
+    ### Parameters:
+
+    - `file_path`: The markdown file to preview
+    - `theme`: A local file path to a css style sheet. If not supplied, the default style is used
+    - `context`: Variables to render the email with
+    - `on_render`: Called with the number of seconds each render took, and the error if it failed
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        theme: Optional[str] = None,
+        context: Optional[dict] = None,
+        on_render: Optional[Callable[[float, Optional[Exception]], None]] = None,
+    ):
+        from maildown import renderer
+
+        self.file_path = file_path
+        self.theme = theme
+        self.context = context or {}
+        self.on_render = on_render
+        self.paths = [
+            file_path,
+            theme or renderer.DEFAULT_THEME,
+            renderer.TEMPLATE,
+            os.path.splitext(file_path)[0] + ".json",
+        ]
+        self.stats: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.version = 0
+        self.html = ""
+        self.changed = threading.Condition()
+
+    def poll(self) -> bool:
+        """
+        Renders the file again if any of its inputs have changed since the last render. Returns True if it did
+        """
+        stats = {path: _stat(path) for path in self.paths}
+        if stats == self.stats:
+            return False
+        self.stats = stats
+        self.render()
+        return True
+
+    def render(self) -> None:
+        from maildown import renderer
+
+        start = time.perf_counter()
+        error: Optional[Exception] = None
+        try:
+            with open(self.file_path) as f:
+                content = f.read()
+            context = dict(self.context)
+            if os.path.isfile(self.paths[3]):
+                with open(self.paths[3]) as f:
+                    context.update(json.load(f))
+            result = renderer.compile_content(content, theme=self.theme).render(context)
+        except Exception as e:
+            error = e
+            result = f"<h1>Failed to render {html.escape(self.file_path)}</h1><pre>{html.escape(repr(e))}</pre>"
+
+        with self.changed:
+            self.version += 1
+            self.html = result
+            self.changed.notify_all()
+        if self.on_render:
+            self.on_render(time.perf_counter() - start, error)
+
+    def watch(self, stop: threading.Event, interval: float = POLL_INTERVAL) -> None:
+        """
+        Polls for changes every `interval` seconds until `stop` is set
+        """
+        while not stop.wait(interval):
+            self.poll()
+
+    def wait(self, version: int, timeout: float) -> int:
+        """
+        Waits up to `timeout` seconds for a rendering newer than `version`, and returns the current version
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def page(self, reload: bool = True) -> str:
+        """
+        Returns the latest rendering, with a script which reloads it when it changes if `reload` is true
+        """
+        with self.changed:
+            page, version = self.html, self.version
+        if not reload:
+            return page
+        script = RELOAD_SCRIPT % version
+        index = page.rfind("</body>")
+        return page[:index] + script + page[index:] if index != -1 else page + script
+
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the preview at `/`, and a stream of server sent events at `/events` which tells the page to reload
+    """
+
+    server: "PreviewServer"  # type: ignore
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path == "/":
+            data = self.server.preview.page(self.server.reload).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(data)
+        elif path == "/events" and self.server.reload:
+            params = dict(param.partition("=")[::2] for param in query.split("&"))
+            try:
+                version = int(params.get("version", 0))
+            except ValueError:
+                version = 0
+            self.events(version)
+        else:
+            self.send_error(404)
+
+    def events(self, version: int) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        try:
+            while True:
+                latest = self.server.preview.wait(version, KEEPALIVE_INTERVAL)
+                if latest != version:
+                    self.wfile.write(f"data: {latest}\n\n".encode("utf-8"))
+                    return
+                self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PreviewServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Serves a `Preview`, in a thread per connection. With `reload` false, pages are served without the reload script
+    """
+
+    daemon_threads = True
+
+    def __init__(self, preview: Preview, address: Tuple[str, int], reload: bool = True):
+        super().__init__(address, PreviewHandler)
+        self.preview = preview
+        self.reload = reload
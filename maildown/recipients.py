@@ -0,0 +1,244 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, IO, TypeVar
+from array import array
+import csv
+import hashlib
+import itertools
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+
+FORMATS = ("csv", "jsonl", "lines")
+BLOOM_CAPACITY = 10_000_000
+HASHED_SET_MAGIC = b"MDHASH01"
+HASHED_SET_HEADER = struct.Struct("<8sQQ")
+
+T = TypeVar("T")
+
+
+def _hash(email: str, size: int = 8) -> bytes:
+    return hashlib.blake2b(email.strip().lower().encode("utf-8"), digest_size=size).digest()
+
+
+class HashedSet(object):
+    """
+    A set of email addresses which only stores an 8 byte hash of each address, in an open addressing table backed by
+    an `array`. The table doubles in size whenever it is half full, so this uses between 16 and 32 bytes per address,
+    rather than the hundred or so taken by a set of strings. Addresses are compared case insensitively
+    """
+
+    def __init__(self, capacity: int = 1024):
+        size = 1
+        while size < capacity * 2:
+            size *= 2
+        self.table = array("Q", bytes(8 * size))
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _slot(self, key: int) -> int:
+        mask = len(self.table) - 1
+        slot = key & mask
+        while self.table[slot] and self.table[slot] != key:
+            slot = (slot + 1) & mask
+        return slot
+
+    @staticmethod
+    def _key(email: str) -> int:
+        return int.from_bytes(_hash(email), "little") or 1
+
+    def __contains__(self, email: str) -> bool:
+        return bool(self.table[self._slot(self._key(email))])
+
+    def add(self, email: str) -> bool:
+        """
+        Adds an address to the set. Returns True if it was not already present
+        """
+        return self.add_key(self._key(email))
+
+    def add_key(self, key: int) -> bool:
+        """
+        Adds an address by its hash - see `_key`
+        """
+        slot = self._slot(key)
+        if self.table[slot]:
+            return False
+
+        self.table[slot] = key
+        self.count += 1
+        if self.count * 2 > len(self.table):
+            self._grow()
+        return True
+
+    def _grow(self) -> None:
+        old = self.table
+        self.table = array("Q", bytes(16 * len(old)))
+        for key in old:
+            if key:
+                self.table[self._slot(key)] = key
+
+    def save(self, path: str) -> None:
+        """
+        Writes the set's table to a file, which `load` can memory map
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".hashed-")
+        with open(fd, "wb") as f:
+            f.write(HASHED_SET_HEADER.pack(HASHED_SET_MAGIC, self.count, len(self.table)))
+            f.write(self.table.tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "HashedSet":
+        """
+        Memory maps a set written by `save`. Loading takes the same time however large the set is, and pages of the
+        table are only read from disk as lookups touch them. The loaded set is read only
+        """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, size = HASHED_SET_HEADER.unpack_from(data)
+        if magic != HASHED_SET_MAGIC or len(data) != HASHED_SET_HEADER.size + size * 8:
+            data.close()
+            raise ValueError(f"{path} is not a hashed set")
+        hashed = cls.__new__(cls)
+        hashed.table = memoryview(data)[HASHED_SET_HEADER.size:].cast("Q")  # type: ignore
+        hashed.count = count
+        return hashed
+
+
+class BloomFilter(object):
+    """
+    A fixed size probabilistic set of email addresses. Memory use depends only on `capacity` and `error_rate` (around
+    1.2 bytes per address at 1%), but roughly `error_rate` of new addresses will be wrongly reported as already
+    present, and so skipped
+
+    ### Parameters:
+
+    - `capacity`: The number of addresses the filter is sized for
+    - `error_rate`: The false positive rate once `capacity` addresses have been added
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, email: str) -> Iterator[int]:
+        digest = _hash(email, 16)
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def __contains__(self, email: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(email))
+
+    def add(self, email: str) -> bool:
+        """
+        Adds an address to the filter. Returns True if it was (definitely) not already present
+        """
+        new = False
+        for p in self._positions(email):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                self.bits[p >> 3] |= 1 << (p & 7)
+                new = True
+        return new
+
+
+def detect_format(line: str) -> str:
+    """
+    Guesses the format of a recipients stream from its first line
+    """
+    line = line.strip()
+    if line.startswith("{"):
+        return "jsonl"
+    if "," in line or line.lower() == "email":
+        return "csv"
+    return "lines"
+
+
+def parse(stream: IO[str], format: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily parses recipients from an open text stream, yielding a dict per recipient. CSV streams must have a header
+    row, and a CSV row with more fields than the header is an error. JSONL streams must have one JSON object per line,
+    and plain streams have one email address per line. Each recipient must have an `email` field
+
+    ### Parameters:
+
+    - `stream`: An open text file, or `sys.stdin`
+    - `format`: One of `csv`, `jsonl` or `lines`. If not supplied, the format is guessed from the first line
+    """
+    non_empty = (line for line in stream if line.strip())
+    first = next(non_empty, None)
+    if first is None:
+        return
+    lines = itertools.chain([first], non_empty)
+    format = format or detect_format(first)
+
+    rows: Iterable[Dict[str, Any]]
+    if format == "jsonl":
+        rows = (json.loads(line) for line in lines)
+    elif format == "csv":
+        rows = csv.DictReader(lines)
+    elif format == "lines":
+        rows = (dict(email=line.strip()) for line in lines)
+    else:
+        raise ValueError(f"Unknown recipients format {format}. Must be one of {', '.join(FORMATS)}")
+
+    for number, row in enumerate(rows, 1):
+        if None in row:
+            raise ValueError(f"Recipient row {number} has more fields than the header: {row[None]}")
+        if not row.get("email"):
+            raise KeyError(f"Recipient {row} has no `email` field")
+        yield dict(row)
+
+
+def read(path: str, format: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily reads recipients from a file - see `parse`. A path of `-` reads from stdin. If no format is given, files
+    ending in `.csv`, `.jsonl` or `.json` are read in that format, and anything else is guessed from its first line
+    """
+    if path == "-":
+        yield from parse(sys.stdin, format)
+        return
+
+    if not format and path.endswith(".csv"):
+        format = "csv"
+    elif not format and path.endswith((".jsonl", ".json")):
+        format = "jsonl"
+
+    with open(path, newline="") as f:
+        yield from parse(f, format)
+
+
+def dedupe(recipients: Iterable[Dict[str, Any]], seen: Optional[Any] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Drops recipients whose email address has already been seen. The first occurrence of each address is kept
+
+    ### Parameters:
+
+    - `recipients`: An iterable of recipient dicts
+    - `seen`: The structure used to remember addresses - a `HashedSet` (the default) or a `BloomFilter`
+    """
+    if seen is None:
+        seen = HashedSet()
+    for recipient in recipients:
+        if seen.add(recipient["email"]):
+            yield recipient
+
+
+def chunked(recipients: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Lazily groups recipients into lists of at most `size`
+    """
+    iterator = iter(recipients)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
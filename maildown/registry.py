@@ -0,0 +1,32 @@
+from typing import Any, Optional
+import importlib
+
+
+class LazyRegistry(object):
+    """
+    Maps names to classes given as `module:attribute` strings. A class's module is only imported the first time it is
+    looked up, so that listing or parsing commands doesn't pay for importing every backend's dependencies
+    """
+
+    def __init__(self, **paths: str):
+        self.paths = paths
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def register(self, name: str, path: str) -> None:
+        self.paths[name] = path
+
+    def get(self, name: str, default: Optional[Any] = None) -> Any:
+        if name not in self.paths:
+            return default
+        module, attribute = self.paths[name].split(":")
+        return getattr(importlib.import_module(module), attribute)
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.paths:
+            raise KeyError(name)
+        return self.get(name)
@@ -1,11 +1,110 @@
 import os
-from typing import Optional
-import jinja2
+import re
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from concurrent import futures
+from typing import Optional, Tuple
 import mistune
 import pygments
 from pygments import lexers
 from pygments.formatters import html
-import premailer
+from maildown import inliner, instrumentation, templates
+from maildown.templates import PlaceholderUndefined  # noqa: F401
+
+
+HIGHLIGHT_CACHE_SIZE = 1024
+MIN_PARALLEL_BLOCKS = 8
+FENCES = re.compile(mistune.BlockGrammar.fences.pattern, re.M)
+
+_highlighted: "OrderedDict[bytes, str]" = OrderedDict()
+_highlighted_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=64)
+def get_lexer(lang: str):
+    """
+    Returns the pygments lexer for a language. Looking lexers up by name scans pygments' registry and plugins, so
+    they are memoised
+    """
+    return lexers.get_lexer_by_name(lang, stripall=True)
+
+
+@functools.lru_cache(maxsize=1)
+def get_formatter():
+    return html.HtmlFormatter()
+
+
+def _highlight_key(code: str, lang: str) -> bytes:
+    return hashlib.blake2b(f"{lang}\0{code}".encode("utf-8"), digest_size=16).digest()
+
+
+def highlight(code: str, lang: str) -> str:
+    """
+    Highlights a block of code. The output is kept in an LRU cache, keyed on a hash of the language and code
+    """
+    key = _highlight_key(code, lang)
+    with _highlighted_lock:
+        if key in _highlighted:
+            _highlighted.move_to_end(key)
+            return _highlighted[key]
+
+    with instrumentation.span("render.highlight"):
+        result = pygments.highlight(code, get_lexer(lang), get_formatter())
+    _store_highlighted(key, result)
+    return result
+
+
+def _store_highlighted(key: bytes, result: str) -> None:
+    with _highlighted_lock:
+        _highlighted[key] = result
+        while len(_highlighted) > HIGHLIGHT_CACHE_SIZE:
+            _highlighted.popitem(last=False)
+
+
+def clear_highlight_cache() -> None:
+    """
+    Empties the lexer, formatter and highlighted output caches
+    """
+    get_lexer.cache_clear()
+    get_formatter.cache_clear()
+    with _highlighted_lock:
+        _highlighted.clear()
+
+
+def _highlight_block(block: Tuple[str, str]) -> str:
+    code, lang = block
+    return pygments.highlight(code, get_lexer(lang), get_formatter())
+
+
+def prehighlight(md_content: str, workers: int) -> None:
+    """
+    Highlights the fenced code blocks of a markdown document in a pool of worker processes, and stores the results in
+    the highlight cache, so that rendering the document afterwards doesn't need to highlight anything. Pygments is
+    pure python, so processes are used rather than threads. Documents with fewer than `MIN_PARALLEL_BLOCKS` uncached
+    code blocks are left alone, as the pool would cost more than it saves
+
+    ### Parameters:
+
+    - `md_content`: The markdown content of the email
+    - `workers`: The number of processes to use
+    """
+    blocks = {}
+    for match in FENCES.finditer(mistune.preprocessing(md_content)):
+        lang, code = match.group(2), match.group(3)
+        if lang:
+            blocks[_highlight_key(code, lang)] = (code, lang)
+
+    with _highlighted_lock:
+        blocks = {key: block for key, block in blocks.items() if key not in _highlighted}
+
+    if len(blocks) < MIN_PARALLEL_BLOCKS:
+        return
+
+    with instrumentation.span("render.prehighlight"), futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for key, result in zip(blocks, executor.map(_highlight_block, blocks.values(), chunksize=4)):
+            _store_highlighted(key, result)
 
 
 class HighlightRenderer(mistune.Renderer):
@@ -17,9 +116,75 @@ class HighlightRenderer(mistune.Renderer):
     def block_code(code, lang=None):
         if not lang:
             return "\n<pre><code>%s</code></pre>\n" % mistune.escape(code)
-        lexer = lexers.get_lexer_by_name(lang, stripall=True)
-        formatter = html.HtmlFormatter()
-        return pygments.highlight(code, lexer, formatter)
+        return highlight(code, lang)
+
+
+DEFAULT_THEME = templates.DEFAULT_THEME
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.jinja2")
+COMPILED_CACHE_SIZE = 128
+
+
+@functools.lru_cache(maxsize=COMPILED_CACHE_SIZE)
+def render_markdown(md_content: str) -> str:
+    """
+    Converts markdown to html. The result is cached on its own, so that changing only the theme or the local template
+    of a message doesn't parse its markdown again
+    """
+    markdown = mistune.Markdown(renderer=HighlightRenderer())
+    with instrumentation.span("render.markdown"):
+        return markdown(md_content)
+
+
+class CompiledMessage(templates.CompiledTemplate):
+    """
+    A markdown document which has already been written into the local template and had its css inlined. The result
+    is held as a jinja template, so that each additional recipient only costs a call to `render`
+    """
+
+    def __init__(self, md_content: str, stylesheet: str, template: str):
+        body = render_markdown(md_content)
+        with instrumentation.span("render.template"):
+            html = templates.from_string(template).render(content=body, stylesheet=stylesheet)
+        with instrumentation.span("render.inline"):
+            content = inliner.transform(html)
+        super().__init__(content, md_content, theme=templates.stylesheet_checksum(stylesheet))
+
+
+@functools.lru_cache(maxsize=COMPILED_CACHE_SIZE)
+def _compile(md_content: str, stylesheet: str, template: str) -> CompiledMessage:
+    return CompiledMessage(md_content, stylesheet, template)
+
+
+def compile_content(
+    md_content: str, theme: Optional[str] = None, highlight_workers: Optional[int] = None
+) -> templates.CompiledTemplate:
+    """
+    Returns a `CompiledMessage` for the given content and theme. Compiled messages are kept in an LRU cache keyed on
+    the markdown source, the contents of the theme and the contents of the local template, so rendering the same
+    document many times only runs markdown, pygments and the css inliner once. If the content was read from a compiled
+    artifact with `templates.read_file`, and the artifact was compiled with the same theme, it is returned instead
+
+    ### Parameters:
+
+    - `md_content`: The markdown content of the email
+    - `theme`: A local file path to a css style sheet. If not supplied, the default style is used
+    - `highlight_workers`: If set, code blocks are highlighted in parallel with this many processes. See
+    `prehighlight`
+    """
+    artifact = templates.loaded(md_content, theme)
+    if artifact is not None:
+        return artifact
+
+    if highlight_workers:
+        prehighlight(md_content, highlight_workers)
+
+    with open(theme or DEFAULT_THEME) as f:
+        stylesheet = f.read()
+
+    with open(TEMPLATE) as t:
+        template = t.read()
+
+    return _compile(md_content, stylesheet, template)
 
 
 def generate_content(
@@ -34,32 +199,8 @@ def generate_content(
 
     Apart from rendering the template, this method also does two other things:
     1. Applies an additional highlight renderer with better support for code blocks
-    2. Uses premailer.transform to bake the css into the HTML
-    """
-    if not theme:
-        theme = os.path.join(os.path.dirname(os.path.abspath(__file__)), "style.css")
+    2. Bakes the css into the HTML - see `inliner.transform`
 
-    if not context:
-        context = {}
-
-    with open(theme) as f:
-        theme = f.read()
-
-    markdown = mistune.Markdown(renderer=HighlightRenderer())
-
-    with open(
-        os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.jinja2")
-    ) as t:
-        template = jinja2.Template(t.read())
-    content = premailer.transform(
-        template.render(content=markdown(md_content), stylesheet=theme)
-    )
-
-    new_template = jinja2.Template(content)
-    return new_template.render(context)
-
-
-#
-# with open('test.md') as r:
-#     with open('test.html', 'w') as f:
-#         f.write(generate_content(r.read(), theme='my-style.css', context=dict(things=['Thing 1', 'Thing 2'])))
+    The first template, and the css inlining, are cached between calls - see `compile_content`
+    """
+    return compile_content(md_content, theme=theme).render(context)
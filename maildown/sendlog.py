@@ -0,0 +1,429 @@
+"""
+An append-only log of every send's outcome, so campaigns of millions of messages can be reconciled without scraping
+command output. Each result is one length-prefixed binary record: a fixed header of the record's length, format version,
+timestamp, latency, status and the lengths of the strings which follow, then the campaign, recipient, SES message id and
+error code as UTF-8. Senders only put results on a queue; a background thread encodes them, appends them to the file in
+batches, and calls fsync at most once every `FSYNC_INTERVAL` seconds. Writers hold an exclusive lock on the file while
+they append, so several processes can share one log. Bytes which aren't a whole record, such as a record torn by a
+crash, are skipped when the log is read, and a torn record at the end is cut off when the log is next opened for
+writing. `summarise` reads the file through a memory map, without decoding the parts of each record it doesn't need
+"""
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence
+import collections
+import contextlib
+import datetime
+import math
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+
+VERSION = 1
+FSYNC_INTERVAL = 1.0
+BATCH_SIZE = 10_000
+
+DELIVERED = 0
+FAILED = 1
+SUPPRESSED = 2
+STATUSES = ("delivered", "failed", "suppressed")
+
+# length, version, timestamp, latency in seconds (NaN if not known), status, then the length of the campaign,
+# recipient, message id and error code
+HEADER = struct.Struct("<IBdfBHHHH")
+MAX_FIELD = 0xFFFF
+# The length of the end of the log which is checked for a torn record when it is opened: more than twice the longest
+# record, so that it always holds a whole one
+TAIL_WINDOW = 1 << 20
+
+_duration = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+_date = re.compile(r"^(\d{4}-\d{2}-\d{2})(?:[T ](\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?))?(Z|[+-]\d{2}:?\d{2})?$")
+_units = dict(s=1, m=60, h=3600, d=86400)
+
+
+def log_path() -> str:
+    """
+    Returns the location of the local send log
+    """
+    return os.path.join(os.path.expanduser("~"), ".maildown", "sends.log")
+
+
+class Record(NamedTuple):
+    timestamp: float
+    campaign: str
+    recipient: str
+    status: int
+    message_id: Optional[str] = None
+    error_code: Optional[str] = None
+    latency: Optional[float] = None
+
+
+def error_code(error: Optional[Exception]) -> Optional[str]:
+    """
+    Returns a short code for why a send failed: the SES error code for an SES error, the status of a failed bulk
+    destination, or otherwise the name of the exception's class
+    """
+    if error is None:
+        return None
+    response = getattr(error, "response", None)
+    if isinstance(response, dict) and response.get("Error", {}).get("Code"):
+        return response["Error"]["Code"]
+    status = getattr(error, "status", None)
+    if isinstance(status, dict) and status.get("Status"):
+        return status["Status"]
+    return type(error).__name__
+
+
+def message_id(response) -> Optional[str]:
+    """
+    Returns the message id from a backend's response, if it has one
+    """
+    if isinstance(response, dict):
+        return response.get("MessageId")
+    return None
+
+
+def to_record(campaign: str, result, timestamp: float) -> Record:
+    """
+    Returns the log record for a `SendResult`
+    """
+    from maildown.backends.base import Suppressed
+
+    if result.error is None:
+        status = DELIVERED
+    elif isinstance(result.error, Suppressed):
+        status = SUPPRESSED
+    else:
+        status = FAILED
+    return Record(
+        timestamp,
+        campaign,
+        result.recipient,
+        status,
+        message_id(result.response),
+        error_code(result.error),
+        result.latency,
+    )
+
+
+def _field(value: Optional[str]) -> bytes:
+    return (value or "").encode("utf-8")[:MAX_FIELD]
+
+
+def encode(record: Record) -> bytes:
+    """
+    Returns the bytes of a record, as they are written to the log
+    """
+    fields = [_field(record.campaign), _field(record.recipient), _field(record.message_id), _field(record.error_code)]
+    body = b"".join(fields)
+    return HEADER.pack(
+        HEADER.size + len(body),
+        VERSION,
+        record.timestamp,
+        math.nan if record.latency is None else record.latency,
+        record.status,
+        *(len(field) for field in fields),
+    ) + body
+
+
+def _records(data, offset: int = 0) -> Iterator[tuple]:
+    # Yields (offset, header fields) for every whole record. Bytes which aren't one, such as a torn record, are skipped
+    # by searching forward a byte at a time for the next header which is valid and whose record fits in the file
+    end = len(data)
+    while offset + HEADER.size <= end:
+        header = HEADER.unpack_from(data, offset)
+        length = header[0]
+        if (
+            header[1] == VERSION
+            and header[4] < len(STATUSES)
+            and length == HEADER.size + header[5] + header[6] + header[7] + header[8]
+            and offset + length <= end
+        ):
+            yield offset, header
+            offset += length
+        else:
+            offset += 1
+
+
+@contextlib.contextmanager
+def _locked(fd: int):
+    # Holds an exclusive lock on the log, where the platform has them
+    if fcntl is None:  # pragma: no cover
+        yield
+        return
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _truncate_torn(fd: int) -> None:
+    # Cuts off anything after the last whole record, such as a record torn by a crash, which would otherwise swallow
+    # the start of the records appended after it. Only the last `TAIL_WINDOW` bytes are read: `_records` finds the
+    # first header in them and follows the records from there. Must be called with the log locked, so that nothing is
+    # appended between reading the file and truncating it
+    size = os.fstat(fd).st_size
+    if not size:
+        return
+    start = max(size - TAIL_WINDOW, 0)
+    end = None if start else 0
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as data:
+        for offset, header in _records(data, start):
+            end = offset + header[0]
+    if end is not None and end < size:
+        os.ftruncate(fd, end)
+
+
+def read(path: Optional[str] = None) -> Iterator[Record]:
+    """
+    Yields every record in the log, oldest first
+    """
+    with open(path or log_path(), "rb") as f:
+        data = f.read()
+    for offset, (_, _, timestamp, latency, status, *lengths) in _records(data):
+        start = offset + HEADER.size
+        fields: List[str] = []
+        for length in lengths:
+            fields.append(data[start:start + length].decode("utf-8", "replace"))
+            start += length
+        campaign, recipient, message, error = fields
+        yield Record(
+            timestamp,
+            campaign,
+            recipient,
+            status,
+            message or None,
+            error or None,
+            None if math.isnan(latency) else latency,
+        )
+
+
+class SendLog(object):
+    """
+    Appends send results to the log from a background thread, so that sending never waits on the disk. Results are
+    written in batches of whatever has been recorded since the last write, up to `BATCH_SIZE`, and synced to disk
+    every `fsync_interval` seconds and when the log is closed. A torn record at the end of an existing log is truncated
+    before appending. If a write fails, the error is raised by the next call to `record` or `close`
+
+    ### Parameters:
+
+    - `path`: The file to append to. Defaults to `~/.maildown/sends.log`
+    - `fsync_interval`: The most seconds written results can go without being synced to disk
+    """
+
+    def __init__(self, path: Optional[str] = None, fsync_interval: float = FSYNC_INTERVAL):
+        self.path = path or log_path()
+        self.fsync_interval = fsync_interval
+        self.written = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        with _locked(self._fd):
+            _truncate_torn(self._fd)
+        self._queue: queue.Queue = queue.Queue()
+        self._closed = False
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, name="maildown-sendlog", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, campaign: str, result) -> None:
+        """
+        Queues a `SendResult` to be written to the log, under the name of its campaign
+        """
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise ValueError("The send log is closed")
+        self._queue.put((campaign, result, time.time()))
+
+    def _write(self, batch: list) -> None:
+        data = memoryview(b"".join(encode(to_record(*item)) for item in batch))
+        with _locked(self._fd):
+            while data:
+                data = data[os.write(self._fd, data):]
+        self.written += len(batch)
+
+    def _run(self) -> None:
+        try:
+            self._write_batches()
+        except Exception as e:
+            self._error = e
+
+    def _write_batches(self) -> None:
+        synced = time.monotonic()
+        dirty = False
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.fsync_interval)]
+            except queue.Empty:
+                batch = []
+            try:
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            done = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self._write(batch)
+                dirty = True
+            if dirty and (done or time.monotonic() - synced >= self.fsync_interval):
+                os.fsync(self._fd)
+                synced = time.monotonic()
+                dirty = False
+            if done:
+                return
+
+    def close(self) -> None:
+        """
+        Writes everything recorded so far, syncs it to disk and closes the file
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        os.close(self._fd)
+        if self._error is not None:
+            raise self._error
+
+
+class Summary(object):
+    """
+    The totals of one campaign's records
+    """
+
+    def __init__(self, campaign: str):
+        self.campaign = campaign
+        self.counts = [0, 0, 0]
+        self.latencies = array("f")
+        self.errors: collections.Counter = collections.Counter()
+        self.first = math.inf
+        self.last = 0.0
+
+    @property
+    def delivered(self) -> int:
+        return self.counts[DELIVERED]
+
+    @property
+    def failed(self) -> int:
+        return self.counts[FAILED]
+
+    @property
+    def suppressed(self) -> int:
+        return self.counts[SUPPRESSED]
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts)
+
+    def percentiles(self, *points: float) -> List[Optional[float]]:
+        """
+        Returns the send latencies, in seconds, at each percentile in `points`, by the nearest rank method. None if no
+        send had a latency recorded
+        """
+        ordered = sorted(self.latencies)
+        if not ordered:
+            return [None for _ in points]
+        return [ordered[max(math.ceil(point / 100 * len(ordered)) - 1, 0)] for point in points]
+
+
+def summarise(
+    path: Optional[str] = None,
+    campaigns: Optional[Sequence[str]] = None,
+    since: Optional[float] = None,
+) -> Dict[str, Summary]:
+    """
+    Totals the log's records by campaign, in the order each campaign was first logged. Only the header, campaign and
+    error code of each record are read
+
+    ### Parameters:
+
+    - `path`: The log to read. Defaults to `~/.maildown/sends.log`
+    - `campaigns`: Only total these campaigns
+    - `since`: Only total records logged at or after this Unix timestamp
+    """
+    path = path or log_path()
+    wanted = {campaign.encode("utf-8") for campaign in campaigns} if campaigns else None
+    summaries: Dict[bytes, Summary] = {}
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, header in _records(data):
+                _, _, timestamp, latency, status, campaign_length, recipient_length, id_length, error_length = header
+                if since is not None and timestamp < since:
+                    continue
+                start = offset + HEADER.size
+                campaign = data[start:start + campaign_length]
+                if wanted is not None and campaign not in wanted:
+                    continue
+                summary = summaries.get(campaign)
+                if summary is None:
+                    summary = summaries[campaign] = Summary(campaign.decode("utf-8", "replace"))
+                summary.counts[status] += 1
+                if latency == latency:
+                    summary.latencies.append(latency)
+                if error_length:
+                    start += campaign_length + recipient_length + id_length
+                    summary.errors[data[start:start + error_length]] += 1
+                if timestamp < summary.first:
+                    summary.first = timestamp
+                if timestamp > summary.last:
+                    summary.last = timestamp
+
+    for summary in summaries.values():
+        summary.errors = collections.Counter(
+            {code.decode("utf-8", "replace"): count for code, count in summary.errors.items()}
+        )
+    return {summary.campaign: summary for summary in summaries.values()}
+
+
+def parse_since(value: str, now: Optional[float] = None) -> float:
+    """
+    Returns the Unix timestamp for a `--since` option: a duration before now such as `30m`, `12h` or `7d`, or an ISO
+    8601 date or time, which is taken as local time unless it has an offset
+    """
+    match = _duration.match(value.strip())
+    if match:
+        return (time.time() if now is None else now) - float(match.group(1)) * _units[match.group(2)]
+    try:
+        return _parse_date(value.strip()).timestamp()
+    except ValueError:
+        raise ValueError(f"Can't read {value} as a time - give a duration such as 12h or 7d, or a date") from None
+
+
+def _parse_date(value: str) -> datetime.datetime:
+    # An ISO 8601 date, or date and time with an optional offset. datetime.fromisoformat needs Python 3.7
+    match = _date.match(value)
+    if not match:
+        raise ValueError(value)
+    date, clock, offset = match.groups()
+    text, fields = date, "%Y-%m-%d"
+    if clock:
+        text += " " + clock
+        fields += " %H:%M" + (":%S" if clock.count(":") == 2 else "") + (".%f" if "." in clock else "")
+    parsed = datetime.datetime.strptime(text, fields)
+    if offset == "Z":
+        return parsed.replace(tzinfo=datetime.timezone.utc)
+    if offset:
+        digits = offset[1:].replace(":", "")
+        delta = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+        return parsed.replace(tzinfo=datetime.timezone(delta if offset[0] == "+" else -delta))
+    return parsed
@@ -0,0 +1,403 @@
+"""
+A long running process which renders and sends emails on behalf of other programs. It keeps the things every
+`maildown send` would otherwise rebuild - imported modules, the config, compiled templates, backend clients and
+connection pools, and a pool of worker threads - and accepts jobs as JSON over HTTP, on either a localhost port or a
+Unix socket
+
+Requests are untrusted: a TCP listener requires a shared token in an `Authorization: Bearer` header, every POST must
+be `application/json` (so a web page can't send one without a CORS preflight), request content is rendered in jinja's
+sandbox, and requests can only read local files - `file_path`, `theme`, `attachments` and images - from inside the
+daemon's `root` directory
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import hmac
+import http.server
+import json
+import os
+import secrets
+import socketserver
+import threading
+import time
+from concurrent import futures
+from maildown import instrumentation
+from maildown.backends.base import DEFAULT_WORKERS
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8025
+MAX_REQUEST_SIZE = 10 * 1024 * 1024
+
+
+def token_path() -> str:
+    """
+    Returns the location of the token `maildown serve` generates when none is configured
+    """
+    return os.path.join(os.path.expanduser("~"), ".maildown", "serve.token")
+
+
+def default_token() -> str:
+    """
+    Returns the token for a TCP server: the `token` in the `serve` section of the config, otherwise the one stored in
+    `token_path`, which is generated, and only readable by its owner, the first time it is needed
+    """
+    from maildown import utilities
+
+    token = utilities.get_config().get("serve", {}).get("token")
+    if token:
+        return str(token)
+    path = token_path()
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        token = None
+    if token:
+        return token
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+class RequestError(Exception):
+    """
+    An error in a request, which is reported back to the client with the given HTTP status
+    """
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _response(result) -> Dict[str, Any]:
+    response: Dict[str, Any] = dict(recipient=result.recipient)
+    if result.error:
+        response["error"] = f"{type(result.error).__name__}: {result.error}"
+    elif isinstance(result.response, dict) and "MessageId" in result.response:
+        response["message_id"] = result.response["MessageId"]
+    return response
+
+
+class Daemon(object):
+    """
+    Handles render and send jobs. Backends are created the first time each one is asked for and then reused, so their
+    clients, rate limiters and connection pools are shared by every job. Messages are sent from a single pool of
+    worker threads, which bounds how many are in flight across all jobs
+
+    ### Parameters:
+
+    - `backend`: The backend to use for jobs which don't name one
+    - `workers`: The number of threads to send messages from
+    - `theme`: The theme to warm the template caches with
+    - `send_log`: A `sendlog.SendLog` to log the outcome of every message to
+    - `root`: The directory requests may read files from. If not supplied, requests can't name local files
+    """
+
+    def __init__(
+        self,
+        backend: str = "aws",
+        workers: int = DEFAULT_WORKERS,
+        theme: Optional[str] = None,
+        send_log=None,
+        root: Optional[str] = None,
+    ):
+        self.default_backend = backend
+        self.workers = workers
+        self.theme = theme
+        self.send_log = send_log
+        self.root = os.path.realpath(root) if root else None
+        self.started = time.time()
+        self.sent = 0
+        self.failed = 0
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="maildown-send")
+        self._backends: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def backend(self, name: Optional[str] = None):
+        from maildown.commands import available_backends
+
+        name = name or self.default_backend
+        backend = self._backends.get(name)
+        if backend is None:
+            with self._lock:
+                backend = self._backends.get(name)
+                if backend is None:
+                    __backend = available_backends.get(name)
+                    if not __backend:
+                        raise RequestError(f"No backend called {name} exists")
+                    backend = self._backends[name] = __backend()
+        return backend
+
+    def warm(self) -> None:
+        """
+        Compiles the template and theme, and creates the default backend and its client, before the first job
+        """
+        from maildown import batch
+
+        batch.warm(self.theme)
+        backend = self.backend()
+        if hasattr(backend, "client"):
+            backend.client
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for backend in self._backends.values():
+            if hasattr(backend, "close"):
+                backend.close()
+
+    def handle(self, path: str, payload: Any) -> Dict[str, Any]:
+        if path == "/health":
+            return dict(status="ok", uptime=time.time() - self.started, sent=self.sent, failed=self.failed)
+        if not isinstance(payload, dict):
+            raise RequestError("The request body must be a JSON object")
+        if path == "/render":
+            return self.render(payload)
+        if path == "/send":
+            return self.send(payload)
+        raise RequestError(f"No endpoint called {path}", 404)
+
+    def local_path(self, path: Any) -> str:
+        """
+        Returns the absolute path of a file named in a request, which must be inside `root`. Relative paths are
+        relative to `root`
+        """
+        from maildown import mime
+
+        if self.root is None:
+            raise RequestError("This server doesn't allow requests to read local files - start it with --root", 403)
+        if not isinstance(path, str) or not path:
+            raise RequestError("File paths must be strings")
+        full = os.path.realpath(os.path.join(self.root, path))
+        if not mime.is_within(full, self.root):
+            raise RequestError(f"{path} is outside the server's root directory", 403)
+        return full
+
+    def _files(self, payload: dict) -> Tuple[Optional[str], Optional[str], Optional[List[str]]]:
+        # The file path, theme and attachments of a request, confined to `root`
+        file_path = self.local_path(payload["file_path"]) if payload.get("file_path") else None
+        theme = self.local_path(payload["theme"]) if payload.get("theme") else None
+        attachments = payload.get("attachments")
+        if attachments:
+            if not isinstance(attachments, list):
+                raise RequestError("attachments must be a list of paths")
+            attachments = [self.local_path(path) for path in attachments]
+        return file_path, theme, attachments
+
+    def _compile(self, payload: dict, file_path: Optional[str], theme: Optional[str]):
+        # The markdown of a request, and its message compiled for the sandbox. Artifacts are refused, as loading one
+        # unmarshals python code from the file
+        from maildown import templates
+
+        content = payload.get("content")
+        if file_path:
+            try:
+                content = templates.read_file(file_path, trusted=False)
+            except ValueError as e:
+                raise RequestError(str(e))
+        if not content or not isinstance(content, str):
+            raise RequestError("You must provide either the content or file_path attribute")
+        return content, templates.compile_content(content, theme=theme).sandboxed()
+
+    def render(self, payload: dict) -> Dict[str, Any]:
+        """
+        Renders a message: `{"content" or "file_path", "theme"?, "context"?}`. Returns `{"html"}`. The template is
+        rendered in jinja's sandbox
+        """
+        import jinja2.sandbox
+
+        file_path, theme, _ = self._files(payload)
+        _, compiled = self._compile(payload, file_path, theme)
+        try:
+            return dict(html=compiled.render(payload.get("context")))
+        except jinja2.sandbox.SecurityError as e:
+            raise RequestError(f"The template did something unsafe: {e}")
+
+    def _log(self, campaign: str, result) -> Dict[str, Any]:
+        if self.send_log is not None:
+            self.send_log.record(campaign, result)
+        return _response(result)
+
+    def send(self, payload: dict) -> Dict[str, Any]:
+        """
+        Sends a message: `{"sender", "subject", "to" or "recipients", "content" or "file_path", "theme"?, "context"?,
+        "attachments"?, "backend"?, "campaign"?}`. `to` is a list of addresses, and `recipients` a list of objects with
+        an `email` key and any variables for that recipient's message. Outcomes are logged under `campaign`, or else
+        the subject. Waits for every message to be sent, and returns `{"sent", "failed", "results"}`. Paths must be
+        inside `root`, and the message is rendered in jinja's sandbox
+        """
+        missing = [key for key in ("sender", "subject") if not payload.get(key)]
+        if missing:
+            raise RequestError(f"Missing {', '.join(missing)}")
+        to = payload.get("to", [])
+        if not isinstance(to, list) or not all(isinstance(email, str) for email in to):
+            raise RequestError("to must be a list of email addresses")
+        recipients = payload.get("recipients", [])
+        if not isinstance(recipients, list) or not all(isinstance(recipient, dict) for recipient in recipients):
+            raise RequestError("recipients must be a list of objects")
+        recipients = [dict(email=email) for email in to] + recipients
+        if not recipients or not all(recipient.get("email") for recipient in recipients):
+            raise RequestError("You must supply at least one recipient, and every recipient must have an email")
+
+        file_path, theme, attachments = self._files(payload)
+        _, compiled = self._compile(payload, file_path, theme)
+        campaign = payload.get("campaign") or payload["subject"]
+        results = [
+            self._log(campaign, result)
+            for result in self.backend(payload.get("backend")).iter_send_many(
+                payload["sender"],
+                payload["subject"],
+                recipients,
+                file_path=file_path,
+                context=payload.get("context"),
+                theme=theme,
+                workers=self.workers,
+                executor=self.executor,
+                attachments=attachments,
+                sandbox=True,
+                compiled=compiled,
+            )
+        ]
+        failed = sum(1 for result in results if "error" in result)
+        with self._lock:
+            self.sent += len(results) - failed
+            self.failed += failed
+        return dict(sent=len(results) - failed, failed=failed, results=results)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Reads a JSON request, hands it to the server's `Daemon`, and writes its result back as JSON
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "Server"  # type: ignore
+
+    def setup(self):
+        # Responses are written as headers then body, which Nagle's algorithm would hold back on a kept alive TCP
+        # connection until the client acks. Unix sockets have no such option
+        self.disable_nagle_algorithm = isinstance(self.client_address, tuple)
+        super().setup()
+
+    def authorised(self) -> bool:
+        """
+        Checks the request's token, if the server has one, and responds with a 401 if it is wrong
+        """
+        token = self.server.token
+        if token is None:
+            return True
+        scheme, _, given = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(given.strip().encode(), token.encode()):
+            return True
+        self.close_connection = True
+        self.respond(401, dict(error="A valid token is required, as an `Authorization: Bearer <token>` header"))
+        return False
+
+    def do_GET(self):
+        if self.authorised():
+            self.respond(*self.dispatch(None))
+
+    def do_POST(self):
+        if not self.authorised():
+            return
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            self.close_connection = True
+            return self.respond(415, dict(error="Requests must have a Content-Type of application/json"))
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_REQUEST_SIZE:
+            self.close_connection = True
+            return self.respond(413, dict(error="The request body is missing a length, or is too large"))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            return self.respond(400, dict(error=f"Invalid JSON: {e}"))
+        self.respond(*self.dispatch(payload))
+
+    def dispatch(self, payload: Any) -> Tuple[int, Dict[str, Any]]:
+        try:
+            with instrumentation.span("serve.request", path=self.path):
+                return 200, self.server.daemon.handle(self.path, payload)
+        except RequestError as e:
+            return e.status, dict(error=str(e))
+        except Exception as e:
+            self.log_error("Failed to handle %s: %r", self.path, e)
+            return 500, dict(error=f"{type(e).__name__}: {e}")
+
+    def respond(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket clients don't have an address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class Server(socketserver.ThreadingMixIn):
+    daemon: Daemon
+    quiet: bool
+    token: Optional[str]
+    daemon_threads = True
+
+
+class TCPServer(Server, http.server.HTTPServer):
+    pass
+
+
+class UnixServer(Server, socketserver.UnixStreamServer):
+    pass
+
+
+def create_server(
+    daemon: Daemon,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    socket: Optional[str] = None,
+    quiet=False,
+    token: Optional[str] = None,
+) -> Server:
+    """
+    Returns a server which handles requests with `daemon`, in a thread per connection. If `socket` is given it
+    listens on a Unix socket at that path, replacing any stale socket file, otherwise on `host` and `port`. A TCP
+    server must have a token, since any local process or web page can reach its port; a Unix socket is protected by
+    its file permissions instead, and is only made accessible to its owner
+
+    ### Parameters:
+
+    - `daemon`: The `Daemon` to hand requests to
+    - `host`: The address to listen on. Defaults to localhost only
+    - `port`: The port to listen on
+    - `socket`: The path of a Unix socket to listen on instead of a port
+    - `quiet`: When true, requests aren't logged to stderr
+    - `token`: The token every request must send as an `Authorization: Bearer` header. Optional for a Unix socket
+    """
+    server: Server
+    if socket:
+        if os.path.exists(socket):
+            os.remove(socket)
+        umask = os.umask(0o077)
+        try:
+            server = UnixServer(socket, RequestHandler)
+        finally:
+            os.umask(umask)
+    else:
+        if not token:
+            raise ValueError("A token is required to listen on a TCP port")
+        server = TCPServer((host, port), RequestHandler)
+    server.daemon = daemon
+    server.quiet = quiet
+    server.token = token or None
+    return server
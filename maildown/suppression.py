@@ -0,0 +1,259 @@
+"""
+A local list of addresses which must not be sent to, e.g. because they hard bounced or complained. The list is kept
+in a SQLite database, which records why and when each address was added, and is imported from SES suppression list
+exports, SES bounce and complaint notifications, and CSV or plain text files. Sends don't query the database: after
+each change it is written out as a `recipients.HashedSet` index file, which is memory mapped, so checking a recipient
+costs one hash and a probe or two of the table, and opening a list of millions of addresses is instant
+"""
+from typing import Iterable, Iterator, List, Optional, Tuple
+import csv
+import functools
+import io
+import itertools
+import json
+import os
+import sqlite3
+import time
+from maildown import recipients as recipients_module
+from maildown.recipients import HashedSet
+
+
+BATCH_SIZE = 100_000
+KEY_MASK = (1 << 64) - 1
+
+# SES bounces which are worth retrying later, so shouldn't suppress the address
+TRANSIENT_BOUNCES = ("Transient",)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS suppressions (
+    key INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    reason TEXT,
+    source TEXT,
+    added REAL NOT NULL
+);
+"""
+
+
+def database_path() -> str:
+    """
+    Returns the location of the local suppression list database
+    """
+    return os.path.join(os.path.expanduser("~"), ".maildown", "suppressions.db")
+
+
+def index_path() -> str:
+    """
+    Returns the location of the suppression list's lookup index
+    """
+    return os.path.join(os.path.expanduser("~"), ".maildown", "suppressions.idx")
+
+
+def _key(email: str) -> int:
+    # HashedSet's unsigned 64 bit key, as the signed integer SQLite stores
+    key = HashedSet._key(email)
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+@functools.lru_cache(maxsize=1)
+def _load_index(path: str, mtime: int, size: int) -> Optional[HashedSet]:
+    index = HashedSet.load(path)
+    return index if len(index) else None
+
+
+def default_index() -> Optional[HashedSet]:
+    """
+    Returns the memory mapped index of the local suppression list, or None if nothing has been suppressed. The index
+    is only loaded again when the file changes
+    """
+    path = index_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return _load_index(path, stat.st_mtime_ns, stat.st_size)
+
+
+class SuppressionList(object):
+    """
+    The local suppression list. Changes are made in batches of `BATCH_SIZE` addresses per transaction, and the index
+    which sends check against is rebuilt once they are done
+
+    ### Parameters:
+
+    - `path`: The location of the database. Defaults to `~/.maildown/suppressions.db`
+    - `index`: The location of the index. Defaults to `~/.maildown/suppressions.idx`
+    """
+
+    def __init__(self, path: Optional[str] = None, index: Optional[str] = None):
+        self.path = path or database_path()
+        self.index_path = index or index_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM suppressions").fetchone()[0]
+
+    def __contains__(self, email: str) -> bool:
+        return self.reason(email) is not None
+
+    def reason(self, email: str) -> Optional[str]:
+        """
+        Returns why an address was suppressed, or None if it isn't
+        """
+        row = self.db.execute("SELECT reason FROM suppressions WHERE key = ?", (_key(email),)).fetchone()
+        return None if row is None else row[0] or ""
+
+    def add(self, entries: Iterable[Tuple[str, Optional[str]]], source: Optional[str] = None) -> int:
+        """
+        Adds `(email, reason)` pairs to the list, and rebuilds the index. Addresses which are already suppressed
+        keep their original reason. Returns the number of addresses added
+        """
+        before = len(self)
+        now = time.time()
+        try:
+            for batch in recipients_module.chunked(entries, BATCH_SIZE):
+                # Inserting in key order keeps each batch's writes to neighbouring pages of the table
+                rows = sorted(
+                    (_key(email), email.strip().lower(), reason, source, now)
+                    for email, reason in batch
+                    if email.strip()
+                )
+                with self.db:
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO suppressions (key, email, reason, source, added) VALUES (?, ?, ?, ?, ?)",
+                        rows,
+                    )
+        finally:
+            # Batches which were committed before an error are still suppressed
+            self.build_index()
+        return len(self) - before
+
+    def remove(self, emails: Iterable[str]) -> int:
+        """
+        Removes addresses from the list, and rebuilds the index. Returns the number of addresses removed
+        """
+        removed = 0
+        for batch in recipients_module.chunked(emails, BATCH_SIZE):
+            with self.db:
+                removed += self.db.executemany(
+                    "DELETE FROM suppressions WHERE key = ?", ((_key(email),) for email in batch)
+                ).rowcount
+        self.build_index()
+        return removed
+
+    def build_index(self) -> HashedSet:
+        """
+        Writes every suppressed address's key to the index file, which replaces the old one atomically
+        """
+        index = HashedSet(max(len(self), 1))
+        cursor = self.db.execute("SELECT key FROM suppressions")
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            for (key,) in rows:
+                index.add_key(key & KEY_MASK)
+        index.save(self.index_path)
+        return index
+
+
+def _notification(record: dict) -> Iterator[Tuple[str, str]]:
+    # An SNS envelope holds the SES notification as a JSON string
+    if isinstance(record.get("Message"), str):
+        try:
+            record = json.loads(record["Message"])
+        except ValueError:
+            return
+    kind = record.get("notificationType") or record.get("eventType")
+    if kind == "Bounce":
+        bounce = record.get("bounce", {})
+        if bounce.get("bounceType") in TRANSIENT_BOUNCES:
+            return
+        for recipient in bounce.get("bouncedRecipients", []):
+            yield recipient["emailAddress"], "bounce"
+    elif kind == "Complaint":
+        for recipient in record.get("complaint", {}).get("complainedRecipients", []):
+            yield recipient["emailAddress"], "complaint"
+
+
+def _records(data) -> Iterator[Tuple[str, Optional[str]]]:
+    if isinstance(data, list):
+        for item in data:
+            yield from _records(item)
+    elif isinstance(data, dict):
+        if "SuppressedDestinationSummaries" in data:
+            # `aws sesv2 list-suppressed-destinations`
+            yield from _records(data["SuppressedDestinationSummaries"])
+        elif "EmailAddress" in data:
+            reason = data.get("Reason")
+            yield data["EmailAddress"], reason.lower() if reason else None
+        else:
+            yield from _notification(data)
+    elif isinstance(data, str):
+        yield data, None
+
+
+def _column(fields: List[str], *names: str) -> Optional[int]:
+    normalised = [field.strip().lower().replace("_", "").replace(" ", "") for field in fields]
+    for name in names:
+        for i, field in enumerate(normalised):
+            if name in field:
+                return i
+    return None
+
+
+def _csv(f: io.TextIOBase) -> Iterator[Tuple[str, Optional[str]]]:
+    reader = csv.reader(f)
+    header = next(reader, [])
+    email = _column(header, "email", "address", "recipient")
+    reason = _column(header, "reason", "bouncetype", "type")
+    if email is None:
+        # No header, so the first column is the address
+        email, reason = 0, None
+        reader = itertools.chain([header], reader)  # type: ignore
+    for row in reader:
+        if len(row) > email:
+            yield row[email], row[reason] or None if reason is not None and len(row) > reason else None
+
+
+def read(path: str) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Reads `(email, reason)` pairs from a file. The format is worked out from its contents:
+
+    - JSON, such as the output of `aws sesv2 list-suppressed-destinations`, or an SES bounce or complaint notification,
+    or a list of either. Transient bounces are skipped
+    - JSON lines, one of the above per line, e.g. notifications collected from an SQS queue
+    - CSV with a header, whose email column is any column named like `email`, `address` or `recipient`, and whose
+    reason column, if any, is named like `reason` or `bounce type`
+    - One address per line
+    """
+    with open(path, newline="") as f:
+        start = f.read(1024).lstrip()
+        f.seek(0)
+        if start.startswith(("{", "[")):
+            try:
+                documents: Iterable = [json.load(f)]
+            except ValueError:
+                f.seek(0)
+                documents = (json.loads(line) for line in f if line.strip())
+            for document in documents:
+                yield from _records(document)
+        elif "," in start.partition("\n")[0]:
+            yield from _csv(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield line.strip(), None
@@ -0,0 +1,309 @@
+"""
+The jinja environment every maildown template is compiled in. Compiled templates are kept in memory, and their
+bytecode is cached in `~/.maildown/jinja`, so a new process only pays for jinja's compiler the first time a template
+is seen on the machine. This module also reads and writes compiled message artifacts - see `CompiledTemplate.save` -
+and only depends on jinja, so that loading an artifact doesn't import markdown, pygments or the css inliner
+"""
+from typing import Optional, Tuple, Type
+import base64
+import copy
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from types import CodeType
+import jinja2
+import jinja2.sandbox
+from jinja2.bccache import Bucket
+from maildown import instrumentation
+
+
+TEMPLATE_CACHE_SIZE = 128
+ARTIFACT_CACHE_SIZE = 32
+ARTIFACT_EXTENSION = ".mdc"
+ARTIFACT_FORMAT = 1
+DEFAULT_THEME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "style.css")
+
+# Loaded artifacts, keyed on their markdown and the checksum of the stylesheet they were compiled with
+_artifacts: "OrderedDict[Tuple[str, str], CompiledTemplate]" = OrderedDict()
+_artifacts_lock = threading.Lock()
+
+
+def cache_dir() -> str:
+    return os.path.join(os.path.expanduser("~"), ".maildown", "jinja")
+
+
+class PlaceholderUndefined(jinja2.Undefined):
+    """
+    Renders undefined variables back out as `{{name}}` placeholders, rather than as empty strings
+    """
+
+    def __str__(self):
+        return "{{%s}}" % self._undefined_name
+
+    def __getattr__(self, name):
+        if name[:2] == "__" and name[-2:] == "__":
+            raise AttributeError(name)
+        return PlaceholderUndefined(name=f"{self._undefined_name}.{name}")
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    A bytecode cache which treats the disk as optional: if the cache directory can't be created or written to,
+    templates are simply compiled again next time
+    """
+
+    def load_bytecode(self, bucket: Bucket) -> None:
+        try:
+            super().load_bytecode(bucket)
+        except OSError:
+            bucket.reset()
+
+    def dump_bytecode(self, bucket: Bucket) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+@functools.lru_cache(maxsize=1)
+def get_bytecode_cache() -> BytecodeCache:
+    return BytecodeCache(cache_dir())
+
+
+@functools.lru_cache(maxsize=None)
+def get_environment(undefined: Type[jinja2.Undefined] = jinja2.Undefined) -> jinja2.Environment:
+    """
+    Returns the shared environment for templates using the given class for undefined variables. The environments
+    all have `jinja2.Template`'s default options, so templates render exactly as they would with it
+    """
+    return jinja2.Environment(undefined=undefined, bytecode_cache=get_bytecode_cache(), auto_reload=False)
+
+
+def _checksum(source: str) -> str:
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+def stylesheet_checksum(stylesheet: str) -> str:
+    """
+    Returns the checksum which identifies the stylesheet a message was compiled with
+    """
+    return _checksum(stylesheet)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _theme_checksum(path: str, mtime: int, size: int) -> str:
+    with open(path) as f:
+        return stylesheet_checksum(f.read())
+
+
+def theme_checksum(theme: Optional[str] = None) -> str:
+    """
+    Returns the checksum of a theme's stylesheet, or of the default style if no theme is given. The file is only read
+    again when it changes
+    """
+    path = os.path.abspath(theme or DEFAULT_THEME)
+    stat = os.stat(path)
+    return _theme_checksum(path, stat.st_mtime_ns, stat.st_size)
+
+
+def compile_template(source: str) -> CodeType:
+    """
+    Returns the python code object for a template, from the bytecode cache if it is there. The code doesn't depend on
+    the class used for undefined variables, so it is shared by every environment
+    """
+    environment = get_environment()
+    cache = get_bytecode_cache()
+    name = _checksum(source)
+    bucket = cache.get_bucket(environment, name, None, source)
+    if bucket.code is None:
+        bucket.code = environment.compile(source, name)
+        cache.set_bucket(bucket)
+    return bucket.code
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def from_string(source: str, undefined: Type[jinja2.Undefined] = jinja2.Undefined) -> jinja2.Template:
+    """
+    The cached equivalent of `jinja2.Template(source, undefined=undefined)`
+    """
+    environment = get_environment(undefined)  # type: ignore
+    return environment.template_class.from_code(environment, compile_template(source), environment.globals, None)
+
+
+@functools.lru_cache(maxsize=1)
+def get_sandboxed_environment() -> jinja2.sandbox.SandboxedEnvironment:
+    """
+    Returns the environment for templates from untrusted sources, which can't reach python internals such as
+    `__globals__` or call unsafe methods. Its templates aren't kept in the bytecode cache
+    """
+    return jinja2.sandbox.SandboxedEnvironment(auto_reload=False)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def sandboxed_from_string(source: str) -> jinja2.Template:
+    """
+    The cached equivalent of `from_string`, compiled in the sandboxed environment
+    """
+    return get_sandboxed_environment().from_string(source)
+
+
+def clear_caches() -> None:
+    """
+    Empties the in memory template caches, and forgets any loaded artifacts. The bytecode cache on disk is left alone
+    """
+    from_string.cache_clear()
+    sandboxed_from_string.cache_clear()
+    get_environment.cache_clear()
+    get_sandboxed_environment.cache_clear()
+    get_bytecode_cache.cache_clear()
+    _theme_checksum.cache_clear()
+    with _artifacts_lock:
+        _artifacts.clear()
+
+
+class CompiledTemplate(object):
+    """
+    A message which is ready to be rendered for each recipient: the markdown has been written into the local template
+    and had its css inlined, and the result compiled as a jinja template
+
+    ### Parameters:
+
+    - `source`: The inlined html, which is the source of the template
+    - `content`: The markdown the message was made from, which is sent as its plain text part
+    - `code`: The template's compiled code, if it is already known
+    - `theme`: The checksum of the stylesheet which was inlined, if it is known - see `theme_checksum`
+    """
+
+    def __init__(
+        self, source: str, content: str = "", code: Optional[CodeType] = None, theme: Optional[str] = None
+    ):
+        self.source = source
+        self.content = content
+        self.theme = theme
+        if code is None:
+            self.template = from_string(source)
+        else:
+            environment = get_environment()
+            self.template = environment.template_class.from_code(environment, code, environment.globals, None)
+
+    def sandboxed(self) -> "CompiledTemplate":
+        """
+        Returns a copy of the message whose template is rendered in jinja's sandbox, for content from untrusted
+        sources such as `maildown serve` requests
+        """
+        compiled = copy.copy(self)
+        compiled.template = sandboxed_from_string(self.source)
+        return compiled
+
+    def render(self, context: Optional[dict] = None) -> str:
+        with instrumentation.span("render.context"):
+            return self.template.render(context or {})
+
+    def render_placeholders(self, context: Optional[dict] = None) -> str:
+        """
+        Renders the message with the given shared context, but leaves any simple variable the context doesn't define
+        in place as a `{{name}}` placeholder. This is used to hand the message to template engines which fill in
+        per-recipient values themselves, such as SES templates
+        """
+        return from_string(self.source, PlaceholderUndefined).render(context or {})
+
+    def save(self, path: str) -> None:
+        """
+        Writes the message to an artifact file, holding the markdown, the inlined html and the template's bytecode.
+        Loading it with `load` skips markdown, pygments, the css inliner and the jinja compiler. The bytecode is
+        tied to the version of python which wrote it; other versions recompile the template from the html instead
+        """
+        bucket = Bucket(get_environment(), "", _checksum(self.source))
+        bucket.code = compile_template(self.source)
+        artifact = dict(
+            format=ARTIFACT_FORMAT,
+            content=self.content,
+            source=self.source,
+            theme=self.theme,
+            bytecode=base64.b64encode(bucket.bytecode_to_string()).decode("ascii"),
+        )
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".maildown-", suffix=ARTIFACT_EXTENSION)
+        with open(fd, "w") as f:
+            json.dump(artifact, f)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+
+def is_artifact(path: str) -> bool:
+    return path.endswith(ARTIFACT_EXTENSION)
+
+
+def load(path: str) -> CompiledTemplate:
+    """
+    Loads a message saved with `CompiledTemplate.save`
+    """
+    with open(path) as f:
+        artifact = json.load(f)
+    if artifact.get("format") != ARTIFACT_FORMAT:
+        raise ValueError(f"{path} was compiled by an incompatible version of maildown")
+
+    bucket = Bucket(get_environment(), "", _checksum(artifact["source"]))
+    bucket.bytecode_from_string(base64.b64decode(artifact["bytecode"]))
+    return CompiledTemplate(artifact["source"], artifact["content"], bucket.code, artifact.get("theme"))
+
+
+def read_file(path: str, trusted: bool = True) -> str:
+    """
+    Returns the markdown content of a file to be sent. If the file is a compiled artifact, the compiled message is
+    also kept, and `compile_content` returns it when it is asked for this content with the same theme, rather than
+    compiling it again. The last `ARTIFACT_CACHE_SIZE` artifacts are kept. Artifacts hold marshalled python code, so
+    a `ValueError` is raised for one unless the file is `trusted`
+    """
+    if not is_artifact(path):
+        with open(path) as f:
+            return f.read()
+    if not trusted:
+        raise ValueError(f"{path} is a compiled artifact, which can only be sent from a trusted source")
+
+    compiled = load(path)
+    if compiled.theme is not None:
+        with _artifacts_lock:
+            _artifacts[compiled.content, compiled.theme] = compiled
+            _artifacts.move_to_end((compiled.content, compiled.theme))
+            while len(_artifacts) > ARTIFACT_CACHE_SIZE:
+                _artifacts.popitem(last=False)
+    return compiled.content
+
+
+def loaded(content: str, theme: Optional[str] = None) -> Optional[CompiledTemplate]:
+    """
+    Returns the artifact loaded by `read_file` for the given markdown and theme, if there is one. No theme means the
+    default style
+    """
+    if not _artifacts:
+        return None
+    key = (content, theme_checksum(theme))
+    with _artifacts_lock:
+        compiled = _artifacts.get(key)
+        if compiled is not None:
+            _artifacts.move_to_end(key)
+        return compiled
+
+
+def compile_content(
+    content: str, theme: Optional[str] = None, highlight_workers: Optional[int] = None
+) -> CompiledTemplate:
+    """
+    Returns the compiled message for the given markdown. If it was read from an artifact which was compiled with the
+    same theme, the artifact is returned without importing the renderer and its dependencies. Otherwise this is
+    `renderer.compile_content`, which highlights code blocks in `highlight_workers` processes if it is given
+    """
+    artifact = loaded(content, theme)
+    if artifact is not None:
+        return artifact
+
+    from maildown import renderer
+
+    return renderer.compile_content(content, theme=theme, highlight_workers=highlight_workers)
@@ -1,32 +1,86 @@
-from typing import MutableMapping, Any
+from typing import MutableMapping, Any, Optional, Tuple
 import os
+import copy as _copy
+import tempfile
+import threading
 import toml
 from typing import Dict, Union, SupportsFloat
 
 
-def get_config() -> MutableMapping[str, Any]:
+_config_lock = threading.Lock()
+_config_snapshot: Dict[str, Any] = dict(key=None, config=None)
+
+
+def config_path() -> str:
     """
-    Returns the existing configuration from the local environment
+    Returns the location of the local maildown config file
     """
+    return os.path.join(os.path.expanduser("~"), "maildown.toml")
+
+
+def _config_key(path: str) -> Optional[Tuple[int, int]]:
     try:
-        with open(os.path.join(os.path.expanduser("~"), "maildown.toml")) as f:
-            return toml.loads(f.read())
+        stat = os.stat(path)
     except FileNotFoundError:
-        pass
-    return {}
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def clear_config_cache() -> None:
+    """
+    Forgets the in-memory snapshot of the config file, so that the next lookup reads it from disk again
+    """
+    with _config_lock:
+        _config_snapshot.update(key=None, config=None)
+
+
+def get_config(copy: bool = True) -> MutableMapping[str, Any]:
+    """
+    Returns the existing configuration from the local environment. The parsed file is kept in memory, and is only
+    read again when its modification time or size changes
+
+    ### Parameters:
+
+    - `copy`: when false, the shared snapshot is returned directly rather than a copy of it. This avoids a copy on
+    hot paths, but the result must not be modified
+
+    """
+    path = config_path()
+    key = _config_key(path)
+    with _config_lock:
+        if key is None or key != _config_snapshot["key"]:
+            try:
+                with open(path) as f:
+                    config = toml.loads(f.read())
+            except FileNotFoundError:
+                config = {}
+            _config_snapshot.update(key=key, config=config)
+        config = _config_snapshot["config"]
+    return _copy.deepcopy(config) if copy else config
 
 
 def write_config(**config: Dict[str, Union[str, SupportsFloat, bool]]) -> None:
     """
-    Updates the existing local config with the given additional arguments
+    Updates the existing local config with the given additional arguments. All of the arguments are written at
+    once, and the file is replaced atomically by writing to a temporary file and renaming it
 
     ### Parameters:
 
     - `config`: the new configuration items to add to the configuration
 
     """
+    path = config_path()
     existing = get_config()
     for key, val in config.items():
         existing[key] = val
-    with open(os.path.expanduser("~/maildown.toml"), "w") as f:
-        f.write(toml.dumps(config))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".maildown-", suffix=".toml")
+    try:
+        with open(fd, "w") as f:
+            f.write(toml.dumps(existing))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    clear_config_cache()
@@ -0,0 +1,16 @@
+import pytest
+from maildown import renderer, templates, utilities
+
+
+@pytest.fixture(autouse=True)
+def home(monkeypatch, tmp_path):
+    """
+    Keeps the tests away from the real ~/maildown.toml
+    """
+    monkeypatch.setenv("HOME", str(tmp_path))
+    utilities.clear_config_cache()
+    templates.clear_caches()
+    renderer.render_markdown.cache_clear()
+    yield tmp_path
+    utilities.clear_config_cache()
+    templates.clear_caches()
@@ -0,0 +1,155 @@
+import asyncio
+import socketserver
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import mock
+import pytest
+from maildown import backends, utilities
+from maildown.backends import aio
+
+
+SEND_EMAIL_RESPONSE = """<SendEmailResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <SendEmailResult><MessageId>{message_id}</MessageId></SendEmailResult>
+  <ResponseMetadata><RequestId>request</RequestId></ResponseMetadata>
+</SendEmailResponse>"""
+
+SEND_QUOTA_RESPONSE = """<GetSendQuotaResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <GetSendQuotaResult><Max24HourSend>-1</Max24HourSend><MaxSendRate>1000</MaxSendRate>
+  <SentLast24Hours>0</SentLast24Hours></GetSendQuotaResult>
+  <ResponseMetadata><RequestId>request</RequestId></ResponseMetadata>
+</GetSendQuotaResponse>"""
+
+ERROR_RESPONSE = """<ErrorResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <Error><Type>Sender</Type><Code>{code}</Code><Message>{message}</Message></Error>
+  <RequestId>request</RequestId>
+</ErrorResponse>"""
+
+
+class StubSes(BaseHTTPRequestHandler):
+    """
+    Stands in for the SES query API. Sends to addresses starting with `bad` are rejected, and those starting with
+    `throttle` are throttled
+    """
+
+    requests: list = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        params = dict(urllib.parse.parse_qsl(body))
+        self.requests.append(params)
+
+        to = params.get("Destination.ToAddresses.member.1", "")
+        if params["Action"] == "GetSendQuota":
+            status, response = 200, SEND_QUOTA_RESPONSE
+        elif to.startswith("bad"):
+            status, response = 400, ERROR_RESPONSE.format(code="MessageRejected", message="Address rejected")
+        elif to.startswith("throttle"):
+            status, response = 400, ERROR_RESPONSE.format(code="Throttling", message="Maximum sending rate exceeded")
+        else:
+            status, response = 200, SEND_EMAIL_RESPONSE.format(message_id=to)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def ses():
+    StubSes.requests = []
+    server = StubServer(("127.0.0.1", 0), StubSes)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    utilities.write_config(aws=dict(access_key="access_key", secret_key="secret_key"))
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_send_many(ses):
+    pytest.importorskip("aiobotocore")
+    recipients = [dict(email=f"{i}@email.com", name=str(i)) for i in range(30)]
+    recipients.append(dict(email="bad@email.com", name="bad"))
+
+    async def send():
+        async with backends.AsyncAwsBackend(endpoint_url=ses, rate_limit=False) as backend:
+            return await backend.send_many(
+                "me@email.com", "test", iter(recipients), content="Hi {{ name }}", concurrency=5
+            )
+
+    results = run(send())
+
+    assert len(results) == 31
+    assert {result.recipient: result.response["MessageId"] for result in results if not result.error} == {
+        f"{i}@email.com": f"{i}@email.com" for i in range(30)
+    }
+    failed = [result for result in results if result.error]
+    assert [result.recipient for result in failed] == ["bad@email.com"]
+    assert "MessageRejected" in str(failed[0].error)
+
+    sent = {request["Destination.ToAddresses.member.1"]: request for request in StubSes.requests}
+    assert sent["7@email.com"]["Action"] == "SendEmail"
+    assert "Hi 7" in sent["7@email.com"]["Message.Body.Html.Data"]
+
+
+def test_send(ses):
+    pytest.importorskip("aiobotocore")
+
+    async def send():
+        backend = backends.AsyncAwsBackend(endpoint_url=ses, rate_limit=False)
+        try:
+            return await backend.send("me@email.com", "test", ["you@email.com"], content="Hello")
+        finally:
+            await backend.close()
+
+    assert run(send())["MessageId"] == "you@email.com"
+    assert StubSes.requests[0]["Source"] == "me@email.com"
+
+
+def test_throttle_retries(ses, monkeypatch):
+    pytest.importorskip("aiobotocore")
+    # The quota is read through the async client, rather than a blocking boto3 one
+    monkeypatch.setattr(backends.AwsBackend, "create_client", mock.MagicMock(side_effect=AssertionError))
+
+    # botocore's own retries are turned off, so only the backend's are counted
+    utilities.write_config(aws=dict(access_key="access_key", secret_key="secret_key", max_attempts=0))
+
+    async def send():
+        async with backends.AsyncAwsBackend(endpoint_url=ses, throttle_retries=1) as backend:
+            results = await backend.send_many("me@email.com", "test", [dict(email="throttle@email.com")], content="Hi")
+            return backend, results
+
+    backend, [result] = run(send())
+    assert "Throttling" in str(result.error)
+    assert [request["Action"] for request in StubSes.requests] == ["GetSendQuota", "SendEmail", "SendEmail"]
+    assert backend.backend.rate_limiter.max_rate == 1000
+
+
+def test_base_backend():
+    backend = aio.AsyncBaseBackend()
+    with pytest.raises(NotImplementedError):
+        run(backend.send_message(["you@email.com"], "me@email.com", "", "", "test"))
+    with pytest.raises(AttributeError):
+        run(backend.send("me@email.com", "test", ["you@email.com"]))
+    with pytest.raises(AttributeError):
+        run(backend.send_many("me@email.com", "test", []))
+
+    results = run(backend.send_many("me@email.com", "test", [dict(email="you@email.com")], content="Hi"))
+    assert isinstance(results[0].error, NotImplementedError)
@@ -1,5 +1,9 @@
+import os
+import subprocess
+import sys
 import mock
 from maildown.application import application
+from maildown import renderer
 import maildown
 
 
@@ -7,3 +11,68 @@ def test_app(monkeypatch):
     monkeypatch.setattr(application, "run", mock.MagicMock())
     maildown.run()
     application.run.assert_called_with()
+
+
+HEAVY_MODULES = {"boto3", "botocore", "premailer", "pygments", "jinja2", "mistune", "lxml", "cssutils"}
+
+
+def import_times(statement):
+    """
+    Returns the cumulative import time, in microseconds, of every module imported by `statement`
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement], stderr=subprocess.PIPE, universal_newlines=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_startup_imports():
+    times = import_times("import maildown.application")
+    top_level = {module.split(".")[0] for module in times}
+    assert not top_level & HEAVY_MODULES
+
+    # Everything maildown itself adds on top of cleo should be small compared to cleo
+    assert times["maildown.application"] < 3 * times["cleo.application"]
+
+    top_level = {module.split(".")[0] for module in import_times("import maildown.backends.aws")}
+    assert "boto3" in top_level
+    assert not top_level & {"premailer", "pygments", "jinja2", "mistune"}
+
+    # Importing one backend doesn't import the others' dependencies
+    top_level = {module.split(".")[0] for module in import_times("import maildown.backends.smtp")}
+    assert not top_level & {"boto3", "botocore"}
+    top_level = {module.split(".")[0] for module in import_times("from maildown.backends import SmtpBackend")}
+    assert not top_level & {"boto3", "botocore"}
+
+
+SEND_ARTIFACT = """
+from maildown.backends.base import BaseBackend
+
+class Backend(BaseBackend):
+    def send_message(self, *args):
+        return dict(MessageId="1")
+
+results = list(Backend().iter_send_many("me@email.com", "Hi", [dict(email="you@email.com")], file_path={artifact!r}))
+assert Backend().send("me@email.com", "Hi", ["you@email.com"], file_path={artifact!r})
+if not results[0].error:
+    open({done!r}, "w").close()
+"""
+
+
+def test_artifact_send_imports(tmp_path):
+    # Sending a compiled artifact needs jinja, but not the renderer, markdown, pygments or the css inliner
+    artifact, done = str(tmp_path / "email.mdc"), str(tmp_path / "done")
+    renderer.compile_content("# Hello {{ name }}").save(artifact)
+    times = import_times(SEND_ARTIFACT.format(artifact=artifact, done=done))
+    assert os.path.exists(done)
+
+    top_level = {module.split(".")[0] for module in times}
+    assert "jinja2" in top_level
+    assert not top_level & {"premailer", "pygments", "mistune", "lxml", "cssutils"}
+    assert "maildown.renderer" not in times
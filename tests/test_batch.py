@@ -0,0 +1,69 @@
+import json
+import pytest
+from maildown import batch
+
+
+@pytest.fixture
+def documents(tmp_path):
+    (tmp_path / "digests" / "emea").mkdir(parents=True)
+    (tmp_path / "digests" / "emea" / "sales.md").write_text("# Sales {{ region }} {{ team }}")
+    (tmp_path / "digests" / "emea" / "sales.json").write_text(json.dumps(dict(team="Sales")))
+    (tmp_path / "digests" / "support.markdown").write_text("# Support {{ region }}\n\n```python\nx = 1\n```")
+    (tmp_path / "digests" / "notes.txt").write_text("not markdown")
+    (tmp_path / "broken.md").write_text("{% if %}")
+    return tmp_path
+
+
+def test_find_files(documents):
+    digests = str(documents / "digests")
+    assert batch.find_files([digests]) == [
+        (f"{digests}/support.markdown", "support.markdown"),
+        (f"{digests}/emea/sales.md", "emea/sales.md"),
+    ]
+    assert [relative for _, relative in batch.find_files([f"{digests}/**/*", f"{digests}/support.markdown"])] == [
+        "sales.md",
+        "support.markdown",
+    ]
+    assert batch.find_files([f"{digests}/notes.txt"]) == [(f"{digests}/notes.txt", "notes.txt")]
+    assert batch.find_files([f"{documents}/missing*.md"]) == []
+
+
+def test_plan(documents):
+    digests = str(documents / "digests")
+    jobs = batch.plan([digests], context=dict(region="EMEA", team="None"))
+    assert jobs[0] == batch.RenderJob(
+        f"{digests}/support.markdown", f"{digests}/support.html", dict(region="EMEA", team="None")
+    )
+    assert jobs[1].context == dict(region="EMEA", team="Sales")
+
+    jobs = batch.plan([digests], output_dir=str(documents / "out"))
+    assert [job.output for job in jobs] == [f"{documents}/out/support.html", f"{documents}/out/emea/sales.html"]
+
+    # A malformed context file fails only its own markdown file
+    (documents / "digests" / "emea" / "sales.json").write_text("{")
+    jobs = batch.plan([digests])
+    assert jobs[0].error is None
+    assert "Can't read the context in" in jobs[1].error
+    result = batch.render_file(jobs[1])
+    assert result.error == jobs[1].error
+    assert not (documents / "digests" / "emea" / "sales.html").exists()
+
+    # Files with the same name from different places can't be written to the same html file
+    (documents / "other").mkdir()
+    (documents / "other" / "support.md").write_text("# Other")
+    with pytest.raises(ValueError, match="would both be rendered to"):
+        batch.plan([f"{digests}/*.markdown", f"{documents}/other/*.md"], output_dir=str(documents / "out"))
+    assert len(batch.plan([f"{digests}/*.markdown", f"{documents}/other/*.md"])) == 2
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_render_files(documents, workers):
+    paths = [str(documents / "digests"), str(documents / "broken.md")]
+    jobs = batch.plan(paths, str(documents / "out"), dict(region="EMEA"))
+    results = list(batch.render_files(jobs, workers=workers))
+
+    assert [result.source for result in results] == [job.source for job in jobs]
+    assert [result.error is None for result in results] == [True, True, False]
+    assert "TemplateSyntaxError" in results[2].error
+    assert "Sales EMEA Sales" in (documents / "out" / "emea" / "sales.html").read_text()
+    assert 'class="highlight"' in (documents / "out" / "support.html").read_text()
@@ -0,0 +1,25 @@
+import io
+import json
+from benchmarks import run
+
+
+def test_run(tmp_path):
+    output = tmp_path / "results.json"
+    run.main(["-k", "config", "-r", "2", "--min-time", "0", "-o", str(output)])
+
+    results = json.loads(output.read_text())
+    assert set(results["results"]) == {"config.lookup", "config.get_config"}
+    assert results["results"]["config.lookup"]["ops"] == 1000
+    assert results["results"]["config.lookup"]["runs"] >= 2
+    assert "python" in results["metadata"]
+
+    out = io.StringIO()
+    previous = {"config.lookup": dict(results["results"]["config.lookup"], median=1.0)}
+    run.compare(dict(previous, other={}), dict(previous, **{"config.lookup": dict(median=2.0)}), out=out)
+    assert "-50.0%" in out.getvalue()
+
+
+def test_send(capsys):
+    results = run.run("send.send_many.workers=10", repeat=1, min_time=0)
+    assert results["send.send_many.workers=10"]["ops"] == 200
+    assert "send.send_many.workers=10" in capsys.readouterr().out
@@ -1,6 +1,6 @@
 from cleo.testers import CommandTester
 from maildown.application import application
-from maildown import backends
+from maildown import backends, commands, jobs, renderer, sendlog
 import mock
 
 
@@ -44,7 +44,7 @@ def test_verify(monkeypatch):
 
 
 def test_send(monkeypatch):
-    monkeypatch.setattr(backends.AwsBackend, "send", mock.MagicMock())
+    monkeypatch.setattr(backends.AwsBackend, "send", mock.MagicMock(return_value=dict(MessageId="abc")))
 
     command = application.find("send")
     command_tester = CommandTester(command)
@@ -60,7 +60,10 @@ def test_send(monkeypatch):
         context={},
     )
 
-    assert "Messages added to queue" in command_tester.io.fetch_output()
+    assert "1 of 1 messages sent as message abc" in command_tester.io.fetch_output()
+    [record] = sendlog.read()
+    assert (record.campaign, record.recipient, record.message_id) == ("test", "somebody@email.com", "abc")
+    assert record.status == sendlog.DELIVERED
 
     command_tester.execute("me@email.com test --c test")
 
@@ -76,3 +79,251 @@ def test_send(monkeypatch):
     command_tester.execute("--backend=grrr me@email.com test somebody@email.com")
     assert 'No backend called grrr' in command_tester.io.fetch_output()
 
+
+def test_send_recipients_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(backends.AwsBackend, "iter_send_many", mock.MagicMock())
+    recipients_file = tmp_path / "recipients.csv"
+    recipients_file.write_text("email,name\nfirst@email.com,First\nOTHER@email.com,Other\n")
+
+    backends.AwsBackend().iter_send_many.return_value = iter([
+        backends.base.SendResult("first@email.com", {}),
+        backends.base.SendResult("other@email.com", error=ValueError("bad address")),
+    ])
+
+    command = application.find("send")
+    command_tester = CommandTester(command)
+    command_tester.execute(f"me@email.com test --c test -w 4 -r {recipients_file} other@email.com")
+
+    kwargs = backends.AwsBackend().iter_send_many.call_args[1]
+    assert kwargs["workers"] == 4
+    assert "to" not in kwargs
+    assert list(kwargs["recipients"]) == [
+        dict(email="other@email.com"),
+        dict(email="first@email.com", name="First"),
+    ]
+
+    output = command_tester.io.fetch_output()
+    assert "Failed to send to other@email.com: bad address" in output
+    assert "1 of 2 messages sent" in output
+
+    command_tester.execute(f"me@email.com test --c test --dedupe=none -r {recipients_file} other@email.com")
+    assert len(list(backends.AwsBackend().iter_send_many.call_args[1]["recipients"])) == 3
+
+    command_tester.execute(f"me@email.com test --c test --dedupe=bloom -r {recipients_file} other@email.com")
+    assert len(list(backends.AwsBackend().iter_send_many.call_args[1]["recipients"])) == 2
+
+    command_tester.execute(f"me@email.com test --c test --dedupe=grrr -r {recipients_file}")
+    assert "Unknown dedupe option grrr" in command_tester.io.fetch_output()
+
+
+def test_send_bulk(monkeypatch, tmp_path):
+    monkeypatch.setattr(backends.AwsBackend, "iter_send_bulk", mock.MagicMock())
+    recipients_file = tmp_path / "recipients.txt"
+    recipients_file.write_text("first@email.com\n")
+    backends.AwsBackend().iter_send_bulk.return_value = iter([backends.base.SendResult("first@email.com", {})])
+
+    command = application.find("send")
+    command_tester = CommandTester(command)
+    command_tester.execute(f"me@email.com test --c test --bulk -r {recipients_file}")
+
+    kwargs = backends.AwsBackend().iter_send_bulk.call_args[1]
+    assert "workers" not in kwargs
+    assert list(kwargs["recipients"]) == [dict(email="first@email.com")]
+    assert "1 of 1 messages sent" in command_tester.io.fetch_output()
+
+    monkeypatch.delattr(backends.AwsBackend, "iter_send_bulk")
+    command_tester.execute(f"me@email.com test --c test --bulk -r {recipients_file}")
+    assert "The aws backend does not support bulk sending" in command_tester.io.fetch_output()
+
+
+def test_send_async(monkeypatch):
+    async def iter_send_many(**kwargs):
+        for recipient in kwargs["recipients"]:
+            error = ValueError("bad") if "bad" in recipient["email"] else None
+            yield backends.base.SendResult(recipient["email"], error=error)
+
+    monkeypatch.setattr(backends.AsyncAwsBackend, "iter_send_many", mock.MagicMock(side_effect=iter_send_many))
+
+    command = application.find("send")
+    command_tester = CommandTester(command)
+    command_tester.execute("me@email.com test --c test --async --concurrency 7 you@email.com bad@email.com")
+
+    assert backends.AsyncAwsBackend.iter_send_many.call_args[1]["concurrency"] == 7
+    output = command_tester.io.fetch_output()
+    assert "Failed to send to bad@email.com: bad" in output
+    assert "1 of 2 messages sent" in output
+
+    monkeypatch.setattr(commands, "async_backends", {})
+    command_tester.execute("me@email.com test --c test --async you@email.com")
+    assert "The aws backend does not support async sending" in command_tester.io.fetch_output()
+
+
+def test_send_queue_and_resume(monkeypatch):
+    monkeypatch.setattr(backends.AwsBackend, "send_message", mock.MagicMock(return_value=dict(MessageId="1")))
+
+    command_tester = CommandTester(application.find("send"))
+    command_tester.execute("me@email.com test --c test --queue you@email.com them@email.com")
+    output = command_tester.io.fetch_output()
+    job_id = output.split("as job ")[1].split()[0]
+    assert f"Job {job_id}: 2 sent, 0 failed, 0 pending" in output
+
+    with jobs.SendQueue() as queue:
+        job_id = queue.create_job("aws", "me@email.com", "test", "test")
+        queue.enqueue(job_id, [dict(email="you@email.com"), dict(email="them@email.com")])
+        queue.checkpoint(job_id, jobs.idempotency_key(job_id, "you@email.com"), "1")
+
+    backends.AwsBackend.send_message.reset_mock()
+    command_tester = CommandTester(application.find("resume"))
+    command_tester.execute(job_id)
+    assert f"Job {job_id}: 2 sent, 0 failed, 0 pending" in command_tester.io.fetch_output()
+    assert backends.AwsBackend.send_message.call_count == 1
+
+    command_tester.execute("missing")
+    assert "No job with id missing exists" in command_tester.io.fetch_output()
+
+    with jobs.SendQueue() as queue:
+        job_id = queue.create_job("grrr", "me@email.com", "test", "test")
+    command_tester.execute(job_id)
+    assert "No backend called grrr exists" in command_tester.io.fetch_output()
+
+    # --queue can't be resumed if another mode sends the messages instead, so conflicting modes are refused
+    command_tester = CommandTester(application.find("send"))
+    backends.AwsBackend.send_message.reset_mock()
+    for options in ("--queue --async", "--queue --bulk", "--async --bulk"):
+        command_tester.execute(f"me@email.com test --c test {options} you@email.com")
+        assert "Only one of --bulk, --async and --queue" in command_tester.io.fetch_output()
+    assert not backends.AwsBackend.send_message.called
+
+
+def test_render(tmp_path):
+    (tmp_path / "first.md").write_text("# Hello {{ name }}")
+    (tmp_path / "second.md").write_text("# Goodbye {{ name }}")
+
+    command_tester = CommandTester(application.find("render"))
+    command_tester.execute(f"{tmp_path} -w 2 -e name=Chris -o {tmp_path / 'html'}")
+    assert "2 of 2 files rendered" in command_tester.io.fetch_output()
+    assert "Goodbye Chris" in (tmp_path / "html" / "second.html").read_text()
+
+    command_tester.execute(f"{tmp_path / 'missing'}")
+    assert "No markdown files found" in command_tester.io.fetch_output()
+
+    (tmp_path / "more").mkdir()
+    (tmp_path / "more" / "first.md").write_text("# Again")
+    command_tester.execute(f"{tmp_path}/*.md {tmp_path}/more/*.md -o {tmp_path / 'html'}")
+    assert "would both be rendered to" in command_tester.io.fetch_output()
+
+
+def test_compile(monkeypatch, tmp_path):
+    (tmp_path / "email.md").write_text("# Hello {{ name }}")
+    monkeypatch.setattr(backends.AwsBackend, "send_message", mock.MagicMock())
+
+    command_tester = CommandTester(application.find("compile"))
+    command_tester.execute(f"{tmp_path / 'email.md'}")
+    assert "Compiled" in command_tester.io.fetch_output()
+    assert (tmp_path / "email.mdc").exists()
+
+    command_tester.execute(f"{tmp_path / 'email.md'} -o {tmp_path / 'email.html'}")
+    assert "must have a .mdc extension" in command_tester.io.fetch_output()
+
+    command_tester = CommandTester(application.find("send"))
+    command_tester.execute(f"me@email.com Hello -f {tmp_path / 'email.mdc'} -e name=Chris to@email.com")
+    to, sender, html, content, subject = backends.AwsBackend.send_message.call_args[0]
+    assert "Hello Chris" in html
+    assert content == "# Hello {{ name }}"
+
+    # --highlight-workers is passed through to the renderer by compile and send
+    monkeypatch.setattr(renderer, "prehighlight", mock.MagicMock())
+    (tmp_path / "code.md").write_text("# Code")
+    CommandTester(application.find("compile")).execute(f"{tmp_path / 'code.md'} --highlight-workers 3")
+    renderer.prehighlight.assert_called_with("# Code", 3)
+    renderer.prehighlight.reset_mock()
+    (tmp_path / "other.md").write_text("# Goodbye")
+    send_tester = CommandTester(application.find("send"))
+    send_tester.execute(f"me@email.com Hello -f {tmp_path / 'other.md'} --highlight-workers 2 to@email.com")
+    renderer.prehighlight.assert_called_with("# Goodbye", 2)
+
+
+def test_serve(monkeypatch, tmp_path):
+    from maildown import server
+
+    monkeypatch.setattr(server.Daemon, "warm", mock.MagicMock())
+    monkeypatch.setattr(server.TCPServer, "serve_forever", mock.MagicMock(side_effect=KeyboardInterrupt))
+    monkeypatch.setattr(server.Daemon, "close", mock.MagicMock())
+
+    command_tester = CommandTester(application.find("serve"))
+    command_tester.execute("--port 0 --no-log")
+    assert "Listening on http://127.0.0.1:0" in command_tester.io.fetch_output()
+    server.Daemon.warm.assert_called_once_with()
+    server.Daemon.close.assert_called_once_with()
+
+    command_tester.execute("--backend=grrr")
+    assert "No backend called grrr" in command_tester.io.fetch_output()
+
+
+def test_suppress(monkeypatch, tmp_path):
+    bounces = tmp_path / "bounces.txt"
+    bounces.write_text("bounced@email.com\nother@email.com\n")
+
+    command_tester = CommandTester(application.find("suppress"))
+    command_tester.execute(f"{bounces} --reason=bounce")
+    output = command_tester.io.fetch_output()
+    assert f"Added 2 addresses from {bounces}" in output
+    assert "2 addresses suppressed" in output
+
+    command_tester.execute("--remove=other@email.com")
+    assert "Removed 1 addresses" in command_tester.io.fetch_output()
+
+    monkeypatch.setattr(backends.AwsBackend, "send_message", mock.MagicMock(return_value={}))
+    command_tester = CommandTester(application.find("send"))
+    command_tester.execute(f"me@email.com test --c test -r {bounces}")
+    assert "1 of 1 messages sent, 1 skipped as suppressed" in command_tester.io.fetch_output()
+
+
+def test_send_dry_run(tmp_path):
+    recipients_file = tmp_path / "recipients.csv"
+    recipients_file.write_text("email,name\nfirst@email.com,First\nsecond@email.com,Second\n")
+    output = tmp_path / "out.mbox"
+
+    command_tester = CommandTester(application.find("send"))
+    command_tester.execute(f"me@email.com test --c test --dry-run -o {output} -r {recipients_file}")
+    assert "2 of 2 messages built" in command_tester.io.fetch_output()
+    assert output.read_text().count("From maildown ") == 2
+
+    command_tester.execute(f"me@email.com test --c test --dry-run -o {tmp_path / 'single'} one@email.com")
+    assert "1 messages written" in command_tester.io.fetch_output()
+    assert len(list((tmp_path / "single").iterdir())) == 1
+
+    command_tester.execute("me@email.com test --c test --dry-run one@email.com")
+    assert "--dry-run needs an --output" in command_tester.io.fetch_output()
+
+    command_tester.execute(f"me@email.com test --c test --dry-run --bulk -o {output} one@email.com")
+    assert "can't be combined" in command_tester.io.fetch_output()
+
+
+def test_report(monkeypatch, tmp_path):
+    command_tester = CommandTester(application.find("report"))
+    command_tester.execute("")
+    assert "No sends have been logged" in command_tester.io.fetch_output()
+
+    monkeypatch.setattr(backends.AwsBackend, "iter_send_many", mock.MagicMock())
+    backends.AwsBackend().iter_send_many.return_value = iter([
+        backends.base.SendResult("first@email.com", dict(MessageId="1"), latency=0.02),
+        backends.base.SendResult("other@email.com", error=ValueError("bad address"), latency=0.04),
+    ])
+    recipients_file = tmp_path / "recipients.txt"
+    recipients_file.write_text("first@email.com\nother@email.com\n")
+    send_tester = CommandTester(application.find("send"))
+    send_tester.execute(f"me@email.com test --c test --campaign=launch -r {recipients_file}")
+
+    command_tester.execute("--errors")
+    output = command_tester.io.fetch_output()
+    assert "launch" in output
+    assert "ValueError: 1" in output
+    row = next(line for line in output.splitlines() if "launch" in line and "|" in line)
+    assert [cell.strip() for cell in row.strip("| ").split("|")] == ["launch", "1", "1", "0", "20", "40", "40"]
+
+    command_tester.execute("missing")
+    assert "No logged sends match" in command_tester.io.fetch_output()
+
+    command_tester.execute("--since=grrr")
+    assert "Can't read grrr as a time" in command_tester.io.fetch_output()
@@ -0,0 +1,84 @@
+import json
+import mock
+import threading
+from maildown import backends
+from maildown.backends import identities
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_identity_cache(tmp_path):
+    clock = Clock()
+    path = str(tmp_path / "identities.json")
+    fetch = mock.MagicMock(return_value={"me@email.com", "example.com"})
+    cache = identities.IdentityCache(fetch, path, ttl=100, clock=clock)
+
+    assert cache.is_verified(" Me@Email.com")
+    assert cache.is_verified("anyone@example.com")
+    assert not cache.is_verified("you@email.com")
+    assert cache.check(["me@email.com", "you@email.com"]) == {"me@email.com": True, "you@email.com": False}
+    assert fetch.call_count == 1
+    with open(path) as f:
+        assert json.load(f) == dict(fetched=1000.0, identities=["example.com", "me@email.com"])
+
+    cache.refresh(force=False)
+    assert fetch.call_count == 1
+    clock.now += identities.MIN_REFRESH_INTERVAL + 1
+    cache.refresh(force=False)
+    assert fetch.call_count == 2
+
+    fetched = threading.Event()
+    fetch.side_effect = lambda: fetched.wait(5) and {"you@email.com"}
+    clock.now += 101
+    assert cache.is_verified("me@email.com")
+    fetched.set()
+    cache._refreshing.join()
+    assert fetch.call_count == 3
+    assert cache.is_verified("you@email.com")
+    assert not cache.is_verified("me@email.com")
+
+    loaded = identities.IdentityCache(mock.MagicMock(), path, ttl=100, clock=clock)
+    assert loaded.is_verified("you@email.com")
+    loaded.fetch.assert_not_called()
+
+
+def test_fetch_identities(monkeypatch):
+    monkeypatch.setattr(backends.AwsBackend, "client", mock.MagicMock())
+    client = backends.AwsBackend.client
+    client.list_identities.side_effect = [
+        dict(Identities=[f"{i}@email.com" for i in range(150)], NextToken="next"),
+        dict(Identities=["example.com"]),
+    ]
+    client.get_identity_verification_attributes.side_effect = lambda Identities: dict(
+        VerificationAttributes={
+            identity: dict(VerificationStatus="Pending" if identity.startswith("1") else "Success")
+            for identity in Identities
+        }
+    )
+
+    backend = backends.AwsBackend()
+    assert backend.verify_addresses(["0@email.com", "1@email.com", "me@example.com"]) == {
+        "0@email.com": True,
+        "1@email.com": False,
+        "me@example.com": True,
+    }
+    assert client.list_identities.call_args_list == [
+        mock.call(MaxItems=1000),
+        mock.call(MaxItems=1000, NextToken="next"),
+    ]
+    assert [len(call[1]["Identities"]) for call in client.get_identity_verification_attributes.call_args_list] == [
+        100,
+        50,
+        1,
+    ]
+
+    assert backend.is_verified("2@email.com")
+    assert backend.verify_address("2@email.com") is True
+    assert client.list_identities.call_count == 2
+    client.verify_email_address.assert_not_called()
@@ -0,0 +1,64 @@
+import premailer
+import pytest
+from maildown import inliner, renderer
+
+
+STYLESHEET = """
+p, li { margin: 15px 0; color: #333 }
+p.note, .note { color: blue !important; width: 10px; background-color: #abc }
+a:hover { color: red }
+li:first-child { font-weight: bold }
+tr:nth-child(even) { background: #eee }
+img { float: left; height: 20px }
+h2 em { text-align: center; vertical-align: top }
+#box > span { color: green; margin: unset }
+* { box-sizing: border-box }
+@media (max-width: 600px) { p { font-size: 12px } h1 { color: red !important } }
+"""
+
+BODY = """
+<h1>Title</h1>
+<h2>A <em>heading</em></h2>
+<p>First</p>
+<p class="note  other" style="color: black; padding: 2px">Inline</p>
+<div id="box"><span>Span</span></div>
+<ul><li>One</li><li class="note">Two</li></ul>
+<table><tr><td>1</td></tr><tr><td>2</td></tr></table>
+<img src="a.png" alt="a">
+"""
+
+
+@pytest.mark.parametrize("html", [
+    f"<style>{STYLESHEET}</style>{BODY}",
+    f"<!DOCTYPE html><html><head><style>{STYLESHEET}</style><style>p {{ color: green }}</style></head>"
+    f"<body>{BODY}</body></html>",
+    f'<style media="print">p {{ color: red }}</style>{BODY}',
+    f"<style></style>{BODY}",
+    BODY,
+])
+def test_transform(html):
+    assert inliner.transform(html) == premailer.transform(html)
+
+
+def test_default_theme():
+    with open(renderer.DEFAULT_THEME) as f:
+        stylesheet = f.read()
+    with open(renderer.TEMPLATE) as f:
+        template = f.read()
+    content = renderer.HighlightRenderer.block_code("print('hi')", "python") + BODY
+    html = template.replace("{{ stylesheet }}", stylesheet).replace("{{ content }}", content)
+
+    assert inliner.transform(html) == premailer.transform(html)
+
+
+def test_stylesheet():
+    inliner.compile_stylesheet.cache_clear()
+    assert inliner.compile_stylesheet(STYLESHEET) is inliner.compile_stylesheet(STYLESHEET)
+
+    sheet = inliner.compile_stylesheet(STYLESHEET)
+    assert [rule.specificity for rule in sheet.rules] == sorted(rule.specificity for rule in sheet.rules)
+    assert sheet.rules[-1].pairs == (("color", "blue"),)
+    assert sheet.rules[0].simple == "p"
+    assert "a:hover {color:red}" in sheet.leftover
+    assert "@media" in sheet.leftover
+    assert "!important" not in sheet.leftover
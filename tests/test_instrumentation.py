@@ -0,0 +1,133 @@
+import json
+import mock
+from botocore.exceptions import ClientError
+from cleo.testers import CommandTester
+import pytest
+from maildown import backends, instrumentation, renderer
+from maildown.application import application
+
+
+def test_span():
+    assert not instrumentation.enabled()
+    assert instrumentation.span("nothing") is instrumentation.span("listening")
+
+    spans = []
+    with instrumentation.recording(spans.append):
+        assert instrumentation.enabled()
+        with instrumentation.span("outer", region="eu-west-1"):
+            pass
+        with pytest.raises(ValueError):
+            with instrumentation.span("failing"):
+                raise ValueError()
+        instrumentation.event("happened")
+
+    assert not instrumentation.enabled()
+    assert [(span.name, span.error) for span in spans] == [
+        ("outer", None),
+        ("failing", "ValueError"),
+        ("happened", None),
+    ]
+    assert spans[0].labels == dict(region="eu-west-1")
+    assert spans[0].duration >= 0
+    assert spans[2].duration is None
+
+
+def test_failing_hook():
+    def hook(span):
+        raise RuntimeError()
+
+    with instrumentation.recording(hook):
+        with instrumentation.span("ignored"):
+            pass
+
+
+def test_metrics():
+    metrics = instrumentation.Metrics(reservoir=10)
+    for i in range(100):
+        metrics(instrumentation.Span("phase", 0, i / 1000, {}, "Error" if i % 10 == 0 else None))
+    metrics(instrumentation.Span("throttle", 0, None, dict(region="us-east-1")))
+
+    series = metrics.get("phase")
+    assert series.count == 100
+    assert series.errors == 10
+    assert len(series.samples) == 10
+    assert series.total == pytest.approx(4.95)
+    assert 0 <= series.quantile(0.5) <= series.quantile(0.99) <= 0.099
+    assert metrics.get("missing") is None
+    assert metrics.events == {("throttle", (("region", "us-east-1"),)): 1}
+
+
+def test_exporters(tmp_path):
+    lines = []
+    log = instrumentation.LogExporter(lines.append)
+    prometheus = instrumentation.PrometheusExporter(str(tmp_path / "maildown.prom"))
+    trace = instrumentation.JsonTraceExporter(str(tmp_path / "trace.json"))
+    renderer._compile.cache_clear()
+    renderer.clear_highlight_cache()
+
+    with instrumentation.recording(log, prometheus, trace):
+        renderer.generate_content("# Hello {{ name }}\n\n```python\nprint(1)\n```", context=dict(name="Chris"))
+        instrumentation.event("aws.throttle", region='us-"east"-1')
+
+    phases = ["render.markdown", "render.highlight", "render.template", "render.inline", "render.context"]
+    for phase in phases:
+        assert log.get(phase).count == 1
+    assert any(line.startswith("render.inline: 1 calls, p50") for line in lines)
+    assert "aws.throttle[region=us-\"east\"-1]: 1 times" in lines
+
+    text = (tmp_path / "maildown.prom").read_text()
+    assert "# TYPE maildown_span_seconds summary" in text
+    assert 'maildown_span_seconds{span="render.markdown",quantile="0.99"}' in text
+    assert 'maildown_span_seconds_count{span="render.context"} 1' in text
+    assert 'maildown_span_errors_total{span="render.inline"} 0' in text
+    assert 'maildown_events_total{region="us-\\"east\\"-1",event="aws.throttle"} 1' in text
+
+    events = json.loads((tmp_path / "trace.json").read_text())
+    assert [event["name"] for event in events if event["ph"] == "X"] == [
+        "render.highlight",
+        "render.markdown",
+        "render.template",
+        "render.inline",
+        "render.context",
+    ]
+    assert events[-1]["ph"] == "i"
+    assert all(event["dur"] >= 0 for event in events if event["ph"] == "X")
+
+
+def test_send_spans(monkeypatch):
+    throttle = ClientError({"Error": {"Code": "Throttling", "Message": "Maximum sending rate exceeded."}}, "SendEmail")
+    monkeypatch.setattr(backends.AwsBackend, "client", mock.MagicMock())
+    client = backends.AwsBackend.client
+    client.meta.region_name = "eu-west-1"
+    client.get_send_quota.return_value = dict(MaxSendRate=1000.0, Max24HourSend=-1)
+    client.send_email.side_effect = [throttle, {"MessageId": "1"}, ClientError({"Error": {}}, "SendEmail")]
+
+    backend = backends.AwsBackend()
+    backend.rate_limiter.sleep = backend.rate_limiter.bucket.sleep = mock.MagicMock()
+    metrics = instrumentation.Metrics()
+    with instrumentation.recording(metrics):
+        backend.send_many("me@email.com", "test", [dict(email="you@email.com"), dict(email="bad@email.com")],
+                          content="Hi", workers=1)
+
+    assert metrics.get("aws.send_email", region="eu-west-1").count == 3
+    assert metrics.get("aws.send_email", region="eu-west-1").errors == 2
+    assert metrics.get("aws.wait", region="eu-west-1").count == 3
+    assert metrics.get("send.message", backend="aws").count == 2
+    assert metrics.get("send.message", backend="aws").errors == 1
+    assert metrics.events[("aws.throttle", (("region", "eu-west-1"),))] == 1
+
+
+def test_send_command(monkeypatch, tmp_path):
+    monkeypatch.setattr(backends.AwsBackend, "send_message", mock.MagicMock())
+
+    command_tester = CommandTester(application.find("send"))
+    command_tester.execute(
+        f"me@email.com test --c test --stats --prometheus {tmp_path / 'metrics.prom'} "
+        f"--trace {tmp_path / 'trace.json'} you@email.com"
+    )
+
+    output = command_tester.io.fetch_output()
+    assert "send.message[backend=aws]: 1 calls" in output
+    assert "send.message" in (tmp_path / "metrics.prom").read_text()
+    assert "send.message" in [event["name"] for event in json.loads((tmp_path / "trace.json").read_text())]
+    assert not instrumentation.enabled()
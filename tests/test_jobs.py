@@ -0,0 +1,87 @@
+import pytest
+import mock
+from maildown import jobs, backends
+
+
+class FakeBackend(backends.base.BaseBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send_message(self, to, sender, html, content, subject):
+        if to[0].startswith("bad"):
+            raise ValueError("rejected")
+        self.sent.append((to[0], html))
+        return dict(MessageId=f"id-{to[0]}")
+
+
+def test_queue(monkeypatch, home):
+    monkeypatch.setattr(jobs, "PAGE_SIZE", 3)
+    with jobs.SendQueue() as queue:
+        assert queue.path == str(home / ".maildown" / "queue.db")
+        job_id = queue.create_job("aws", "me@email.com", "test", "Hi {{ name }}", context=dict(a=1))
+        job = queue.get_job(job_id)
+        assert job["status"] == "queued"
+        assert job["context"] == dict(a=1)
+
+        recipients = [dict(email=f"{i}@email.com", name=str(i)) for i in range(10)]
+        assert queue.enqueue(job_id, iter(recipients)) == 10
+        assert queue.enqueue(job_id, [dict(email="0@EMAIL.com"), dict(email="new@email.com")]) == 1
+
+        pending = list(queue.pending(job_id))
+        assert len(pending) == 11
+        assert pending[0] == dict(email="0@email.com", name="0", _key=jobs.idempotency_key(job_id, "0@email.com"))
+
+        queue.checkpoint(job_id, pending[0]["_key"], message_id="1")
+        queue.checkpoint(job_id, pending[1]["_key"], error="ValueError: rejected")
+        assert queue.counts(job_id) == dict(pending=9, sent=1, failed=1)
+        assert len(list(queue.pending(job_id))) == 9
+        assert len(list(queue.pending(job_id, retry_failed=True))) == 10
+
+        with pytest.raises(KeyError):
+            queue.get_job("missing")
+
+        # A relative theme still points at the same file when the job is resumed from elsewhere
+        monkeypatch.chdir(home)
+        job_id = queue.create_job("aws", "me@email.com", "test", "Hi", theme="styles/email.css")
+        assert queue.get_job(job_id)["theme"] == str(home / "styles" / "email.css")
+
+
+def test_run_job(monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "PAGE_SIZE", 4)
+    path = str(tmp_path / "queue.db")
+    with jobs.SendQueue(path) as queue:
+        job_id = queue.create_job("fake", "me@email.com", "test", "Hi {{ name }}")
+        recipients = [dict(email=f"{i}@email.com", name=str(i)) for i in range(10)]
+        queue.enqueue(job_id, recipients + [dict(email="bad@email")])
+
+        backend = FakeBackend()
+        results = jobs.run_job(queue, job_id, backend, workers=1)
+        for _ in range(3):
+            next(results)
+        results.close()
+        assert queue.get_job(job_id)["status"] == "running"
+
+    with jobs.SendQueue(path) as queue:
+        assert queue.counts(job_id)["sent"] == 3
+        checkpointed = {row[0] for row in queue.db.execute("SELECT recipient FROM messages WHERE status = 'sent'")}
+
+        resumed = FakeBackend()
+        results = list(jobs.run_job(queue, job_id, resumed, workers=2))
+        assert {email for email, _ in resumed.sent}.isdisjoint(checkpointed)
+        assert len(results) == 8
+        assert queue.counts(job_id) == dict(pending=0, sent=10, failed=1)
+        assert queue.get_job(job_id)["status"] == "done"
+        assert "Hi 7" in dict(backend.sent + resumed.sent)["7@email.com"]
+
+        message = queue.db.execute("SELECT * FROM messages WHERE recipient = 'bad@email'").fetchone()
+        assert message["error"] == "ValueError: rejected"
+        assert message["attempts"] == 1
+
+        resumed.send_message = mock.MagicMock(return_value=dict(MessageId="retried"))
+        assert [result.recipient for result in jobs.run_job(queue, job_id, resumed, 1, retry_failed=True)] == [
+            "bad@email"
+        ]
+        assert queue.counts(job_id) == dict(pending=0, sent=11, failed=0)
@@ -0,0 +1,106 @@
+import base64
+import email
+import email.policy
+import mock
+import pytest
+from maildown import backends, mime
+
+
+def parse(raw):
+    return email.message_from_bytes(raw, policy=email.policy.default)
+
+
+def test_encode_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(mime, "CHUNK_SIZE", 57 * 3)
+    data = bytes(range(256)) * 10
+    (tmp_path / "data.bin").write_bytes(data)
+    (tmp_path / "empty.bin").write_bytes(b"")
+
+    encoded = mime.encode_file(str(tmp_path / "data.bin"))
+    assert encoded == base64.encodebytes(data).replace(b"\n", b"\r\n")
+    assert mime.encode_file(str(tmp_path / "data.bin")) is encoded
+    assert mime.encode_file(str(tmp_path / "empty.bin")) == b""
+
+
+def test_find_images(tmp_path):
+    (tmp_path / "logo.png").write_bytes(b"png")
+    (tmp_path / "my logo.png").write_bytes(b"png")
+    html = (
+        '<img src="logo.png"><img alt="" src="my%20logo.png"><img src="https://example.com/a.png">'
+        '<img src="data:image/png;base64,AAAA"><img src="missing.png"><img src="logo.png">'
+    )
+    assert mime.find_images(html, str(tmp_path)) == {
+        "logo.png": str(tmp_path / "logo.png"),
+        "my%20logo.png": str(tmp_path / "my logo.png"),
+    }
+    assert mime.campaign('<img src="https://example.com/a.png">') is None
+
+
+def test_raw_message(tmp_path):
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG")
+    (tmp_path / "report.pdf").write_bytes(b"%PDF" * 1000)
+    (tmp_path / "naïve.txt").write_bytes(b"text")
+
+    raw = mime.campaign(
+        '<p><img src="logo.png"></p>', [str(tmp_path / "report.pdf"), str(tmp_path / "naïve.txt")], str(tmp_path)
+    )
+    assert raw.shared_size > 5000
+
+    first = raw.build(["you@email.com"], "Me <me@email.com>", "Hello ✓", '<p><img src="logo.png"></p>', "Hi")
+    alternative = raw.alternative('<p><img src="cid:%s"></p>' % raw.images["logo.png"], "Hi")
+    assert raw.alternative('<p><img src="cid:%s"></p>' % raw.images["logo.png"], "Hi") is alternative
+    assert alternative in first
+
+    message = parse(first)
+    assert message["Subject"] == "Hello ✓"
+    assert message["To"] == "you@email.com"
+    assert message["From"] == "Me <me@email.com>"
+    assert message.get_content_type() == "multipart/mixed"
+
+    related, report, text = message.iter_parts()
+    assert related.get_content_type() == "multipart/related"
+    body, logo = related.iter_parts()
+    assert body.get_body(("html",)).get_content().strip() == f'<p><img src="cid:{raw.images["logo.png"]}"></p>'
+    assert body.get_body(("plain",)).get_content().strip() == "Hi"
+    assert logo["Content-ID"] == f"<{raw.images['logo.png']}>"
+    assert logo.get_content() == b"\x89PNG"
+    assert (report.get_filename(), report.get_content()) == ("report.pdf", b"%PDF" * 1000)
+    assert (text.get_filename(), text.get_content().strip()) == ("naïve.txt", "text")
+
+    second = parse(raw.build(["other@email.com"], "me@email.com", "Hello", "<p>Bye</p>", "Bye"))
+    assert second["To"] == "other@email.com"
+    assert second.get_body(("html",)).get_content().strip() == "<p>Bye</p>"
+
+    plain = parse(mime.RawMessage().build(["a@b.com"], "me@email.com", "Hi\r\nBcc: x@y.com", "<p>Hi</p>", "Hi"))
+    assert plain.get_content_type() == "multipart/alternative"
+    assert plain["Bcc"] is None
+
+
+def test_send_many_raw(monkeypatch, tmp_path):
+    monkeypatch.setattr(backends.AwsBackend, "client", mock.MagicMock())
+    monkeypatch.setattr(backends.AwsBackend, "rate_limiter", None)
+    monkeypatch.setattr(mime, "encode_file", mock.MagicMock(wraps=mime.encode_file))
+    client = backends.AwsBackend.client
+    client.send_raw_email.side_effect = lambda **kwargs: dict(MessageId=kwargs["Destinations"][0])
+    (tmp_path / "report.pdf").write_bytes(b"%PDF" * 1000)
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG")
+    (tmp_path / "email.md").write_text("Hi {{ name }} ![logo](logo.png)")
+
+    recipients = [dict(email=f"{i}@email.com", name=str(i)) for i in range(10)]
+    results = backends.AwsBackend().send_many(
+        "me@email.com", "test", recipients, file_path=str(tmp_path / "email.md"),
+        attachments=[str(tmp_path / "report.pdf")], workers=2
+    )
+
+    assert sorted(result.response["MessageId"] for result in results) == sorted(r["email"] for r in recipients)
+    assert mime.encode_file.call_count == 2
+    client.send_email.assert_not_called()
+    for call in client.send_raw_email.call_args_list:
+        email_address, = call[1]["Destinations"]
+        message = parse(call[1]["RawMessage"]["Data"])
+        assert message["To"] == email_address
+        assert f"Hi {email_address.split('@')[0]}" in message.get_body(("html",)).get_content()
+        assert 'src="cid:' in message.get_body(("html",)).get_content()
+
+    with pytest.raises(FileNotFoundError):
+        backends.AwsBackend().send("me@email.com", "test", ["a@b.com"], content="Hi", attachments=["missing.pdf"])
@@ -0,0 +1,71 @@
+import email
+import email.policy
+import gzip
+import json
+import mailbox
+import pytest
+from maildown import backends, outbox, suppression
+
+
+def parse(raw):
+    return email.message_from_bytes(raw, policy=email.policy.default)
+
+
+def test_guess_format(tmp_path):
+    assert outbox.guess_format("out.mbox") == "mbox"
+    assert outbox.guess_format("out.jsonl.gz") == "jsonl"
+    assert outbox.guess_format("out") == "eml"
+    assert outbox.guess_format(str(tmp_path)) == "eml"
+    with pytest.raises(ValueError):
+        outbox.guess_format("out.txt")
+
+
+def test_writers(monkeypatch, tmp_path):
+    monkeypatch.setattr(outbox, "BUFFER_SIZE", 100)
+    message = b"From: me@email.com\r\nTo: you@email.com\r\n\r\nFrom here\r\n>From there\r\n"
+
+    with outbox.open_writer(str(tmp_path / "out.mbox")) as writer:
+        assert [writer.write("you@email.com", message) for _ in range(3)] == [1, 2, 3]
+    messages = mailbox.mbox(str(tmp_path / "out.mbox"))
+    assert len(messages) == 3
+    assert messages[2]["To"] == "you@email.com"
+    # mboxrd quoting, which the mailbox module leaves in place
+    assert messages[2].get_payload() == ">From here\n>>From there\n"
+
+    with outbox.open_writer(str(tmp_path / "out.jsonl.gz")) as writer:
+        writer.write("you@email.com", message)
+    with gzip.open(str(tmp_path / "out.jsonl.gz")) as f:
+        assert [json.loads(line) for line in f] == [dict(recipient="you@email.com", message=message.decode())]
+
+    with outbox.open_writer(str(tmp_path / "out")) as writer:
+        writer.write("you@email.com", message)
+    assert (tmp_path / "out" / "00000001-you@email.com.eml").read_bytes() == message
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_dry_run(tmp_path, processes):
+    with suppression.SuppressionList() as suppressions:
+        suppressions.add([("bounced@email.com", None)])
+
+    recipients = [dict(email=f"{i}@email.com", name=f"User {i}") for i in range(250)]
+    recipients.insert(10, dict(email="bounced@email.com"))
+    recipients.append(dict(email="broken@email.com", items=1))
+
+    with outbox.open_writer(str(tmp_path / "out.jsonl")) as writer:
+        backend = backends.DryRunBackend(writer, processes=processes)
+        results = backend.send_many(
+            "me@email.com", "Hello", recipients, content="Hi {{ name }}{% for i in items %}{% endfor %}"
+        )
+
+    assert len(results) == 252
+    errors = {result.recipient: type(result.error).__name__ for result in results if result.error}
+    assert errors == {"bounced@email.com": "Suppressed", "broken@email.com": "TypeError"}
+    assert {result.recipient: result.response for result in results}["0@email.com"] == dict(MessageId="dry-run-1")
+
+    with open(tmp_path / "out.jsonl") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["recipient"] for line in lines] == [f"{i}@email.com" for i in range(250)]
+    message = parse(lines[7]["message"].encode())
+    assert message["To"] == "7@email.com"
+    assert message["Subject"] == "Hello"
+    assert "User 7" in message.get_body(("html",)).get_content()
@@ -0,0 +1,83 @@
+import http.client
+import os
+import threading
+import mistune
+import mock
+from maildown import inliner, preview
+
+
+def touch(path, text):
+    path.write_text(text)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def test_preview(monkeypatch, tmp_path):
+    monkeypatch.setattr(mistune, "Markdown", mock.MagicMock(wraps=mistune.Markdown))
+    monkeypatch.setattr(inliner, "Stylesheet", mock.MagicMock(wraps=inliner.Stylesheet))
+    inliner.compile_stylesheet.cache_clear()
+    markdown, theme = tmp_path / "email.md", tmp_path / "theme.css"
+    touch(markdown, "# Hello {{ name }}")
+    touch(theme, "h1 { color: red }")
+
+    renders = []
+    page = preview.Preview(str(markdown), str(theme), dict(name="Chris"), lambda *args: renders.append(args))
+    assert page.poll()
+    assert not page.poll()
+    assert '<h1 style="color:red">Hello Chris</h1>' in page.html
+    assert (page.version, mistune.Markdown.call_count, inliner.Stylesheet.call_count) == (1, 1, 1)
+
+    touch(theme, "h1 { color: blue }")
+    assert page.poll()
+    assert '<h1 style="color:blue">Hello Chris</h1>' in page.html
+    assert (page.version, mistune.Markdown.call_count, inliner.Stylesheet.call_count) == (2, 1, 2)
+
+    touch(markdown, "# Goodbye {{ name }}")
+    assert page.poll()
+    assert "Goodbye Chris" in page.html
+    assert (page.version, mistune.Markdown.call_count, inliner.Stylesheet.call_count) == (3, 2, 2)
+
+    touch(tmp_path / "email.json", '{"name": "Bob"}')
+    assert page.poll()
+    assert "Goodbye Bob" in page.html
+    assert all(elapsed < 0.1 for elapsed, error in renders[1:])
+
+    touch(markdown, "# Goodbye {{ name")
+    assert page.poll()
+    assert "Failed to render" in page.html
+    assert isinstance(renders[-1][1], Exception)
+    inliner.compile_stylesheet.cache_clear()
+
+
+def test_preview_server(tmp_path):
+    markdown = tmp_path / "email.md"
+    touch(markdown, "# Hello")
+    page = preview.Preview(str(markdown))
+    page.poll()
+
+    httpd = preview.PreviewServer(page, ("127.0.0.1", 0))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    stop = threading.Event()
+    threading.Thread(target=page.watch, args=(stop,), daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*httpd.server_address)
+        connection.request("GET", "/")
+        html = connection.getresponse().read().decode("utf-8")
+        assert "Hello</h1>" in html
+        assert 'EventSource("/events?version=1")' in html
+        assert html.index("EventSource") < html.index("</body>")
+
+        connection = http.client.HTTPConnection(*httpd.server_address)
+        connection.request("GET", "/events?version=1")
+        response = connection.getresponse()
+        assert response.getheader("Content-Type") == "text/event-stream"
+        touch(markdown, "# Goodbye")
+        assert response.read() == b"data: 2\n\n"
+
+        connection = http.client.HTTPConnection(*httpd.server_address)
+        connection.request("GET", "/missing")
+        assert connection.getresponse().status == 404
+    finally:
+        stop.set()
+        httpd.shutdown()
+        httpd.server_close()
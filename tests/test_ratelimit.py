@@ -0,0 +1,84 @@
+import pytest
+import threading
+from maildown.backends import ratelimit
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(2.0, clock=clock, sleep=clock.sleep)
+
+    for _ in range(4):
+        bucket.acquire()
+
+    assert clock.sleeps == [0.5, 0.5]
+    assert clock.now == 1.0
+
+    clock.now += 10
+    bucket.acquire()
+    assert bucket.tokens == 1.0
+
+    bucket.acquire(5)
+    assert bucket.tokens == -3.0
+    bucket.acquire()
+    assert clock.sleeps[-1] == 2.0
+
+
+def test_token_bucket_threads():
+    bucket = ratelimit.TokenBucket(1000.0, capacity=10)
+    threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(10)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert bucket.tokens < 10
+
+
+def test_from_quota():
+    limiter = ratelimit.AdaptiveRateLimiter.from_quota(dict(MaxSendRate=14.0, Max24HourSend=-1.0))
+    assert limiter.max_rate == 14.0
+    assert limiter.daily_quota is None
+
+    limiter = ratelimit.AdaptiveRateLimiter.from_quota(
+        dict(MaxSendRate=1.0, Max24HourSend=200.0, SentLast24Hours=199.0)
+    )
+    limiter.acquire()
+    with pytest.raises(ratelimit.QuotaExceeded):
+        limiter.acquire()
+
+
+def test_adaptive_throttling(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit.random, "uniform", lambda low, high: high)
+    limiter = ratelimit.AdaptiveRateLimiter(10.0, daily_quota=5, clock=clock, sleep=clock.sleep)
+
+    limiter.acquire()
+    assert limiter.throttled(0) == 0.5
+    assert limiter.throttled(1) == 1.0
+    assert limiter.throttled(10) == 30.0
+    assert limiter.rate == 1.25
+    assert limiter.bucket.rate == 1.25
+
+    for _ in range(5):
+        limiter.succeeded()
+    assert limiter.rate == 3.75
+
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.rate == 10.0
+
+    for _ in range(10):
+        limiter.throttled()
+    assert limiter.rate == limiter.min_rate
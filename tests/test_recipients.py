@@ -0,0 +1,87 @@
+import io
+import sys
+import pytest
+from maildown import recipients
+
+
+def test_read(tmp_path, monkeypatch):
+    csv_file = tmp_path / "recipients.csv"
+    csv_file.write_text("email,name\nme@email.com,Me\n")
+    assert list(recipients.read(str(csv_file))) == [dict(email="me@email.com", name="Me")]
+    csv_file.write_text("email,name\nme@email.com,Me\nyou@email.com,You,extra\n")
+    stream = recipients.read(str(csv_file))
+    assert next(stream) == dict(email="me@email.com", name="Me")
+    with pytest.raises(ValueError, match="row 2 has more fields than the header"):
+        next(stream)
+
+    jsonl_file = tmp_path / "recipients.jsonl"
+    jsonl_file.write_text('{"email": "me@email.com", "things": [1, 2]}\n\n{"name": "nobody"}\n')
+    stream = recipients.read(str(jsonl_file))
+    assert next(stream) == dict(email="me@email.com", things=[1, 2])
+    with pytest.raises(KeyError):
+        next(stream)
+
+    text_file = tmp_path / "recipients.txt"
+    text_file.write_text("me@email.com\n\nyou@email.com\n")
+    assert list(recipients.read(str(text_file))) == [dict(email="me@email.com"), dict(email="you@email.com")]
+    with pytest.raises(ValueError):
+        list(recipients.read(str(text_file), format="jsonl"))
+
+    empty_file = tmp_path / "empty.txt"
+    empty_file.write_text("\n")
+    assert list(recipients.read(str(empty_file))) == []
+
+    monkeypatch.setattr(sys, "stdin", io.StringIO('{"email": "me@email.com"}\n'))
+    assert list(recipients.read("-")) == [dict(email="me@email.com")]
+
+    with pytest.raises(ValueError):
+        list(recipients.parse(io.StringIO("me@email.com\n"), format="xml"))
+
+
+def test_detect_format():
+    assert recipients.detect_format('{"email": "me@email.com"}') == "jsonl"
+    assert recipients.detect_format("email,name") == "csv"
+    assert recipients.detect_format("Email\n") == "csv"
+    assert recipients.detect_format("me@email.com") == "lines"
+
+
+def test_hashed_set():
+    seen = recipients.HashedSet(capacity=2)
+    emails = [f"{i}@email.com" for i in range(1000)]
+    assert all(seen.add(email) for email in emails)
+    assert not any(seen.add(email.upper()) for email in emails)
+    assert len(seen) == 1000
+    assert "999@EMAIL.COM" in seen
+    assert "1000@email.com" not in seen
+    assert len(seen.table) == 2048
+
+
+def test_hashed_set_save_and_load(tmp_path):
+    seen = recipients.HashedSet()
+    for i in range(100):
+        seen.add(f"{i}@email.com")
+    seen.save(str(tmp_path / "seen.idx"))
+
+    loaded = recipients.HashedSet.load(str(tmp_path / "seen.idx"))
+    assert len(loaded) == 100
+    assert "99@EMAIL.COM" in loaded
+    assert "100@email.com" not in loaded
+
+    (tmp_path / "bad.idx").write_bytes(b"not a hashed set" * 4)
+    with pytest.raises(ValueError):
+        recipients.HashedSet.load(str(tmp_path / "bad.idx"))
+
+
+def test_bloom_filter():
+    seen = recipients.BloomFilter(1000, error_rate=0.01)
+    emails = [f"{i}@email.com" for i in range(1000)]
+    assert sum(seen.add(email) for email in emails) > 980
+    assert all(email in seen for email in emails)
+    assert not any(seen.add(email) for email in emails)
+    assert len(seen.bits) < 1500
+
+
+def test_dedupe():
+    stream = [dict(email="me@email.com", n=1), dict(email="you@email.com"), dict(email="ME@email.com", n=2)]
+    assert list(recipients.dedupe(iter(stream))) == stream[:2]
+    assert list(recipients.dedupe(stream, recipients.BloomFilter(10))) == stream[:2]
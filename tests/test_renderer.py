@@ -1,11 +1,9 @@
 import mock
-from maildown import renderer
+from maildown import inliner, renderer, templates
 import mistune
 import pygments
 from pygments import lexers
 from pygments.formatters import html
-import premailer
-import jinja2
 
 
 def test_highlight_renderer(monkeypatch):
@@ -16,6 +14,7 @@ def test_highlight_renderer(monkeypatch):
 
     lexers.get_lexer_by_name.return_value = True
     html.HtmlFormatter.return_value = {}
+    renderer.clear_highlight_cache()
 
     r = renderer.HighlightRenderer()
     r.block_code("code")
@@ -25,16 +24,84 @@ def test_highlight_renderer(monkeypatch):
     r.block_code("code", "python")
     lexers.get_lexer_by_name.assert_called_with("python", stripall=True)
     pygments.highlight.assert_called_with("code", True, {})
+    renderer.clear_highlight_cache()
+
+
+def test_highlight_cache(monkeypatch):
+    monkeypatch.setattr(lexers, "get_lexer_by_name", mock.MagicMock(wraps=lexers.get_lexer_by_name))
+    monkeypatch.setattr(pygments, "highlight", mock.MagicMock(wraps=pygments.highlight))
+    monkeypatch.setattr(renderer, "HIGHLIGHT_CACHE_SIZE", 2)
+    renderer.clear_highlight_cache()
+
+    first = renderer.highlight("x = 1", "python")
+    assert "<div class=\"highlight\">" in first
+    assert renderer.highlight("x = 1", "python") == first
+    renderer.highlight("x = 2", "python")
+    renderer.highlight("x = 3", "python")
+    assert lexers.get_lexer_by_name.call_count == 1
+    assert pygments.highlight.call_count == 3
+
+    renderer.highlight("x = 1", "python")
+    assert pygments.highlight.call_count == 4
+    renderer.clear_highlight_cache()
+
+
+def test_prehighlight(monkeypatch):
+    renderer.clear_highlight_cache()
+    blocks = ["```python\nx = %d\n```" % i for i in range(renderer.MIN_PARALLEL_BLOCKS)]
+    document = "# Title\n\n" + "\n\n".join(blocks) + "\n\n```\nno language\n```\n"
+
+    renderer.prehighlight(document, 2)
+    assert len(renderer._highlighted) == renderer.MIN_PARALLEL_BLOCKS
+
+    monkeypatch.setattr(pygments, "highlight", mock.MagicMock())
+    renderer._compile.cache_clear()
+    html = renderer.compile_content(document, highlight_workers=2).render()
+    assert html.count("class=\"highlight\"") == renderer.MIN_PARALLEL_BLOCKS
+    pygments.highlight.assert_not_called()
+
+    renderer.clear_highlight_cache()
+    renderer.prehighlight(blocks[0], 2)
+    assert not renderer._highlighted
+    renderer._compile.cache_clear()
 
 
 def test_generate_content(monkeypatch):
     monkeypatch.setattr(mistune, "Markdown", mock.MagicMock())
-    monkeypatch.setattr(premailer, "transform", mock.MagicMock())
+    monkeypatch.setattr(inliner, "transform", mock.MagicMock())
     monkeypatch.setattr(renderer, "HighlightRenderer", mock.MagicMock())
-    monkeypatch.setattr(jinja2, "Template", mock.MagicMock())
+    monkeypatch.setattr(templates, "from_string", mock.MagicMock())
 
     renderer.HighlightRenderer.return_value = 1
-    premailer.transform.return_value = ""
-    jinja2.Template.render.return_value = ""
+    inliner.transform.return_value = ""
+    templates.from_string.return_value.render.return_value = ""
+    renderer._compile.cache_clear()
     renderer.generate_content("")
     mistune.Markdown.assert_called_with(renderer=1)
+    templates.from_string.assert_called_with("")
+    renderer._compile.cache_clear()
+
+
+def test_compile_content_cache(monkeypatch):
+    monkeypatch.setattr(mistune, "Markdown", mock.MagicMock(wraps=mistune.Markdown))
+    monkeypatch.setattr(inliner, "transform", mock.MagicMock(wraps=inliner.transform))
+    renderer._compile.cache_clear()
+
+    compiled = renderer.compile_content("# Hello {{ name }}")
+    assert renderer.compile_content("# Hello {{ name }}") is compiled
+    assert "Hello Chris" in compiled.render(dict(name="Chris"))
+    assert "Hello Bob" in renderer.generate_content("# Hello {{ name }}", context=dict(name="Bob"))
+
+    assert mistune.Markdown.call_count == 1
+    assert inliner.transform.call_count == 1
+
+    assert renderer.compile_content("# Goodbye") is not compiled
+    assert mistune.Markdown.call_count == 2
+    renderer._compile.cache_clear()
+
+
+def test_render_placeholders():
+    compiled = renderer.compile_content("{{ greeting }} {{ name }}, {{ user.first_name }}")
+    html = compiled.render_placeholders(dict(greeting="Hello"))
+    assert "Hello {{name}}, {{user.first_name}}" in html
+    renderer._compile.cache_clear()
@@ -0,0 +1,146 @@
+import errno
+import fcntl
+import math
+import os
+import threading
+import time
+import pytest
+from botocore.exceptions import ClientError
+from maildown import sendlog
+from maildown.backends.aws import BulkSendError
+from maildown.backends.base import SendResult, Suppressed
+
+
+def test_error_code():
+    assert sendlog.error_code(None) is None
+    error = ClientError({"Error": {"Code": "MessageRejected", "Message": "no"}}, "SendEmail")
+    assert sendlog.error_code(error) == "MessageRejected"
+    assert sendlog.error_code(BulkSendError(dict(Status="MailFromDomainNotVerified"))) == "MailFromDomainNotVerified"
+    assert sendlog.error_code(ValueError("bad")) == "ValueError"
+
+
+def test_write_and_read(tmp_path):
+    path = str(tmp_path / "sends.log")
+    with sendlog.SendLog(path) as log:
+        log.record("launch", SendResult("you@email.com", dict(MessageId="abc"), latency=0.25))
+        log.record("launch", SendResult("bad@email.com", error=ValueError("bad"), latency=0.5))
+        log.record("lancé", SendResult("gone@email.com", error=Suppressed("gone@email.com")))
+    assert log.written == 3
+    with pytest.raises(ValueError):
+        log.record("launch", SendResult("you@email.com"))
+
+    delivered, failed, suppressed = sendlog.read(path)
+    assert delivered[1:] == ("launch", "you@email.com", sendlog.DELIVERED, "abc", None, 0.25)
+    assert abs(delivered.timestamp - time.time()) < 60
+    assert failed[1:] == ("launch", "bad@email.com", sendlog.FAILED, None, "ValueError", 0.5)
+    assert suppressed[1:] == ("lancé", "gone@email.com", sendlog.SUPPRESSED, None, "Suppressed", None)
+
+    # A record cut short by a crash is skipped, and appending carries on after it
+    with open(path, "ab") as f:
+        f.write(sendlog.encode(sendlog.Record(1.0, "launch", "torn@email.com", sendlog.DELIVERED))[:-3])
+    assert len(list(sendlog.read(path))) == 3
+
+    # The torn record is cut off when the log is next opened, so later records can be read
+    with sendlog.SendLog(path) as log:
+        for number in range(5):
+            log.record("launch", SendResult(f"{number}@email.com", {}))
+    assert [record.recipient for record in sendlog.read(path)][3:] == [f"{number}@email.com" for number in range(5)]
+    assert {campaign: summary.total for campaign, summary in sendlog.summarise(path).items()} == {
+        "launch": 7,
+        "lancé": 1,
+    }
+
+
+def test_damaged_log(monkeypatch, tmp_path):
+    path = str(tmp_path / "sends.log")
+    records = [sendlog.encode(sendlog.Record(1.0, "launch", f"{i}@email.com", sendlog.DELIVERED)) for i in range(8)]
+    # A torn record in the middle of the log, as an older version would have appended after it, is skipped
+    with open(path, "wb") as f:
+        f.write(b"".join(records[:3]) + records[3][:20] + b"".join(records[3:]))
+    assert [record.recipient for record in sendlog.read(path)] == [f"{i}@email.com" for i in range(8)]
+    assert {campaign: summary.total for campaign, summary in sendlog.summarise(path).items()} == {"launch": 8}
+
+    # Only a torn record at the end is cut off, found by reading the last TAIL_WINDOW bytes
+    monkeypatch.setattr(sendlog, "TAIL_WINDOW", len(records[0]) * 3)
+    with open(path, "ab") as f:
+        f.write(records[0][:-1])
+    size = os.path.getsize(path)
+    sendlog.SendLog(path).close()
+    assert os.path.getsize(path) == size - len(records[0]) + 1
+    assert len(list(sendlog.read(path))) == 8
+
+    # Opening waits for other writers, so a record they append isn't mistaken for a torn one
+    with open(path, "ab") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        opened = threading.Event()
+        thread = threading.Thread(target=lambda: (sendlog.SendLog(path).close(), opened.set()))
+        thread.start()
+        f.write(records[0][:10])
+        f.flush()
+        time.sleep(0.1)
+        assert not opened.is_set()
+        f.write(records[0][10:])
+        f.flush()
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    thread.join()
+    assert len(list(sendlog.read(path))) == 9
+
+
+def test_write_error(monkeypatch, tmp_path):
+    def write(fd, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    log = sendlog.SendLog(str(tmp_path / "sends.log"), fsync_interval=0.01)
+    monkeypatch.setattr(os, "write", write)
+    log.record("launch", SendResult("you@email.com", {}))
+    deadline = time.monotonic() + 5
+    while log._error is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(OSError, match="No space"):
+        log.record("launch", SendResult("you@email.com", {}))
+    with pytest.raises(OSError, match="No space"):
+        log.close()
+
+
+def test_background_writes(tmp_path):
+    path = tmp_path / "sends.log"
+    log = sendlog.SendLog(str(path), fsync_interval=0.01)
+    log.record("launch", SendResult("you@email.com", {}))
+    deadline = time.monotonic() + 5
+    while not path.stat().st_size and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [record.recipient for record in sendlog.read(str(path))] == ["you@email.com"]
+    log.close()
+
+
+def test_summarise(tmp_path):
+    path = str(tmp_path / "sends.log")
+    with open(path, "wb") as f:
+        for i in range(100):
+            f.write(sendlog.encode(sendlog.Record(1000.0 + i, "launch", f"{i}@email.com", 0, latency=(i + 1) / 1000)))
+        f.write(sendlog.encode(sendlog.Record(2000.0, "launch", "a@email.com", 1, error_code="Throttling")))
+        f.write(sendlog.encode(sendlog.Record(2001.0, "launch", "b@email.com", 1, error_code="Throttling")))
+        f.write(sendlog.encode(sendlog.Record(2002.0, "other", "c@email.com", 2, error_code="Suppressed")))
+
+    summaries = sendlog.summarise(path)
+    assert list(summaries) == ["launch", "other"]
+    launch = summaries["launch"]
+    assert (launch.delivered, launch.failed, launch.suppressed) == (100, 2, 0)
+    assert [round(value, 3) for value in launch.percentiles(50, 90, 99)] == [0.05, 0.09, 0.099]
+    assert launch.errors == {"Throttling": 2}
+    assert (launch.first, launch.last) == (1000.0, 2001.0)
+    assert summaries["other"].percentiles(50) == [None]
+
+    assert list(sendlog.summarise(path, campaigns=["other"])) == ["other"]
+    assert sendlog.summarise(path, since=2000.5)["launch"].failed == 1
+
+
+def test_parse_since():
+    assert sendlog.parse_since("12h", now=100000.0) == 100000.0 - 12 * 3600
+    assert sendlog.parse_since("1.5d", now=200000.0) == 200000.0 - 1.5 * 86400
+    assert math.isclose(sendlog.parse_since("2024-05-01T00:00:00+00:00"), 1714521600.0)
+    assert math.isclose(sendlog.parse_since("2024-05-01 01:30:00.5+0130"), 1714521600.5)
+    assert math.isclose(sendlog.parse_since("2024-05-01T00:00Z"), 1714521600.0)
+    assert sendlog.parse_since("2024-05-01") == time.mktime((2024, 5, 1, 0, 0, 0, 0, 0, -1))
+    with pytest.raises(ValueError):
+        sendlog.parse_since("yesterday")
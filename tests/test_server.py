@@ -0,0 +1,213 @@
+import http.client
+import json
+import os
+import socket
+import threading
+import mock
+import pytest
+from maildown import backends, renderer, sendlog, server, templates
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+TOKEN = "secret"
+
+
+def request(connection, method, path, payload=None, token=TOKEN, content_type="application/json"):
+    body = json.dumps(payload) if payload is not None else None
+    headers = {"Content-Type": content_type}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@pytest.fixture
+def daemon(monkeypatch):
+    monkeypatch.setattr(backends.AwsBackend, "send_message", mock.MagicMock())
+    backends.AwsBackend.send_message.side_effect = lambda to, *args: (
+        {"MessageId": to[0]} if to[0] != "bad@email.com" else 1 / 0
+    )
+    daemon = server.Daemon(workers=4)
+    yield daemon
+    daemon.close()
+
+
+def serve(httpd):
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_http(daemon):
+    httpd = server.create_server(daemon, port=0, quiet=True, token=TOKEN)
+    serve(httpd)
+    connection = http.client.HTTPConnection(*httpd.server_address)
+    try:
+        payload = dict(content="# Hi {{ name }}", context=dict(name="Chris"))
+        status, body = request(connection, "POST", "/render", payload)
+        assert status == 200
+        assert "Hi Chris</h1>" in body["html"]
+
+        status, body = request(connection, "POST", "/send", dict(
+            sender="me@email.com",
+            subject="Hello",
+            content="# Hi {{ name }} {{ greeting }}",
+            context=dict(greeting="there"),
+            to=["bad@email.com"],
+            recipients=[dict(email=f"{i}@email.com", name=str(i)) for i in range(5)],
+        ))
+        assert status == 200
+        assert (body["sent"], body["failed"]) == (5, 1)
+        results = {result["recipient"]: result for result in body["results"]}
+        assert results["3@email.com"] == dict(recipient="3@email.com", message_id="3@email.com")
+        assert results["bad@email.com"]["error"] == "ZeroDivisionError: division by zero"
+        html = {call[0][0][0]: call[0][2] for call in backends.AwsBackend.send_message.call_args_list}
+        assert "Hi 3 there" in html["3@email.com"]
+
+        status, body = request(connection, "GET", "/health")
+        assert (status, body["sent"], body["failed"]) == (200, 5, 1)
+
+        assert request(connection, "POST", "/send", dict(sender="me@email.com"))[0] == 400
+        assert request(connection, "POST", "/send", dict(sender="me@email.com", subject="Hi", to=["a@b.com"]))[0] == 400
+        assert request(connection, "POST", "/render", dict(content="Hi", backend="grrr"))[0] == 200
+        assert request(connection, "POST", "/send", dict(
+            sender="me@email.com", subject="Hi", to=["a@b.com"], content="Hi", backend="grrr"
+        )) == (400, dict(error="No backend called grrr exists"))
+        assert request(connection, "POST", "/nowhere", {})[0] == 404
+        assert request(connection, "POST", "/render", [])[0] == 400
+
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {TOKEN}"}
+        connection.request("POST", "/render", body=b"{not json", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 400 and "Invalid JSON" in json.loads(response.read())["error"]
+    finally:
+        connection.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_unix_socket(daemon, tmp_path):
+    path = str(tmp_path / "maildown.sock")
+    (tmp_path / "maildown.sock").write_text("stale")
+    httpd = server.create_server(daemon, socket=path, quiet=True)
+    serve(httpd)
+    connection = UnixConnection(path)
+    try:
+        status, body = request(connection, "POST", "/send", dict(
+            sender="me@email.com", subject="Hello", content="Hi", to=["you@email.com"]
+        ))
+        assert (status, body["sent"]) == (200, 1)
+        assert request(connection, "GET", "/health")[1]["status"] == "ok"
+    finally:
+        connection.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_send_log(daemon, tmp_path):
+    path = str(tmp_path / "sends.log")
+    with sendlog.SendLog(path) as daemon.send_log:
+        daemon.send(dict(sender="me@email.com", subject="Hi", content="Hi", to=["you@email.com", "bad@email.com"]))
+        daemon.send(dict(sender="me@email.com", subject="Hi", content="Hi", to=["you@email.com"], campaign="launch"))
+    summaries = sendlog.summarise(path)
+    assert [(summary.delivered, summary.failed) for summary in summaries.values()] == [(1, 1), (1, 0)]
+    assert list(summaries) == ["Hi", "launch"]
+    assert summaries["Hi"].errors == {"ZeroDivisionError": 1}
+
+
+def test_untrusted_requests(daemon, tmp_path):
+    with pytest.raises(ValueError):
+        server.create_server(daemon, port=0)
+
+    httpd = server.create_server(daemon, port=0, quiet=True, token=TOKEN)
+    serve(httpd)
+    payload = dict(content="`{{ cycler.__init__.__globals__.os.getcwd() }}`")
+    try:
+        for token, content_type, status in [
+            (None, "application/json", 401),
+            ("wrong", "application/json", 401),
+            # A text/plain POST is one a web page can make without a CORS preflight
+            (TOKEN, "text/plain", 415),
+        ]:
+            connection = http.client.HTTPConnection(*httpd.server_address)
+            assert request(connection, "POST", "/render", payload, token, content_type)[0] == status
+            connection.close()
+
+        connection = http.client.HTTPConnection(*httpd.server_address)
+        # Templates are rendered in jinja's sandbox
+        status, body = request(connection, "POST", "/render", payload)
+        assert status == 400 and "unsafe" in body["error"]
+        status, body = request(connection, "POST", "/render", dict(content="Hi {{ name }}", context=dict(name="Chris")))
+        assert status == 200 and "Hi Chris" in body["html"]
+
+        # Without a root directory, requests can't read local files
+        (tmp_path / "email.md").write_text("# Hello")
+        for key, value in [("file_path", str(tmp_path / "email.md")), ("theme", "/etc/hostname")]:
+            assert request(connection, "POST", "/render", {"content": "Hi", key: value})[0] == 403
+        assert request(connection, "POST", "/send", dict(
+            sender="me@email.com", subject="Hi", content="Hi", to=["you@email.com"], attachments=["/etc/hostname"]
+        ))[0] == 403
+        connection.close()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_recipient_types(daemon):
+    message = dict(sender="me@email.com", subject="Hi", content="Hi")
+    for recipients, error in [
+        # A string would otherwise be sent to one recipient per character
+        (dict(to="you@email.com"), "to must be a list"),
+        (dict(to=["you@email.com", 1]), "to must be a list"),
+        (dict(recipients="you@email.com"), "recipients must be a list"),
+        (dict(recipients=["you@email.com"]), "recipients must be a list"),
+        (dict(recipients=[dict(name="Chris")]), "every recipient must have an email"),
+    ]:
+        with pytest.raises(server.RequestError, match=error):
+            daemon.send(dict(message, **recipients))
+    assert not backends.AwsBackend.send_message.called
+
+
+def test_root(monkeypatch, daemon, tmp_path):
+    root = tmp_path / "root"
+    (root / "images").mkdir(parents=True)
+    (root / "email.md").write_text("# Hello ![logo](images/logo.png) ![secret](../secret.png)")
+    (root / "images" / "logo.png").write_bytes(b"\x89PNG logo")
+    (tmp_path / "secret.png").write_bytes(b"\x89PNG secret")
+    daemon.root = str(root)
+
+    assert "Hello" in daemon.render(dict(file_path="email.md"))["html"]
+    for path in ["../secret.png", str(tmp_path / "secret.png"), "images/../../secret.png"]:
+        with pytest.raises(server.RequestError):
+            daemon.render(dict(file_path=path))
+
+    # Only images inside the message's directory are embedded, and the message is only read and compiled once
+    monkeypatch.setattr(backends.AwsBackend, "send_raw_message", mock.MagicMock(return_value=dict(MessageId="1")))
+    monkeypatch.setattr(templates, "read_file", mock.MagicMock(wraps=templates.read_file))
+    daemon.send(dict(sender="me@email.com", subject="Hi", file_path="email.md", to=["you@email.com"]))
+    raw = backends.AwsBackend.send_raw_message.call_args[0][2]
+    assert b"logo.png" in raw and b"secret.png" not in raw
+    assert templates.read_file.call_count == 1
+
+    # Artifacts unmarshal python code when they're loaded, so they can't be sent from a request
+    renderer.compile_content("# Hello").save(str(root / "email.mdc"))
+    for method in (daemon.render, daemon.send):
+        with pytest.raises(server.RequestError, match="compiled artifact"):
+            method(dict(sender="me@email.com", subject="Hi", file_path="email.mdc", to=["you@email.com"]))
+
+
+def test_default_token(home):
+    token = server.default_token()
+    assert len(token) > 20
+    assert server.default_token() == token
+    assert oct(os.stat(server.token_path()).st_mode & 0o777) == "0o600"
@@ -0,0 +1,128 @@
+import pytest
+import mock
+import boto3
+from botocore.exceptions import ClientError
+from maildown import backends, utilities
+from maildown.backends import sharded
+from maildown.backends.ratelimit import AdaptiveRateLimiter, QuotaExceeded
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def mock_client(*args, region_name=None, **kwargs):
+    client = mock.MagicMock()
+    client.meta.region_name = region_name
+    client.send_email.return_value = dict(MessageId=region_name)
+    return client
+
+
+def error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "SendEmail")
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    monkeypatch.setattr(boto3, "client", mock.MagicMock(side_effect=mock_client))
+    return boto3.client
+
+
+def send(backend):
+    return backend.send_message(["you@email.com"], "me@email.com", "<p>Hi</p>", "Hi", "Hello")["MessageId"]
+
+
+def test_shards(clients):
+    backend = backends.ShardedAwsBackend(
+        [
+            dict(access_key="a", secret_key="a", region="us-east-1", weight=1, rate_limit=False),
+            dict(region="eu-west-1", weight=3, rate_limit=False),
+        ]
+    )
+    regions = [send(backend) for _ in range(8)]
+    assert regions.count("us-east-1") == 2
+    assert regions.count("eu-west-1") == 6
+    # The shards' messages are interleaved, rather than sent in runs
+    assert regions[:4].count("us-east-1") == 1
+
+    assert clients.call_count == 2
+    keys = {call[1]["region_name"]: call[1]["aws_access_key_id"] for call in clients.call_args_list}
+    assert keys == {"us-east-1": "a", "eu-west-1": None}
+    assert [shard.sent for shard in backend.shards] == [2, 6]
+
+
+def test_weight_from_quota(clients):
+    backend = backends.ShardedAwsBackend([dict(region="us-east-1"), dict(region="eu-west-1")])
+    first, second = backend.shards
+    first.backend._rate_limiter = AdaptiveRateLimiter(10)
+    second.backend._rate_limiter = AdaptiveRateLimiter(30)
+    assert [first.capacity, second.capacity] == [10, 30]
+
+    picks = [backend.pick() for _ in range(40)]
+    assert picks.count(first) == 10
+
+    # Throttling cuts a shard's rate, and so its share
+    second.backend._rate_limiter.rate = 10
+    picks = [backend.pick() for _ in range(40)]
+    assert picks.count(first) == 20
+
+
+def test_failover(clients):
+    clock = Clock()
+    backend = backends.ShardedAwsBackend(
+        [dict(region="us-east-1", rate_limit=False), dict(region="eu-west-1", rate_limit=False)],
+        cooldown=10,
+        clock=clock,
+    )
+    first, second = backend.shards
+    first.backend.client.send_email.side_effect = error("Throttling")
+
+    assert [send(backend) for _ in range(4)] == ["eu-west-1"] * 4
+    assert first.failed == 1
+    assert first.backend.client.send_email.call_count == 1
+
+    clock.now = 11
+    first.backend.client.send_email.side_effect = None
+    assert {send(backend) for _ in range(4)} == {"us-east-1", "eu-west-1"}
+
+    # Errors which are the message's fault aren't tried elsewhere
+    second.backend.client.send_email.side_effect = error("MessageRejected")
+    first.backend.client.send_email.side_effect = error("MessageRejected")
+    with pytest.raises(ClientError):
+        send(backend)
+    assert first.failed == 1 and second.failed == 0
+
+
+def test_quota_exceeded(clients):
+    backend = backends.ShardedAwsBackend([dict(region="us-east-1"), dict(region="eu-west-1")])
+    for shard in backend.shards:
+        shard.backend._rate_limiter = AdaptiveRateLimiter(1000, daily_quota=2)
+
+    assert sorted(send(backend) for _ in range(4)) == ["eu-west-1", "eu-west-1", "us-east-1", "us-east-1"]
+    with pytest.raises(QuotaExceeded):
+        send(backend)
+    with pytest.raises(sharded.NoShardsAvailable):
+        send(backend)
+
+
+def test_login(monkeypatch):
+    monkeypatch.setattr(backends.AwsBackend, "verify_auth", mock.MagicMock(return_value=True))
+    backend = backends.ShardedAwsBackend()
+    with pytest.raises(AttributeError):
+        backend.shards
+
+    backend.login(region_name="us-east-1")
+    backend.login(access_key="a", secret_key="b", region_name="eu-west-1", weight="2")
+    assert utilities.get_config()["sharded"]["shards"] == [
+        dict(region="us-east-1"),
+        dict(region="eu-west-1", access_key="a", secret_key="b", weight=2.0),
+    ]
+    assert [shard.backend.region_name for shard in backend.shards] == ["us-east-1", "eu-west-1"]
+
+    backends.AwsBackend.verify_auth.return_value = False
+    with pytest.raises(AttributeError):
+        backend.login(access_key="a", secret_key="b", region_name="eu-west-2")
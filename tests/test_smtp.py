@@ -0,0 +1,145 @@
+import email
+import email.policy
+import smtplib
+import socket
+import mock
+import pytest
+from cleo.testers import CommandTester
+from maildown import backends, utilities
+from maildown.application import application
+
+aiosmtpd = pytest.importorskip("aiosmtpd")
+from aiosmtpd.controller import Controller  # noqa: E402
+from aiosmtpd.smtp import AuthResult  # noqa: E402
+
+
+class Handler(object):
+    def __init__(self):
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("bad"):
+            return "550 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.mail_from, envelope.rcpt_tos, envelope.content.decode()))
+        return "250 OK"
+
+
+def authenticate(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=auth_data.login == b"user" and auth_data.password == b"secret")
+
+
+@pytest.fixture
+def relay():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    handler = Handler()
+    controller = Controller(
+        handler, hostname="127.0.0.1", port=port, authenticator=authenticate, auth_require_tls=False
+    )
+    controller.start()
+    yield handler, port
+    controller.stop()
+
+
+def backend(port, **kwargs):
+    options = dict(host="127.0.0.1", port=port, username="user", password="secret", starttls=False, timeout=3)
+    options.update(kwargs)
+    return backends.SmtpBackend(**options)
+
+
+def test_send_many(relay):
+    handler, port = relay
+    smtp = backend(port, pool_size=3, max_messages=5)
+    smtp.connect = mock.MagicMock(wraps=smtp.connect)
+    recipients = [dict(email=f"{i}@email.com", name=str(i)) for i in range(30)]
+
+    results = smtp.send_many("me@email.com", "test", recipients, content="Hi {{ name }}", workers=3)
+
+    assert not [result for result in results if result.error]
+    assert len(handler.messages) == 30
+    assert 6 <= smtp.connect.call_count <= 8
+    sender, to, message = [message for message in handler.messages if message[1] == ["7@email.com"]][0]
+    assert sender == "me@email.com"
+    assert "Subject: test" in message
+    assert "multipart/alternative" in message
+    assert "Hi 7" in message
+    smtp.close()
+    assert smtp.pool.idle.empty()
+
+
+def test_reuse_and_reconnect(relay):
+    handler, port = relay
+    smtp = backend(port)
+    smtp.connect = mock.MagicMock(wraps=smtp.connect)
+
+    assert smtp.send_message(["you@email.com"], "me@email.com", "<p>hi</p>", "hi", "test") == ["you@email.com"]
+    smtp.send_message(["you@email.com"], "me@email.com", "<p>hi</p>", "hi", "test")
+    assert smtp.connect.call_count == 1
+
+    smtp.pool.idle.queue[0].smtp.sock.shutdown(socket.SHUT_RDWR)
+    smtp.send_message(["you@email.com"], "me@email.com", "<p>hi</p>", "hi", "test")
+    assert smtp.connect.call_count == 2
+    assert len(handler.messages) == 3
+
+
+def test_refused(relay):
+    handler, port = relay
+    smtp = backend(port)
+    smtp.connect = mock.MagicMock(wraps=smtp.connect)
+
+    sent = smtp.send_message(["you@email.com", "bad@email.com"], "me@email.com", "<p>hi</p>", "hi", "test")
+    assert sent == ["you@email.com"]
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        smtp.send_message(["bad@email.com"], "me@email.com", "<p>hi</p>", "hi", "test")
+    smtp.send_message(["you@email.com"], "me@email.com", "<p>hi</p>", "hi", "test")
+    assert smtp.connect.call_count == 1
+
+    with pytest.raises(ConnectionRefusedError):
+        backend(1).send_message(["you@email.com"], "me@email.com", "", "", "test")
+
+
+def test_connect(monkeypatch):
+    monkeypatch.setattr(smtplib, "SMTP", mock.MagicMock())
+    backends.SmtpBackend(host="smtp.email.com", username="user", password="secret").connect()
+
+    smtplib.SMTP.assert_called_with("smtp.email.com", 587, timeout=30.0)
+    assert [call[0] for call in smtplib.SMTP.return_value.method_calls] == ["ehlo", "starttls", "ehlo", "login"]
+    smtplib.SMTP.return_value.login.assert_called_with("user", "secret")
+
+    with pytest.raises(AttributeError):
+        backends.SmtpBackend().connect()
+
+
+def test_init(relay):
+    handler, port = relay
+    command_tester = CommandTester(application.find("init"))
+    command_tester.execute(f"--backend=smtp host=127.0.0.1 port={port} starttls=false username=user password=secret")
+    assert "Initiated successfully" in command_tester.io.fetch_output()
+    assert utilities.get_config()["smtp"] == dict(
+        host="127.0.0.1", port=port, starttls=False, username="user", password="secret"
+    )
+
+    command_tester = CommandTester(application.find("send"))
+    command_tester.execute("--backend=smtp me@email.com test --c Hello you@email.com")
+    assert "1 of 1 messages sent" in command_tester.io.fetch_output()
+    assert handler.messages[0][1] == ["you@email.com"]
+
+
+def test_send_attachments(relay, tmp_path):
+    handler, port = relay
+    (tmp_path / "report.pdf").write_bytes(b"%PDF" * 1000)
+    results = backend(port).send_many(
+        "me@email.com", "test", [dict(email="1@email.com")], content="Hi", attachments=[str(tmp_path / "report.pdf")]
+    )
+
+    assert [result.response for result in results] == [["1@email.com"]]
+    message = email.message_from_string(handler.messages[0][2], policy=email.policy.default)
+    assert message.get_content_type() == "multipart/mixed"
+    assert message.get_body(("plain",)).get_content().strip() == "Hi"
+    attachment, = message.iter_attachments()
+    assert attachment.get_content() == b"%PDF" * 1000
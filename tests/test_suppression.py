@@ -0,0 +1,84 @@
+import json
+import mock
+from maildown import backends, suppression
+from maildown.backends.base import BaseBackend
+
+
+def bounce(email, bounce_type="Permanent"):
+    return dict(
+        notificationType="Bounce",
+        bounce=dict(bounceType=bounce_type, bouncedRecipients=[dict(emailAddress=email)]),
+    )
+
+
+def test_read(tmp_path):
+    export = tmp_path / "export.json"
+    export.write_text(json.dumps(dict(SuppressedDestinationSummaries=[
+        dict(EmailAddress="first@email.com", Reason="BOUNCE"),
+        dict(EmailAddress="second@email.com", Reason="COMPLAINT"),
+    ])))
+    assert list(suppression.read(str(export))) == [("first@email.com", "bounce"), ("second@email.com", "complaint")]
+
+    notifications = tmp_path / "notifications.jsonl"
+    notifications.write_text("\n".join([
+        json.dumps(bounce("first@email.com")),
+        json.dumps(bounce("later@email.com", "Transient")),
+        json.dumps(dict(Type="Notification", Message=json.dumps(dict(
+            notificationType="Complaint", complaint=dict(complainedRecipients=[dict(emailAddress="angry@email.com")])
+        )))),
+    ]))
+    assert list(suppression.read(str(notifications))) == [
+        ("first@email.com", "bounce"),
+        ("angry@email.com", "complaint"),
+    ]
+
+    bounces = tmp_path / "bounces.csv"
+    bounces.write_text(
+        "Date,Email Address,Bounce Type\n2020-01-01,first@email.com,Permanent\n2020-01-01,second@email.com,\n"
+    )
+    assert list(suppression.read(str(bounces))) == [("first@email.com", "Permanent"), ("second@email.com", None)]
+
+    lines = tmp_path / "unsubscribed.txt"
+    lines.write_text("first@email.com\n\nsecond@email.com\n")
+    assert list(suppression.read(str(lines))) == [("first@email.com", None), ("second@email.com", None)]
+
+
+def test_suppression_list(tmp_path):
+    assert suppression.default_index() is None
+
+    with suppression.SuppressionList() as suppressions:
+        assert suppressions.add([("First@email.com", "bounce"), ("second@email.com", None)], source="test") == 2
+        assert suppressions.add([("FIRST@email.com", "complaint"), ("third@email.com", None)]) == 1
+        assert len(suppressions) == 3
+        assert suppressions.reason("first@email.com") == "bounce"
+        assert suppressions.reason("second@email.com") == ""
+        assert "nobody@email.com" not in suppressions
+
+        index = suppression.default_index()
+        assert len(index) == 3
+        assert "FIRST@EMAIL.COM" in index
+        assert "nobody@email.com" not in index
+
+        assert suppressions.remove(["second@email.com", "nobody@email.com"]) == 1
+        index = suppression.default_index()
+        assert len(index) == 2
+        assert "second@email.com" not in index
+
+
+def test_send_many_skips_suppressed(monkeypatch):
+    with suppression.SuppressionList() as suppressions:
+        suppressions.add([("bounced@email.com", "bounce")])
+
+    backend = BaseBackend()
+    monkeypatch.setattr(backend, "send_message", mock.MagicMock(return_value={}))
+    results = backend.send_many(
+        "me@email.com", "Hello", [dict(email="you@email.com"), dict(email="BOUNCED@email.com")], content="Hi"
+    )
+
+    errors = {result.recipient: result.error for result in results}
+    assert errors["you@email.com"] is None
+    assert isinstance(errors["BOUNCED@email.com"], backends.Suppressed)
+    backend.send_message.assert_called_once()
+
+    backend.send("me@email.com", "Hello", ["bounced@email.com"], content="Hi")
+    backend.send_message.assert_called_once()
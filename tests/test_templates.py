@@ -0,0 +1,104 @@
+import base64
+import json
+import os
+import jinja2
+import mistune
+import mock
+import pytest
+from maildown import inliner, renderer, templates
+
+
+def test_from_string(home):
+    template = templates.from_string("Hello {{ name }}")
+    assert template is templates.from_string("Hello {{ name }}")
+    assert template.render(name="Chris") == jinja2.Template("Hello {{ name }}").render(name="Chris")
+    assert templates.from_string("Hello {{ name }}", templates.PlaceholderUndefined).render() == "Hello {{name}}"
+    assert len(os.listdir(home / ".maildown" / "jinja")) == 1
+
+    templates.clear_caches()
+    with mock.patch.object(jinja2.Environment, "compile") as compile:
+        assert templates.from_string("Hello {{ name }}").render(name="Bob") == "Hello Bob"
+    compile.assert_not_called()
+
+
+def test_bytecode_cache_unwritable(home):
+    (home / ".maildown").write_text("not a directory")
+    assert templates.from_string("Hello {{ name }}").render(name="Chris") == "Hello Chris"
+
+
+def test_artifact(monkeypatch, tmp_path):
+    path = str(tmp_path / "email.mdc")
+    renderer.compile_content("# Hello {{ name }}").save(path)
+    renderer._compile.cache_clear()
+    templates.clear_caches()
+
+    monkeypatch.setattr(mistune, "Markdown", mock.MagicMock())
+    monkeypatch.setattr(inliner, "transform", mock.MagicMock())
+    monkeypatch.setattr(jinja2.Environment, "compile", mock.MagicMock())
+
+    with pytest.raises(ValueError, match="trusted source"):
+        templates.read_file(path, trusted=False)
+    content = templates.read_file(path)
+    assert content == "# Hello {{ name }}"
+    compiled = renderer.compile_content(content)
+    assert "Hello Chris</h1>" in compiled.render(dict(name="Chris"))
+    mistune.Markdown.assert_not_called()
+    inliner.transform.assert_not_called()
+    jinja2.Environment.compile.assert_not_called()
+
+
+def test_artifact_theme(monkeypatch, tmp_path):
+    theme = tmp_path / "brand.css"
+    theme.write_text("h1 { color: red; }")
+    path = str(tmp_path / "email.mdc")
+    renderer.compile_content("# Hello", theme=str(theme)).save(path)
+    renderer._compile.cache_clear()
+    templates.clear_caches()
+
+    # The artifact is only used for the theme it was compiled with, not in place of the default style
+    content = templates.read_file(path)
+    artifact = templates.compile_content(content, theme=str(theme))
+    assert "color:red" in artifact.source.replace(" ", "")
+    default = templates.compile_content(content)
+    assert default is not artifact
+    assert "color:red" not in default.source.replace(" ", "")
+    theme.write_text("h1 { color: blue; }")
+    assert templates.compile_content(content, theme=str(theme)) is not artifact
+    renderer._compile.cache_clear()
+
+
+def test_artifact_cache_size(monkeypatch, tmp_path):
+    monkeypatch.setattr(templates, "ARTIFACT_CACHE_SIZE", 2)
+    for number in range(3):
+        renderer.compile_content(f"# Email {number}").save(str(tmp_path / f"{number}.mdc"))
+    renderer._compile.cache_clear()
+    templates.clear_caches()
+
+    for number in range(3):
+        templates.read_file(str(tmp_path / f"{number}.mdc"))
+    assert templates.loaded("# Email 0") is None
+    assert templates.loaded("# Email 2") is not None
+    assert len(templates._artifacts) == 2
+
+    # Artifacts from before themes were recorded still load, but are compiled again rather than trusted
+    path = tmp_path / "old.mdc"
+    renderer.compile_content("# Old").save(str(path))
+    path.write_text(json.dumps({key: value for key, value in json.loads(path.read_text()).items() if key != "theme"}))
+    assert templates.read_file(str(path)) == "# Old"
+    assert templates.loaded("# Old") is None
+    renderer._compile.cache_clear()
+
+
+def test_artifact_other_python(tmp_path):
+    path = tmp_path / "email.mdc"
+    renderer.compile_content("# Hello {{ name }}").save(str(path))
+    artifact = json.loads(path.read_text())
+    artifact["bytecode"] = base64.b64encode(b"j2 from another python").decode("ascii")
+    path.write_text(json.dumps(artifact))
+
+    assert "Hello Chris</h1>" in templates.load(str(path)).render(dict(name="Chris"))
+
+    path.write_text(json.dumps(dict(artifact, format=0)))
+    with pytest.raises(ValueError, match="incompatible"):
+        templates.load(str(path))
+    renderer._compile.cache_clear()
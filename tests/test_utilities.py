@@ -1,19 +1,26 @@
 import pytest
-from maildown import utilities, backends, renderer
+from maildown import utilities, backends, templates
 import boto3
 import mock
 from botocore.exceptions import ClientError
 import builtins
 import toml
 import configparser
+import threading
 
 
 class MockClient(object):
     def __init__(self, *args, **kwargs):
         pass
 
-    def list_verified_email_addresses(self):
-        return dict(VerifiedEmailAddresses=["me@email.com"])
+    def list_identities(self, **kwargs):
+        return dict(Identities=["me@email.com", "pending@email.com"])
+
+    def get_identity_verification_attributes(self, Identities):
+        return dict(VerificationAttributes={
+            "me@email.com": dict(VerificationStatus="Success"),
+            "pending@email.com": dict(VerificationStatus="Pending"),
+        })
 
     def verify_email_address(self, EmailAddress):
         pass
@@ -26,11 +33,34 @@ def test_client(monkeypatch):
     monkeypatch.setattr(utilities, "get_config", mock.MagicMock())
     monkeypatch.setattr(boto3, "client", mock.MagicMock())
     utilities.get_config.return_value = dict(access_key=1, secret_key=1)
-    backends.AwsBackend().client
+    backend = backends.AwsBackend()
+    assert backend.client is backend.client
 
-    boto3.client.assert_called_with(
-        "ses", aws_access_key_id=None, aws_secret_access_key=None, region_name="us-east-1"
+    boto3.client.assert_called_once_with(
+        "ses", aws_access_key_id=None, aws_secret_access_key=None, region_name="us-east-1", config=mock.ANY
     )
+    config = boto3.client.call_args[1]["config"]
+    assert config.max_pool_connections == 10
+    assert config.retries == dict(max_attempts=3)
+
+
+def test_client_options(monkeypatch):
+    monkeypatch.setattr(utilities, "get_config", mock.MagicMock())
+    monkeypatch.setattr(boto3, "client", mock.MagicMock(side_effect=lambda *args, **kwargs: object()))
+    utilities.get_config.return_value = dict(aws=dict(retry_mode="adaptive", share_client=False))
+    backend = backends.AwsBackend(max_pool_connections=50, max_attempts=5)
+
+    clients = []
+    thread = threading.Thread(target=lambda: clients.append(backend.client))
+    thread.start()
+    thread.join()
+
+    assert backend.client is backend.client
+    assert clients[0] is not backend.client
+    assert boto3.client.call_count == 2
+    config = boto3.client.call_args[1]["config"]
+    assert config.max_pool_connections == 50
+    assert config.retries == dict(max_attempts=5, mode="adaptive")
 
 
 def test_verify_address(monkeypatch):
@@ -39,6 +69,7 @@ def test_verify_address(monkeypatch):
 
     assert backend.verify_address("me@email.com") is True
     assert backend.verify_address("me2@email.com") is False
+    assert backend.verify_address("pending@email.com") is False
 
 
 def test_verify_auth(monkeypatch):
@@ -89,11 +120,167 @@ def test_login(monkeypatch):
 
 def test_send_message(monkeypatch):
     monkeypatch.setattr(backends.AwsBackend, "client", mock.MagicMock())
+    monkeypatch.setattr(backends.AwsBackend, "rate_limiter", None)
     monkeypatch.setattr(builtins, "open", mock.MagicMock())
-    monkeypatch.setattr(renderer, "generate_content", mock.MagicMock())
+    monkeypatch.setattr(templates, "compile_content", mock.MagicMock())
     with pytest.raises(AttributeError):
         backends.AwsBackend().send("test", "test", ["test@test.com"], theme="test")
 
     backends.AwsBackend().send(
         "test", "test", ["test@test.com"], file_path="test", theme="test"
     )
+
+
+def test_send_many(monkeypatch):
+    monkeypatch.setattr(backends.AwsBackend, "send_message", mock.MagicMock())
+    backends.AwsBackend.send_message.side_effect = lambda to, *args: (
+        {"MessageId": to[0]} if to[0] != "bad@email.com" else 1 / 0
+    )
+    backend = backends.AwsBackend()
+
+    with pytest.raises(AttributeError):
+        backend.send_many("me@email.com", "test", [])
+
+    recipients = [dict(email=f"{i}@email.com", name=str(i)) for i in range(20)]
+    recipients.append(dict(email="bad@email.com"))
+    results = backend.send_many(
+        "me@email.com", "test", iter(recipients), content="Hi {{ name }} {{ greeting }}",
+        context=dict(greeting="there"), workers=2
+    )
+
+    assert len(results) == 21
+    failed = [result for result in results if result.error]
+    assert [result.recipient for result in failed] == ["bad@email.com"]
+    assert isinstance(failed[0].error, ZeroDivisionError)
+
+    html = {call[0][0][0]: call[0][2] for call in backends.AwsBackend.send_message.call_args_list}
+    assert "Hi 7 there" in html["7@email.com"]
+
+
+def test_config_snapshot(monkeypatch, home):
+    monkeypatch.setattr(toml, "loads", mock.MagicMock(wraps=toml.loads))
+    utilities.write_config(aws=dict(access_key="1234"))
+
+    config = backends.AwsBackend().config
+    assert config["access_key"] == "1234"
+    assert config.get("secret_key") is None
+    assert config.get("access_key") == "1234"
+    assert toml.loads.call_count == 1
+
+    utilities.get_config()["aws"]["access_key"] = "mutated"
+    assert config["access_key"] == "1234"
+
+    (home / "maildown.toml").write_text('[aws]\naccess_key = "123456"\n')
+    assert config["access_key"] == "123456"
+    assert toml.loads.call_count == 2
+
+
+def test_config_update(monkeypatch, home):
+    monkeypatch.setattr(utilities, "write_config", mock.MagicMock(wraps=utilities.write_config))
+    utilities.write_config(other=dict(key="value"))
+
+    config = backends.AwsBackend().config
+    config.update(access_key="1", secret_key="2")
+    config["region_name"] = "eu-west-1"
+
+    assert utilities.write_config.call_count == 3
+    assert toml.loads((home / "maildown.toml").read_text()) == dict(
+        other=dict(key="value"), aws=dict(access_key="1", secret_key="2", region_name="eu-west-1")
+    )
+    assert [path.name for path in home.iterdir()] == ["maildown.toml"]
+
+
+def test_call_rate_limited(monkeypatch):
+    throttle = ClientError({"Error": {"Code": "Throttling", "Message": "Maximum sending rate exceeded."}}, "SendEmail")
+    monkeypatch.setattr(backends.AwsBackend, "client", mock.MagicMock())
+    client = backends.AwsBackend.client
+    client.get_send_quota.return_value = dict(MaxSendRate=10.0, Max24HourSend=200.0, SentLast24Hours=10.0)
+    client.send_email.side_effect = [throttle, throttle, {"MessageId": "1"}]
+
+    backend = backends.AwsBackend()
+    limiter = backend.rate_limiter
+    assert limiter is backend.rate_limiter
+    assert limiter.daily_quota == 190
+    limiter.sleep = limiter.bucket.sleep = mock.MagicMock()
+
+    assert backend.send_message(["to@email.com"], "me@email.com", "<p>hi</p>", "hi", "test") == {"MessageId": "1"}
+    assert client.send_email.call_count == 3
+    assert limiter.sent == 1
+    assert 2.5 <= limiter.rate < 10.0
+
+    client.send_email.side_effect = ClientError(
+        {"Error": {"Code": "Throttling", "Message": "Daily message quota exceeded."}}, "SendEmail"
+    )
+    with pytest.raises(backends.QuotaExceeded):
+        backend.send_message(["to@email.com"], "me@email.com", "<p>hi</p>", "hi", "test")
+
+    client.send_email.side_effect = ClientError({"Error": {"Code": "MessageRejected"}}, "SendEmail")
+    with pytest.raises(ClientError):
+        backend.send_message(["to@email.com"], "me@email.com", "<p>hi</p>", "hi", "test")
+
+    client.send_email.side_effect = throttle
+    with pytest.raises(ClientError):
+        backends.AwsBackend(rate_limit=False).send_message(["to@email.com"], "me@email.com", "", "", "test")
+    assert backends.AwsBackend(rate_limit=False).rate_limiter is None
+
+    client.get_send_quota.side_effect = throttle
+    assert backends.AwsBackend().rate_limiter.max_rate == 1.0
+
+
+def test_send_bulk(monkeypatch):
+    monkeypatch.setattr(backends.AwsBackend, "client", mock.MagicMock())
+    monkeypatch.setattr(backends.AwsBackend, "rate_limiter", None)
+    client = backends.AwsBackend.client
+    client.create_template.side_effect = ClientError({"Error": {"Code": "AlreadyExists"}}, "CreateTemplate")
+
+    recipients = [dict(email=f"{i}@email.com", name=str(i)) for i in range(60)]
+    first_chunk = [dict(Status="Success", MessageId=str(i)) for i in range(50)]
+    first_chunk[0] = dict(Status="TransientFailure")
+    first_chunk[1] = dict(Status="MessageRejected", Error="Email address is not verified.")
+    client.send_bulk_templated_email.side_effect = [
+        dict(Status=first_chunk),
+        dict(Status=[dict(Status="Success", MessageId="0")]),
+        ClientError({"Error": {"Code": "InvalidParameterValue"}}, "SendBulkTemplatedEmail"),
+    ]
+
+    results = list(backends.AwsBackend().iter_send_bulk(
+        "me@email.com", "Hi {{name}}", iter(recipients), content="Hello {{ name }}, {{ greeting }}",
+        context=dict(greeting="welcome")
+    ))
+
+    template = client.create_template.call_args[1]["Template"]
+    assert "Hello {{name}}, welcome" in template["HtmlPart"]
+    assert template["SubjectPart"] == "Hi {{name}}"
+    client.delete_template.assert_called_with(TemplateName=template["TemplateName"])
+
+    calls = client.send_bulk_templated_email.call_args_list
+    assert [len(call[1]["Destinations"]) for call in calls] == [50, 1, 10]
+    assert calls[0][1]["Template"] == template["TemplateName"]
+    assert calls[0][1]["DefaultTemplateData"] == '{"greeting": "welcome"}'
+    assert calls[1][1]["Destinations"] == [
+        dict(
+            Destination=dict(ToAddresses=["0@email.com"]),
+            ReplacementTemplateData='{"email": "0@email.com", "name": "0"}',
+        )
+    ]
+
+    assert len(results) == 60
+    failed = {result.recipient: result.error for result in results if result.error}
+    assert set(failed) == {"1@email.com"} | {f"{i}@email.com" for i in range(50, 60)}
+    assert str(failed["1@email.com"]) == "MessageRejected: Email address is not verified."
+    assert isinstance(failed["55@email.com"], ClientError)
+
+    # Destinations SES returns no status for are reported as failures, rather than dropped
+    client.send_bulk_templated_email.side_effect = [dict(Status=[dict(Status="Success", MessageId="0")])]
+    results = list(backends.AwsBackend().iter_send_bulk("me@email.com", "Hi", iter(recipients[:3]), content="Hi"))
+    assert [result.recipient for result in results] == ["0@email.com", "1@email.com", "2@email.com"]
+    assert [str(result.error) for result in results[1:]] == [
+        "MissingStatus: SES returned no status for this destination"
+    ] * 2
+
+    with pytest.raises(AttributeError):
+        list(backends.AwsBackend().iter_send_bulk("me@email.com", "test", []))
+
+    client.create_template.side_effect = ClientError({"Error": {"Code": "LimitExceeded"}}, "CreateTemplate")
+    with pytest.raises(ClientError):
+        list(backends.AwsBackend().iter_send_bulk("me@email.com", "test", [], content="test"))